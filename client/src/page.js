@@ -89,6 +89,50 @@ const formatAnalysisText = (text) => {
   });
 };
 
+// POST a JSON body to a server-sent events endpoint and call onEvent(event, data)
+// for each event as it arrives
+const streamEvents = async (url, body, onEvent) => {
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(body)
+  });
+
+  if (!response.ok) {
+    const errorText = await response.text();
+    throw new Error(`HTTP error! status: ${response.status} ${errorText}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const message = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = 'message';
+      let data = '';
+      for (const line of message.split('\n')) {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      }
+      const payload = data ? JSON.parse(data) : null;
+      if (event === 'error') {
+        throw new Error(payload ? payload.detail : 'Stream error');
+      }
+      onEvent(event, payload);
+    }
+  }
+};
+
 const Page = () => {
   const [selectedImage, setSelectedImage] = useState(null);
   const [imagePreview, setImagePreview] = useState(null);
@@ -159,22 +203,18 @@ const Page = () => {
     setAnalysisStage('basic');
 
     try {
-      // First get basic analysis
-      const response = await fetch('http://localhost:8000/inference/basic', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ filename })
+      // First get basic analysis, streamed: the scene analysis, then the text as it is generated
+      let text = '';
+      await streamEvents('http://localhost:8000/inference/basic/stream', { filename }, (event, data) => {
+        if (event === 'scene_analysis') {
+          setSceneContext(data);
+        } else if (event === 'token') {
+          text += data.text;
+          setBasicAnalysis(text);
+        } else if (event === 'done') {
+          setBasicAnalysis(data.text);
+        }
       });
-
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
-
-      const data = await response.json();
-      setBasicAnalysis(data.text);
-      setSceneContext(data.scene_analysis);
       
     } catch (err) {
       setError('Failed to analyze. Please try again.');
@@ -226,30 +266,26 @@ const Page = () => {
         feedback_id: feedbackId
       });
 
-      // After successful feedback submission, get enhanced analysis
-      const enhancedResponse = await fetch('http://localhost:8000/inference/enhanced', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ 
-          filename,
-          scene_analysis: sceneContext,
-          feedback_id: feedbackId
-        })
+      // After successful feedback submission, get enhanced analysis, streamed:
+      // the relevant patterns, then the text as it is generated
+      let text = '';
+      await streamEvents('http://localhost:8000/inference/enhanced/stream', {
+        filename,
+        scene_analysis: sceneContext,
+        feedback_id: feedbackId
+      }, (event, data) => {
+        if (event === 'patterns') {
+          setRelevantPatterns(data.relevant_patterns);
+          setRelationshipKeys(data.relationship_keys);
+        } else if (event === 'token') {
+          text += data.text;
+          setEnhancedAnalysis(text);
+          setAnalysisStage('enhanced');
+        } else if (event === 'done') {
+          setEnhancedAnalysis(data.text);
+          setAnalysisStage('enhanced');
+        }
       });
-
-      if (!enhancedResponse.ok) {
-        const errorText = await enhancedResponse.text();
-        console.error("Enhanced analysis failed:", errorText);
-        throw new Error(`Enhanced analysis failed: ${errorText}`);
-      }
-
-      const enhancedData = await enhancedResponse.json();
-      setEnhancedAnalysis(enhancedData.text);
-      setRelevantPatterns(enhancedData.relevant_patterns);
-      setRelationshipKeys(enhancedData.relationship_keys);
-      setAnalysisStage('enhanced');
       
     } catch (err) {
       setError(`Failed to submit feedback or get enhanced analysis: ${err.message}`);
@@ -440,7 +476,7 @@ const Page = () => {
                   <button
                     className="submit-button"
                     onClick={handleFeedbackSubmit}
-                    disabled={submitting || basicRating === 0}
+                    disabled={submitting || loading || basicRating === 0}
                   >
                     {submitting ? <span className="loading-spinner"></span> : "Submit & Get Enhanced Analysis"}
                   </button>
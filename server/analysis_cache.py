@@ -0,0 +1,150 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+ANALYSIS_CACHE_FILE = "analysis_cache.db"
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+# Set ANALYSIS_CACHE_DISK=0 to keep analyses in memory only
+ANALYSIS_CACHE_DISK = os.getenv("ANALYSIS_CACHE_DISK", "1") == "1"
+
+# Neighbours of a newly ingested image whose cached analyses are checked for invalidation
+INVALIDATION_NEIGHBOURS = int(os.getenv("ANALYSIS_INVALIDATION_NEIGHBOURS", "50"))
+
+
+class AnalysisCache:
+    """
+    Cache of scene analyses keyed by image id and neighbourhood version.
+
+    Every image has a version, stored in SQLite so ingestion processes and the server
+    see the same one. An analysis is cached together with the version it was computed
+    at and the distance of its farthest neighbour (its radius). Ingesting an image bumps
+    the version of every cached image whose radius it falls into, i.e. whose neighbour
+    set it may enter, which invalidates their analyses.
+
+    Analyses are kept in an in-memory LRU of `max_entries` and, if `disk` is set, in
+    SQLite so they survive restarts.
+    """
+
+    def __init__(self, path=ANALYSIS_CACHE_FILE, max_entries=ANALYSIS_CACHE_SIZE, disk=ANALYSIS_CACHE_DISK):
+        self.max_entries = max_entries
+        self.disk = disk
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS neighbourhoods (
+                image_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                radius REAL
+            );
+            CREATE TABLE IF NOT EXISTS analyses (
+                image_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                analysis TEXT NOT NULL
+            );
+        """)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, image_id):
+        """Current neighbourhood version of an image, read before computing its analysis"""
+        row = self._conn.execute("SELECT version FROM neighbourhoods WHERE image_id = ?", (image_id,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, image_id):
+        """Cached analysis of an image if it is still up to date, None otherwise"""
+        version = self.version(image_id)
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(image_id)
+                self.hits += 1
+                return entry[1]
+
+            if self.disk:
+                row = self._conn.execute(
+                    "SELECT analysis FROM analyses WHERE image_id = ? AND version = ?", (image_id, version)
+                ).fetchone()
+                if row:
+                    analysis = json.loads(row[0])
+                    self._remember(image_id, version, analysis)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return analysis
+
+            self.misses += 1
+            return None
+
+    def put(self, image_id, version, analysis, radius):
+        """
+        Cache an analysis.
+
+        Args:
+            image_id (str): ID of the analyzed image
+            version (int): Version returned by version() before the analysis was computed
+            analysis (dict): JSON-serializable analysis
+            radius (float): Distance of the farthest neighbour used by the analysis
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO neighbourhoods (image_id, version, radius) VALUES (?, ?, ?) "
+                "ON CONFLICT(image_id) DO UPDATE SET radius = excluded.radius",
+                (image_id, version, radius)
+            )
+            if self.disk:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO analyses (image_id, version, analysis) VALUES (?, ?, ?)",
+                    (image_id, version, json.dumps(analysis))
+                )
+            self._remember(image_id, version, analysis)
+
+    def _remember(self, image_id, version, analysis):
+        self._entries[image_id] = (version, analysis)
+        self._entries.move_to_end(image_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_near(self, neighbours):
+        """
+        Invalidate the analyses a newly ingested image may change.
+
+        Args:
+            neighbours (list): (image_id, distance) of the new image's nearest neighbours,
+                including the image itself when it replaces an existing one
+        """
+        with self._lock, self._conn:
+            invalidated = 0
+            for image_id, distance in neighbours:
+                invalidated += self._conn.execute(
+                    "UPDATE neighbourhoods SET version = version + 1 WHERE image_id = ? AND (radius IS NULL OR ? <= radius)",
+                    (image_id, distance)
+                ).rowcount
+            self.invalidations += invalidated
+            return invalidated
+
+    def invalidate_all(self):
+        """Invalidate every analysis, used when images are deleted"""
+        with self._lock, self._conn:
+            self.invalidations += self._conn.execute("UPDATE neighbourhoods SET version = version + 1").rowcount
+            self._conn.execute("DELETE FROM analyses")
+            self._entries.clear()
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+        }
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,123 @@
+from typing import List
+from pydantic import BaseModel, ValidationError
+import tolerant_json
+
+
+class AnalysisParseError(ValueError):
+    """Raised when a model response does not contain a usable image analysis"""
+
+
+class AnalyzedObject(BaseModel):
+    label: str
+    attributes: List[str]
+
+
+class AnalyzedRelationship(BaseModel):
+    subject: str
+    object: str
+    spatial: str
+    functional: str
+    state: str
+    contextual: str
+    confidence: float
+
+
+class ImageAnalysis(BaseModel):
+    """Schema of IMAGE_ANALYSIS_PROMPT answers, also sent to the model as its response schema"""
+    objects: List[AnalyzedObject]
+    relationships: List[AnalyzedRelationship]
+    scene_annotation: str
+
+
+class BatchImageAnalysis(ImageAnalysis):
+    """One entry of a BATCH_IMAGE_ANALYSIS_PROMPT answer"""
+    image_index: int
+
+
+# Filled in for relationships where the model left a dimension out
+RELATIONSHIP_DEFAULTS = {"spatial": "", "functional": "", "state": "", "contextual": "", "confidence": 0.0}
+
+
+def _valid_items(items, model, defaults=None):
+    """Items of a list that validate against `model`, invalid ones are dropped"""
+    valid = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            valid.append(model.model_validate({**(defaults or {}), **item}))
+        except ValidationError:
+            continue
+    return valid
+
+
+def validate_analysis(data):
+    """
+    Build an analysis from parsed JSON, keeping the valid objects and relationships.
+
+    Raises:
+        AnalysisParseError: If there is no valid object or no scene annotation
+    """
+    if not isinstance(data, dict):
+        raise AnalysisParseError(f"Expected an object, got {type(data).__name__}")
+
+    objects = _valid_items(data.get("objects"), AnalyzedObject)
+    relationships = _valid_items(data.get("relationships"), AnalyzedRelationship, RELATIONSHIP_DEFAULTS)
+    scene_annotation = data.get("scene_annotation")
+    if not objects or not isinstance(scene_annotation, str) or not scene_annotation:
+        raise AnalysisParseError("Missing objects or scene_annotation")
+
+    return ImageAnalysis(objects=objects, relationships=relationships, scene_annotation=scene_annotation)
+
+
+def parse_analysis(text):
+    """
+    Parse a single-image analysis, strictly first and with the tolerant parser otherwise.
+
+    Returns:
+        tuple: (ImageAnalysis, strict) where strict tells whether the text was valid JSON
+
+    Raises:
+        AnalysisParseError: If no usable analysis can be recovered
+    """
+    try:
+        data, strict = tolerant_json.loads(text)
+    except tolerant_json.TolerantJSONError as e:
+        raise AnalysisParseError(str(e))
+    return validate_analysis(data), strict
+
+
+def parse_batch_analysis(text, count):
+    """
+    Split the answer to a batch analysis prompt into one analysis per image.
+
+    Entries are matched to images by their image_index (or their position when it is
+    missing or invalid).
+
+    Returns:
+        list: For each image, its ImageAnalysis, or None if it is missing or invalid
+    """
+    analyses = [None] * count
+    try:
+        entries, _ = tolerant_json.loads(text)
+    except tolerant_json.TolerantJSONError:
+        return analyses
+    if isinstance(entries, dict):
+        entries = [entries]
+    if not isinstance(entries, list):
+        return analyses
+
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get("image_index")
+        if not isinstance(index, int) or not 1 <= index <= count:
+            index = position + 1
+        if index > count or analyses[index - 1] is not None:
+            continue
+        try:
+            analysis = validate_analysis(entry)
+        except AnalysisParseError:
+            continue
+        analyses[index - 1] = analysis
+    return analyses
@@ -0,0 +1,388 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import numpy as np
+
+
+# Optional vector index for image similarity: "" keeps Chroma's own index, "hnsw" or
+# "ivfpq" serve nearest-neighbour queries from a local faiss index (pip install faiss-cpu)
+ANN_INDEX = os.getenv("ANN_INDEX", "")
+ANN_INDEX_DIR = os.getenv("ANN_INDEX_DIR", "ann_index")
+
+# HNSW: graph degree and the size of the candidate lists at build and query time.
+# Raising ANN_EF_SEARCH trades latency for recall.
+HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "64"))
+
+# IVF-PQ: number of inverted lists, of lists visited per query (recall/latency knob), and
+# of sub-quantizers (bytes per vector, must divide the dimension). Candidates are re-ranked
+# with the exact vectors, ANN_REFINE times the number of results asked.
+IVF_NLIST = int(os.getenv("ANN_NLIST", "1024"))
+IVF_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+PQ_M = int(os.getenv("ANN_PQ_M", "64"))
+REFINE_FACTOR = int(os.getenv("ANN_REFINE", "10"))
+
+# The index is written to disk after this many inserts (and on close)
+SAVE_EVERY = int(os.getenv("ANN_SAVE_EVERY", "1000"))
+# Seconds between checks for vectors added by other processes (the ingestion script and
+# the server share the index directory)
+SYNC_INTERVAL = float(os.getenv("ANN_SYNC_INTERVAL", "1"))
+
+
+def load_faiss():
+    try:
+        import faiss
+    except ImportError:
+        raise RuntimeError("ANN_INDEX needs faiss: pip install faiss-cpu")
+    return faiss
+
+
+class AnnIndex:
+    """
+    Nearest-neighbour index over the image embeddings, kept next to the Chroma collection.
+
+    Vectors are appended to a float16 file that is memory-mapped for reads, so only the
+    pages of the vectors actually looked at are loaded: the query-by-id fast path reads an
+    image's own vector from it instead of asking Chroma, and IVF-PQ re-ranks its candidates
+    with it. Image ids map to rows of that file in SQLite, and the faiss label of a vector
+    is its row. Distances are squared L2, like Chroma's default space.
+
+    "hnsw" keeps full vectors in a graph (best recall, about 4 * dim bytes per vector in
+    memory). "ivfpq" keeps PQ codes only (PQ_M bytes per vector); it is trained once enough
+    vectors are in, and until then searches exactly with a flat index of the vectors.
+
+    Inserts are incremental. Re-adding an image appends a new row and retires the old one;
+    retired rows are skipped in results.
+
+    Several processes can write to the same directory. Rows are allocated inside an
+    IMMEDIATE SQLite transaction, so writers never get the same row, and every process adds
+    the rows written by the others to its faiss index, in row order, when it syncs: before
+    each insert, and at most every SYNC_INTERVAL seconds before a search.
+    """
+
+    def __init__(self, kind=ANN_INDEX, directory=ANN_INDEX_DIR, ef_search=HNSW_EF_SEARCH, nprobe=IVF_NPROBE,
+                 nlist=IVF_NLIST, pq_m=PQ_M, refine=REFINE_FACTOR):
+        if kind not in ("hnsw", "ivfpq"):
+            raise ValueError(f"Unknown ANN index: {kind}")
+        self.faiss = load_faiss()
+        self.kind = kind
+        self.directory = directory
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.refine = refine
+        self._lock = threading.RLock()
+        self._unsaved = 0
+        self._vectors = None
+        self._synced_at = 0.0
+        # Number of removals seen, other processes' removals make the live rows reload
+        self._removals = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self.index_path = os.path.join(directory, f"{kind}.faiss")
+        self._conn = sqlite3.connect(os.path.join(directory, "rows.db"), check_same_thread=False, timeout=30)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS rows (
+                row INTEGER PRIMARY KEY,
+                image_id TEXT NOT NULL,
+                live INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS rows_live ON rows(image_id) WHERE live = 1;
+        """)
+        self.dim = None
+        self.row_by_id = {}
+        self.id_by_row = {}
+        self.rows = 0
+        self.index = None
+        self._staging = None
+        self._sync()
+
+    def __len__(self):
+        return len(self.row_by_id)
+
+    def __contains__(self, image_id):
+        return image_id in self.row_by_id
+
+    def _open_index(self):
+        faiss = self.faiss
+        if os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+        elif self.kind == "hnsw":
+            self.index = faiss.IndexHNSWFlat(self.dim, HNSW_M)
+            self.index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        else:
+            quantizer = faiss.IndexFlatL2(self.dim)
+            self.index = faiss.IndexIVFPQ(quantizer, self.dim, self.nlist, self.pq_m, 8)
+        self.set_params(self.ef_search, self.nprobe)
+        if not self.index.is_trained:
+            # Filled with every row by _sync
+            self._staging = faiss.IndexFlatL2(self.dim)
+
+    def _indexed(self):
+        """Number of rows in the faiss index (or the staging index), always the first rows"""
+        return (self._staging if self._staging is not None else self.index).ntotal
+
+    def _sync(self):
+        """
+        Catch up with the rows written since the last sync, by this process or another one:
+        map their ids, and add them to the faiss index. Rows written after the last save of
+        the index file (e.g. before a crash) are indexed again the same way.
+        """
+        self._synced_at = time.monotonic()
+        if self.dim is None:
+            dim = self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+            if dim is None:
+                return
+            self.dim = int(dim[0])
+            self._open_index()
+
+        rows = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+        removals = self._conn.execute("SELECT value FROM meta WHERE key = 'removals'").fetchone()
+        if removals != self._removals:
+            self._removals = removals
+            self.row_by_id.clear()
+            self.id_by_row.clear()
+            start = 0
+        else:
+            start = self.rows
+        if rows > start:
+            for row, image_id in self._conn.execute(
+                "SELECT row, image_id FROM rows WHERE row >= ? AND live = 1 ORDER BY row", (start,)
+            ):
+                # A newer row of an image retires the one mapped so far
+                retired = self.row_by_id.get(image_id)
+                if retired is not None:
+                    del self.id_by_row[retired]
+                self.row_by_id[image_id] = row
+                self.id_by_row[row] = image_id
+        self.rows = max(self.rows, rows)
+
+        if self._indexed() < self.rows:
+            self._index_rows(self._indexed(), self.rows)
+            if self._staging is not None:
+                self._train_if_ready()
+
+    def _sync_if_due(self):
+        if time.monotonic() - self._synced_at >= SYNC_INTERVAL:
+            self._sync()
+
+    def set_params(self, ef_search=None, nprobe=None, refine=None):
+        """Tune recall against latency: efSearch for HNSW, nprobe and the re-ranking factor for IVF-PQ"""
+        if refine is not None:
+            self.refine = refine
+        if ef_search is not None:
+            self.ef_search = ef_search
+            if self.kind == "hnsw" and self.index is not None:
+                self.index.hnsw.efSearch = ef_search
+        if nprobe is not None:
+            self.nprobe = nprobe
+            if self.kind == "ivfpq" and self.index is not None:
+                self.index.nprobe = nprobe
+
+    def vectors(self):
+        """Memory-mapped view of all the stored vectors, remapped when rows were appended"""
+        if self._vectors is None or len(self._vectors) != self.rows:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(self.rows, self.dim)) \
+                if self.rows else np.zeros((0, self.dim or 0), dtype=np.float16)
+        return self._vectors
+
+    def _index_rows(self, start, end):
+        """Add rows [start, end) to the faiss index, in order, reading them from the vector file"""
+        vectors = self.vectors()
+        for chunk in range(start, end, 65536):
+            stop = min(end, chunk + 65536)
+            self._add_to_index(chunk, np.ascontiguousarray(vectors[chunk:stop], dtype=np.float32))
+
+    def _add_to_index(self, start, data):
+        if self._staging is not None:
+            # Flat index labels are the insertion order too
+            self._staging.add(data)
+        elif self.kind == "hnsw":
+            # HNSW labels are the insertion order, which is the row order
+            self.index.add(data)
+        else:
+            self.index.add_with_ids(data, np.arange(start, start + len(data), dtype=np.int64))
+
+    def _train_if_ready(self):
+        """Train IVF-PQ once there are enough vectors for its lists, then index every row"""
+        # 39 training points per centroid, for the IVF lists and the 256 codes of each sub-quantizer
+        if self.index.is_trained or self.rows < max(self.nlist, 256) * 39:
+            return
+        vectors = self.vectors()
+        sample = np.random.default_rng(0).choice(self.rows, size=min(self.rows, self.nlist * 256), replace=False)
+        self.index.train(np.ascontiguousarray(vectors[np.sort(sample)], dtype=np.float32))
+        self._staging = None
+        self._index_rows(0, self.rows)
+
+    def add(self, image_ids, embeddings):
+        """Insert or replace the vectors of several images"""
+        image_ids = list(image_ids)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if not image_ids:
+            return
+        if len(set(image_ids)) != len(image_ids):
+            # The last vector of an id repeated within the batch wins
+            keep = sorted({image_id: i for i, image_id in enumerate(image_ids)}.values())
+            image_ids = [image_ids[i] for i in keep]
+            embeddings = embeddings[keep]
+        with self._lock:
+            if self.dim is None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)", (str(embeddings.shape[1]),)
+                    )
+
+            # The write lock is taken before reading the last row, so concurrent writers
+            # (other processes) get consecutive, distinct rows
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                start = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+                self._conn.executemany(
+                    "UPDATE rows SET live = 0 WHERE image_id = ? AND live = 1", [(i,) for i in image_ids]
+                )
+                self._conn.executemany(
+                    "INSERT INTO rows (row, image_id) VALUES (?, ?)",
+                    [(start + offset, image_id) for offset, image_id in enumerate(image_ids)]
+                )
+                # Written at the row's offset, so a write left over by a crash before the commit is overwritten
+                with open(self.vectors_path, 'r+b' if os.path.exists(self.vectors_path) else 'wb') as f:
+                    f.seek(start * embeddings.shape[1] * 2)
+                    f.write(embeddings.astype(np.float16).tobytes())
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+            # Indexes the new rows, after any rows other processes wrote before them
+            self._sync()
+
+            self._unsaved += len(image_ids)
+            if self._unsaved >= SAVE_EVERY:
+                self.save()
+
+    def _count_removal(self):
+        # Other processes reload their live rows when they see the count change
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('removals', 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def remove(self, image_id):
+        with self._lock, self._conn:
+            row = self.row_by_id.pop(image_id, None)
+            if row is not None:
+                del self.id_by_row[row]
+            self._conn.execute("UPDATE rows SET live = 0 WHERE image_id = ? AND live = 1", (image_id,))
+            self._count_removal()
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE rows SET live = 0")
+            self._count_removal()
+            self.row_by_id.clear()
+            self.id_by_row.clear()
+
+    def get_vector(self, image_id):
+        """Stored vector of an image, or None"""
+        with self._lock:
+            self._sync_if_due()
+        row = self.row_by_id.get(image_id)
+        return None if row is None else np.asarray(self.vectors()[row], dtype=np.float32)
+
+    def _rerank(self, queries, labels):
+        """Candidates of each query sorted by their exact distance to it"""
+        vectors = self.vectors()
+        distances, ranked = [], []
+        for query, rows in zip(queries, labels):
+            rows = np.array([row for row in rows.tolist() if row in self.id_by_row], dtype=np.int64)
+            row_distances = ((np.asarray(vectors[rows], dtype=np.float32) - query) ** 2).sum(-1)
+            order = np.argsort(row_distances)
+            distances.append(row_distances[order])
+            ranked.append(rows[order])
+        return distances, ranked
+
+    def search(self, query_embeddings, n):
+        """
+        Nearest images of each query vector.
+
+        Args:
+            query_embeddings (list): Query vectors
+            n (int): Number of results per query
+
+        Returns:
+            tuple: (ids, distances), one list per query, nearest first
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            self._sync_if_due()
+            if self.index is None or not self.id_by_row:
+                return [[] for _ in queries], [[] for _ in queries]
+            # Over-fetch for retired rows and the IVF-PQ re-ranking
+            k = n + (self.rows - len(self.id_by_row))
+            if self.kind == "ivfpq" and self._staging is None:
+                k *= self.refine
+            k = min(k, self.rows)
+            if self._staging is not None:
+                found_distances, labels = self._staging.search(queries, k)
+            else:
+                found_distances, labels = self.index.search(queries, k)
+                if self.kind == "ivfpq":
+                    # PQ distances are approximate, re-rank the candidates with the stored vectors
+                    found_distances, labels = self._rerank(queries, labels)
+
+        ids, distances = [], []
+        for rows, row_distances in zip(labels, found_distances):
+            query_ids, query_distances = [], []
+            for row, distance in zip(rows, row_distances):
+                image_id = self.id_by_row.get(int(row))
+                if image_id is None:
+                    continue
+                query_ids.append(image_id)
+                query_distances.append(float(distance))
+                if len(query_ids) >= n:
+                    break
+            ids.append(query_ids)
+            distances.append(query_distances)
+        return ids, distances
+
+    def query_by_id(self, image_id, n):
+        """
+        Nearest images of a stored image, read from the vector file without fetching its
+        embedding from Chroma. Like a Chroma query, the image itself is included.
+
+        Returns:
+            tuple: (ids, distances), or None if the image is not in the index
+        """
+        vector = self.get_vector(image_id)
+        if vector is None:
+            return None
+        ids, distances = self.search([vector], n)
+        return ids[0], distances[0]
+
+    def save(self):
+        """Write the faiss index next to the vector file, atomically"""
+        with self._lock:
+            if self.index is None:
+                return
+            # A temporary file of its own, other processes may be saving the same index
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            try:
+                self.faiss.write_index(self.index, tmp_path)
+                os.replace(tmp_path, self.index_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self._unsaved = 0
+
+    def close(self):
+        self.save()
+        self._conn.close()
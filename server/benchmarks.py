@@ -0,0 +1,1521 @@
+"""
+Benchmarks for the server hot paths.
+
+Run from the server directory:
+    python3 benchmarks.py <benchmark> [args...]
+
+Benchmarks that talk to a running server expect it to be started with INFERENCE_BACKEND=fake
+so the numbers measure our own overhead rather than the Gemini round-trip.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import statistics
+
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__[len("bench_"):]] = fn
+    return fn
+
+
+def summarize(label, timings):
+    """Print mean/p50/p95 of a list of durations in seconds"""
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(
+        f"{label:<32} n={len(timings):<6} "
+        f"mean={statistics.mean(timings) * 1000:8.2f}ms "
+        f"p50={statistics.median(timings) * 1000:8.2f}ms "
+        f"p95={p95 * 1000:8.2f}ms"
+    )
+    return statistics.mean(timings)
+
+
+@benchmark
+def bench_inference_path(image_path, n="50", server="http://localhost:8000"):
+    """
+    Compare the in-process inference call with the old HTTP loopback through /analyze/all.
+
+    Start the server with INFERENCE_BACKEND=fake before running this benchmark.
+    """
+    import aiohttp
+    import inference_service
+
+    n = int(n)
+    inference_service.set_backend(inference_service.FakeBackend())
+    prompt = "Describe this scene."
+
+    async def in_process():
+        timings = []
+        for _ in range(n):
+            start = time.perf_counter()
+            await inference_service.generate_from_file(prompt, image_path, use_cache=False)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    async def loopback():
+        import aiofiles
+
+        timings = []
+        for _ in range(n):
+            start = time.perf_counter()
+            async with aiofiles.open(image_path, 'rb') as f:
+                file_data = await f.read()
+            form_data = aiohttp.FormData()
+            form_data.add_field('image', file_data, filename=os.path.basename(image_path), content_type='image/jpeg')
+            form_data.add_field('text', json.dumps({"text": prompt}), content_type='application/json')
+            form_data.add_field('no_cache', 'true')
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{server}/analyze/all", data=form_data) as response:
+                    await response.text()
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    direct = summarize("in-process", asyncio.run(in_process()))
+    http = summarize("http loopback /analyze/all", asyncio.run(loopback()))
+    print(f"saved per request: {(http - direct) * 1000:.2f}ms")
+
+
+@benchmark
+def bench_concurrent_load(n="20", server="http://localhost:8000"):
+    """
+    Fire n concurrent /analyze/text requests while polling /files.
+
+    Start the server with INFERENCE_BACKEND=fake FAKE_INFERENCE_LATENCY=1. If model calls
+    run concurrently the wall time stays close to one latency instead of n of them, and
+    /files keeps answering in milliseconds while the model calls are in flight.
+    """
+    import aiohttp
+
+    n = int(n)
+
+    async def analyze(session, i):
+        start = time.perf_counter()
+        async with session.post(f"{server}/analyze/text", json={"text": f"request {i}"}) as response:
+            await response.text()
+        return time.perf_counter() - start
+
+    async def poll_files(session, stop):
+        timings = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            async with session.get(f"{server}/files") as response:
+                await response.text()
+            timings.append(time.perf_counter() - start)
+            await asyncio.sleep(0.05)
+        return timings
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            stop = asyncio.Event()
+            poller = asyncio.create_task(poll_files(session, stop))
+            start = time.perf_counter()
+            timings = await asyncio.gather(*(analyze(session, i) for i in range(n)))
+            wall = time.perf_counter() - start
+            stop.set()
+            return timings, wall, await poller
+
+    timings, wall, file_timings = asyncio.run(run())
+    summarize("/analyze/text", timings)
+    summarize("/files during load", file_timings)
+    print(f"wall time for {n} concurrent requests: {wall:.2f}s")
+
+
+@benchmark
+def bench_token_growth(n="200"):
+    """
+    Send n requests through the fake backend and compare the token cost of the first and
+    the most recent calls. Stateless calls stay flat; a session is capped at a few turns.
+    """
+    import inference_service
+
+    n = int(n)
+    inference_service.set_backend(inference_service.FakeBackend())
+
+    async def run(session_id):
+        inference_service.metrics = inference_service.InferenceMetrics()
+        for i in range(n):
+            await inference_service.generate(f"Describe scene {i}.", session_id=session_id, use_cache=False)
+        return inference_service.metrics.snapshot()
+
+    for label, session_id in [("stateless", None), ("session", "bench")]:
+        snapshot = asyncio.run(run(session_id))
+        print(
+            f"{label:<10} first avg input tokens={snapshot['first_requests']['avg_input_tokens']:8.1f} "
+            f"recent avg input tokens={snapshot['recent_requests']['avg_input_tokens']:8.1f}"
+        )
+
+
+@benchmark
+def bench_ingestion_throughput(n="60", latency="0.5", error_rate="0.1", rpm="600"):
+    """
+    Run the ingestion scheduler over n fake images with 1, 4 and 16 workers. The fake
+    analysis takes `latency` seconds and answers 429 for `error_rate` of the calls.
+
+    For an end-to-end run, start the server with INFERENCE_BACKEND=fake and run
+    ingestion_pipeline.py against a folder of test images instead.
+    """
+    import random
+    from ingestion_scheduler import IngestionScheduler, RateLimiter, RetryableError
+
+    n, latency, error_rate, rpm = int(n), float(latency), float(error_rate), float(rpm)
+    random.seed(0)
+
+    async def fake_analysis(item):
+        await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            raise RetryableError("429: quota exceeded", 429)
+        return item
+
+    for workers in [1, 4, 16]:
+        scheduler = IngestionScheduler(
+            fake_analysis, workers=workers, rate_limiter=RateLimiter(rpm=rpm),
+            base_delay=0.1, max_delay=1.0
+        )
+        results, dead_letters = asyncio.run(scheduler.run(range(n)))
+        print(
+            f"workers={workers:<3} done={len(results):<5} dead={len(dead_letters):<3} "
+            f"retries={scheduler.retries:<4} throughput={scheduler.throughput():8.1f} images/min"
+        )
+
+
+@benchmark
+def bench_batched_ingestion(image_dir, n="64", batch_size="32"):
+    """
+    Compare per-image and batched embedding + writes on CPU, using images from image_dir
+    and a throwaway in-memory collection.
+    """
+    import chromadb
+    import vector_db
+
+    n, batch_size = int(n), int(batch_size)
+    paths = sorted(
+        os.path.join(image_dir, f) for f in os.listdir(image_dir)
+        if f.lower().endswith(('.jpg', '.jpeg'))
+    )[:n]
+    collection = chromadb.EphemeralClient().get_or_create_collection("bench_ingestion")
+
+    def write(batch, embeddings):
+        collection.upsert(
+            ids=[os.path.basename(p) for p in batch],
+            uris=batch,
+            embeddings=embeddings,
+            metadatas=[{"image_name": os.path.basename(p)} for p in batch]
+        )
+
+    start = time.perf_counter()
+    for path in paths:
+        write([path], vector_db.embed_images([path]))
+    per_image = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, len(paths), batch_size):
+        batch = paths[i:i + batch_size]
+        write(batch, vector_db.embed_images(batch))
+    batched = time.perf_counter() - start
+
+    print(f"per-image: {len(paths) / per_image:8.2f} images/s")
+    print(f"batched:   {len(paths) / batched:8.2f} images/s (batch_size={batch_size})")
+
+
+@benchmark
+def bench_import_time(module="main", runs="5"):
+    """
+    Measure the wall time of a cold `import <module>` in a fresh interpreter.
+    Models are loaded lazily, so this should not include any model load.
+    """
+    import subprocess
+
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    env = dict(os.environ, INFERENCE_BACKEND=os.getenv("INFERENCE_BACKEND", "fake"))
+    timings = []
+    for _ in range(int(runs)):
+        output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    summarize(f"import {module}", timings)
+
+
+def synthetic_feedback(n, seed=0):
+    """Generate n feedback metadata entries with 2 relationships each"""
+    import random
+
+    rng = random.Random(seed)
+    subjects = [f"object {i}" for i in range(400)] + ["coffee mug", "cup", "book", "laptop", "plate"]
+    spatial = ["on top of", "in", "on", "under", "next to", "near", "behind", "on the edge of"]
+    states = ["stable", "unstable", "resting", "tilted", "open", "closed"]
+    functional = ["supports", "holds", "covers", "contains", "decorates"]
+    contextual = ["typical", "atypical"]
+
+    def relationship():
+        return {
+            "subject": rng.choice(subjects), "object": rng.choice(subjects),
+            "spatial": rng.choice(spatial), "state": rng.choice(states),
+            "functional": rng.choice(functional), "contextual": rng.choice(contextual),
+            "confidence": 0.9
+        }
+
+    for i in range(n):
+        yield f"feedback_{i}", {
+            "image_id": f"id{rng.randrange(n // 3 + 1)}",
+            "rating": rng.choice([0.4, 0.6, 0.8, 1.0]),
+            "atypical_relationships": json.dumps([relationship()]),
+            "typical_relationships": json.dumps([relationship()]),
+        }
+
+
+def scan_feedback(entries, relationship_keys, exclude_feedback_id=None, limit=3):
+    """The original full scan over every feedback entry, used as the baseline"""
+    from feedback_index import parse_relationship_fields, relationship_matches_key
+
+    results, seen_image_ids = [], set()
+    keys = [key.split("-") for key in relationship_keys]
+    for feedback_id, metadata in entries:
+        if metadata["rating"] < 0.5 or feedback_id == exclude_feedback_id or metadata["image_id"] in seen_image_ids:
+            continue
+        if any(relationship_matches_key(rel, key)
+               for _, rels in parse_relationship_fields(metadata) for key in keys for rel in rels):
+            seen_image_ids.add(metadata["image_id"])
+            results.append(feedback_id)
+    return results[:limit]
+
+
+@benchmark
+def bench_feedback_index(sizes="10000,100000,1000000", queries="20"):
+    """
+    Query latency of the relationship inverted index against the original full scan,
+    on synthetic feedback corpora. Also checks that both return the same ids.
+    """
+    import random
+    from feedback_index import FeedbackIndex
+
+    rng = random.Random(1)
+    for size in [int(size) for size in sizes.split(",")]:
+        entries = list(synthetic_feedback(size))
+        index = FeedbackIndex(":memory:")
+        start = time.perf_counter()
+        index.add_many(entries)
+        build = time.perf_counter() - start
+
+        keys = []
+        for _ in range(int(queries)):
+            rel = json.loads(rng.choice(entries)[1]["atypical_relationships"])[0]
+            keys.append([f"{rel['subject']}-{rel['spatial']}-{rel['state']}-{rel['functional']}-{rel['contextual']}-{rel['object']}"])
+
+        index_timings, scan_timings = [], []
+        for key in keys:
+            start = time.perf_counter()
+            found = index.query(key)
+            index_timings.append(time.perf_counter() - start)
+            if size <= 100000:
+                start = time.perf_counter()
+                expected = scan_feedback(entries, key)
+                scan_timings.append(time.perf_counter() - start)
+                assert found == expected, (key, found, expected)
+
+        print(f"--- {size} feedback entries (index built in {build:.1f}s)")
+        summarize("inverted index", index_timings)
+        if scan_timings:
+            summarize("full scan", scan_timings)
+        index.close()
+
+
+def classify_relationships_loop(image_id, current_relationships, similar_relationships_array):
+    """The original pure-Python extract_relationships, timed against the vectorized one"""
+    from context_integration import is_similar_relationship
+
+    typical_relationships = []
+    atypical_relationships = []
+    for id, similar_relationships, _ in similar_relationships_array:
+        if id == image_id or len(similar_relationships) == 0:
+            continue
+        for current_rel in current_relationships:
+            if current_rel['confidence'] >= 0.8:
+                match_count = 0
+                current_objects = {current_rel["object"], current_rel["subject"]}
+                for rel in similar_relationships:
+                    if current_objects.intersection({rel["object"], rel["subject"]}) or is_similar_relationship(current_rel, rel):
+                        match_count += 1
+                if match_count / len(similar_relationships) >= 0.1:
+                    typical_relationships.append(current_rel)
+                else:
+                    atypical_relationships.append(current_rel)
+    return typical_relationships, atypical_relationships
+
+
+def synthetic_scene(rng, n_relationships, labels=30):
+    """Random relationships drawn from small vocabularies so that matches actually happen"""
+    from relationship_store import parse_relationships
+
+    return parse_relationships([
+        {
+            "subject": f"object {rng.randrange(labels)}", "object": f"object {rng.randrange(labels)}",
+            "spatial": rng.choice(["on", "in", "under", "next to", "near"]),
+            "functional": rng.choice(["supports", "holds", "covers"]),
+            "state": rng.choice(["stable", "unstable", "resting", "tilted"]),
+            "contextual": rng.choice(["typical", "atypical"]),
+            "confidence": rng.choice([0.5, 0.8, 0.9, 0.95])
+        }
+        for _ in range(n_relationships)
+    ])
+
+
+@benchmark
+def bench_relationship_classification(neighbours="6,50,200,500", repeats="20"):
+    """
+    Micro-benchmark of the vectorized extract_relationships against the original loops,
+    for growing numbers of neighbours. Their equivalence is checked by
+    tests/test_relationship_classification.py.
+    """
+    import random
+    from context_integration import extract_relationships
+
+    rng = random.Random(0)
+
+    for n in [int(n) for n in neighbours.split(",")]:
+        current = synthetic_scene(rng, 15)
+        similar = [(f"id{i}", synthetic_scene(rng, 12), "") for i in range(n)]
+        for label, fn in [("loop", classify_relationships_loop), ("vectorized", extract_relationships)]:
+            timings = []
+            for _ in range(int(repeats)):
+                start = time.perf_counter()
+                fn("query", current, similar)
+                timings.append(time.perf_counter() - start)
+            summarize(f"{label} ({n} neighbours)", timings)
+
+
+@benchmark
+def bench_relationship_stats(images="100000", lookups="2000"):
+    """
+    Ingestion cost and lookup latency of the relationship statistics in exact and sketch
+    mode. Exact counts are checked against a brute-force count, sketch estimates are
+    reported as their error over the exact ones.
+    """
+    import random
+    from collections import Counter
+    from relationship_stats import RelationshipStats, triple_key
+
+    rng = random.Random(2)
+    places = ["desk", "kitchen", "office", "bedroom", "garden", "street", "classroom", "bathroom"]
+    corpus = []
+    for i in range(int(images)):
+        place = rng.choice(places)
+        corpus.append((f"id{i}", f"A {place} with some clutter", synthetic_scene(rng, rng.randrange(1, 10), labels=200)))
+
+    expected = Counter(key for _, _, rels in corpus for key in {triple_key(rel) for rel in rels})
+    probes = [rel for _, _, rels in rng.sample(corpus, int(lookups)) for rel in rels[:1]]
+
+    exact = None
+    for mode in ["exact", "sketch"]:
+        stats = RelationshipStats(":memory:", mode=mode)
+        start = time.perf_counter()
+        for i in range(0, len(corpus), 1000):
+            stats.add_images(corpus[i:i + 1000])
+        build = time.perf_counter() - start
+        assert stats.add_images(corpus[:10]) == 0, "images must only be counted once"
+
+        timings, errors = [], []
+        for rel in probes:
+            start = time.perf_counter()
+            stat = stats.relationship_frequency(rel, "A desk with some clutter")
+            timings.append(time.perf_counter() - start)
+            errors.append(stat["images"] - expected[triple_key(rel)])
+            if exact is not None:
+                assert exact[triple_key(rel)] <= stat["images"], "sketch must never under-count"
+
+        print(f"--- {mode}: {len(corpus)} images counted in {build:.1f}s "
+              f"({len(corpus) / build:.0f} images/s)")
+        summarize(f"{mode} frequency lookup", timings)
+        if mode == "exact":
+            assert not any(errors), "exact counts differ from the brute-force count"
+            exact = expected
+            print("exact counts match the brute-force count")
+        else:
+            print(f"sketch over-count: mean={statistics.mean(errors):.2f} max={max(errors)} images")
+        stats.close()
+
+
+@benchmark
+def bench_analysis_cache(images="2000", lookups="5000"):
+    """
+    Lookup latency of the analysis cache from memory and from the disk tier, and checks
+    that ingesting an image only invalidates the analyses whose radius it falls into.
+    """
+    import random
+    import tempfile
+    from analysis_cache import AnalysisCache
+
+    rng = random.Random(3)
+    n = int(images)
+    analyses = {
+        f"id{i}": {
+            "objects": {f"object {j}": ["red"] for j in range(8)},
+            "typical_relationships": [rel.to_dict() for rel in synthetic_scene(rng, 6)],
+            "atypical_relationships": [rel.to_dict() for rel in synthetic_scene(rng, 3)],
+            "scene_type": "A desk with some clutter",
+        }
+        for i in range(n)
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "analysis_cache.db")
+        cache = AnalysisCache(path, max_entries=n)
+        for image_id, analysis in analyses.items():
+            cache.put(image_id, cache.version(image_id), analysis, radius=0.5)
+
+        probes = [f"id{rng.randrange(n)}" for _ in range(int(lookups))]
+        for label, cache in [("memory", cache), ("disk", AnalysisCache(path, max_entries=1))]:
+            timings = []
+            for image_id in probes:
+                start = time.perf_counter()
+                assert cache.get(image_id) == analyses[image_id]
+                timings.append(time.perf_counter() - start)
+            summarize(f"{label} hit", timings)
+
+        assert cache.invalidate_near([("id0", 0.2), ("id1", 0.9), ("unknown", 0.1)]) == 1
+        assert cache.get("id0") is None and cache.get("id1") is not None
+        print("ingestion only invalidates the analyses within their radius")
+        print(cache.snapshot())
+
+
+@benchmark
+def bench_response_cache(n="50", latency="0.5", max_kb="16"):
+    """
+    Latency of repeated identical requests with and without the response cache, using the
+    fake backend with a simulated round-trip, and a check of size-based eviction.
+    """
+    import tempfile
+    import inference_service
+    from response_cache import ResponseCache
+
+    n = int(n)
+    inference_service.set_backend(inference_service.FakeBackend(latency=float(latency)))
+    image_bytes = os.urandom(200 * 1024)
+
+    with tempfile.TemporaryDirectory() as directory:
+        inference_service._response_cache = ResponseCache(os.path.join(directory, "response_cache.db"))
+
+        async def run(use_cache):
+            timings = []
+            for _ in range(n):
+                start = time.perf_counter()
+                await inference_service.generate("Describe this scene.", image_bytes, use_cache=use_cache)
+                timings.append(time.perf_counter() - start)
+            return timings
+
+        summarize("bypassed", asyncio.run(run(False)))
+        summarize("cached (first call is a miss)", asyncio.run(run(True)))
+        print(inference_service.get_response_cache().snapshot())
+
+        cache = ResponseCache(os.path.join(directory, "eviction.db"), max_bytes=int(max_kb) * 1024)
+        for i in range(1000):
+            cache.put(f"key{i}", "x" * 200)
+        assert cache.size <= cache.max_bytes and cache.get("key999") is not None and cache.get("key0") is None
+        print(f"eviction keeps the cache under {max_kb}KB: {cache.snapshot()}")
+
+
+@benchmark
+def bench_single_flight(n="20", latency="0.5"):
+    """
+    Wall time of n concurrent ingestions of the same new file through ingest_single_image,
+    with the fake model and a fake DB write, in a temporary directory. That they share one
+    model call and one write is checked by tests/test_single_flight.py.
+    """
+    import tempfile
+    from PIL import Image
+    import ingestion_pipeline
+    import inference_service
+    import image_mapping_store
+    import content_index
+    from prompts import IMAGE_ANALYSIS_PROMPT
+
+    n = int(n)
+    inference_service.set_backend(inference_service.FakeBackend(latency=float(latency)))
+    calls = {"model": 0, "write": 0}
+
+    async def analyze(session, image_path):
+        calls["model"] += 1
+        with open(image_path, 'rb') as f:
+            text = await inference_service.generate(IMAGE_ANALYSIS_PROMPT, f.read(), use_cache=False)
+        objects, relationships, scene_description = ingestion_pipeline.parse_analysis_result(text)
+        return {
+            'image_path': image_path,
+            'objects': json.dumps(objects),
+            'relationships': json.dumps(relationships),
+            'scene_description': scene_description
+        }
+
+    def write(*args):
+        calls["write"] += 1
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        ingestion_pipeline.process_single_image = analyze
+        ingestion_pipeline.add_image_to_db = write
+        ingestion_pipeline._journal = None
+        try:
+            os.makedirs(ingestion_pipeline.IMAGE_FOLDER)
+            # Ingestion hashes the decoded image, so the file must be a real JPEG
+            Image.new("RGB", (64, 48), (120, 80, 40)).save(os.path.join(ingestion_pipeline.IMAGE_FOLDER, "new.jpg"))
+
+            async def run():
+                start = time.perf_counter()
+                ids = await asyncio.gather(*(ingestion_pipeline.ingest_single_image("new.jpg") for _ in range(n)))
+                return ids, time.perf_counter() - start
+
+            ids, wall = asyncio.run(run())
+            ingestion_pipeline.get_journal().close()
+            image_mapping_store.get_mapping_store().close()
+            content_index.get_content_index().close()
+        finally:
+            ingestion_pipeline._journal = None
+            image_mapping_store._store = None
+            content_index._index = None
+            os.chdir(cwd)
+
+    print(f"{n} concurrent ingestions of one file in {wall:.2f}s: {calls}, ids={set(ids)}")
+    print(ingestion_pipeline.ingestion_flight.snapshot())
+
+
+@benchmark
+def bench_image_mapping(n="5000", readers="4"):
+    """
+    Cost of recording n ingested images in the mapping store against rewriting the whole
+    JSON mapping after each image, lookup latency both ways, and a check that readers in
+    other threads see consistent pairs while a writer inserts.
+    """
+    import random
+    import tempfile
+    import threading
+    from image_mapping_store import ImageMappingStore
+
+    n = int(n)
+    with tempfile.TemporaryDirectory() as directory:
+        mapping, json_path = {}, os.path.join(directory, "image_mapping.json")
+        start = time.perf_counter()
+        for i in range(min(n, 2000)):
+            mapping[f"image_{i}.jpg"] = f"id{i}"
+            with open(json_path, 'w') as f:
+                json.dump(mapping, f, indent=4)
+        print(f"json rewrite per image: {(time.perf_counter() - start) / len(mapping) * 1000:.3f}ms/image "
+              f"(first {len(mapping)} images)")
+
+        store = ImageMappingStore(os.path.join(directory, "image_mapping.db"), legacy_path=json_path)
+        assert len(store) == len(mapping) and store.get_name("id7") == "image_7.jpg"
+        print(f"imported {len(store)} images from the json mapping")
+
+        stop, errors = threading.Event(), []
+
+        def read():
+            reader = ImageMappingStore(os.path.join(directory, "image_mapping.db"), legacy_path=None)
+            rng = random.Random()
+            while not stop.is_set():
+                i = rng.randrange(n)
+                image_id = reader.get_id(f"image_{i}.jpg")
+                if image_id not in (None, f"id{i}") or (image_id and reader.get_name(image_id) != f"image_{i}.jpg"):
+                    errors.append(i)
+            reader.close()
+
+        threads = [threading.Thread(target=read) for _ in range(int(readers))]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        for i in range(len(mapping), n):
+            store.add(f"image_{i}.jpg", f"id{i}")
+        insert = (time.perf_counter() - start) / max(1, n - len(mapping))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors[:10]
+        print(f"store insert per image: {insert * 1000:.3f}ms/image with {readers} concurrent readers, no inconsistent reads")
+
+        rng = random.Random(0)
+        for label, lookup in [("name -> id", lambda i: store.get_id(f"image_{i}.jpg")),
+                              ("id -> name", lambda i: store.get_name(f"id{i}"))]:
+            timings = []
+            for _ in range(5000):
+                i = rng.randrange(n)
+                start = time.perf_counter()
+                lookup(i)
+                timings.append(time.perf_counter() - start)
+            summarize(label, timings)
+        store.close()
+
+
+@benchmark
+def bench_batch_analysis(n="32", sizes="1,4,8", latency="0.5"):
+    """
+    Model calls, prompt tokens per image and wall time to analyze n images with batches of
+    each size, using the fake backend. Checks that batch results match single-image
+    results, and that an image missing from a batch answer falls back to a single call.
+    """
+    import inference_service
+    from prompts import IMAGE_ANALYSIS_PROMPT
+
+    n = int(n)
+    images = [os.urandom(2048) for _ in range(n)]
+    backend = inference_service.FakeBackend(latency=float(latency))
+    inference_service.set_backend(backend)
+
+    async def analyze(size):
+        start = time.perf_counter()
+        batches = [images[i:i + size] for i in range(0, n, size)]
+        results = await asyncio.gather(*(
+            inference_service.analyze_images(batch, endpoint="bench", use_cache=False) for batch in batches
+        ))
+        return [analysis for batch in results for analysis in batch], time.perf_counter() - start
+
+    expected = None
+    for size in [int(size) for size in sizes.split(",")]:
+        inference_service.metrics = inference_service.InferenceMetrics()
+        analyses, wall = asyncio.run(analyze(size))
+        snapshot = inference_service.metrics.snapshot()
+        if expected is None:
+            expected = analyses
+        assert [json.loads(a) for a in analyses] == [json.loads(a) for a in expected], size
+        print(
+            f"batch={size:<3} model calls={snapshot['requests']:<4} "
+            f"input tokens/image={snapshot['input_tokens'] / n:8.1f} wall={wall:.2f}s"
+        )
+    print("batch analyses match the single-image analyses")
+
+    class DroppingBackend(inference_service.FakeBackend):
+        """Drops the last entry of every batch answer"""
+        async def generate(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None, response_schema=None):
+            generation = await super().generate(prompt, image_bytes, mime_type, history, response_schema)
+            if prompt != IMAGE_ANALYSIS_PROMPT:
+                generation.text = json.dumps(json.loads(generation.text)[:-1])
+            return generation
+
+    inference_service.set_backend(DroppingBackend())
+    inference_service.metrics = inference_service.InferenceMetrics()
+    analyses = asyncio.run(inference_service.analyze_images(images[:4], endpoint="bench", use_cache=False))
+    assert [json.loads(a) for a in analyses] == [json.loads(a) for a in expected[:4]]
+    print(f"fallback: {inference_service.metrics.snapshot()['batch_analysis']}")
+
+
+def legacy_parse_analysis(response_str):
+    """The regex cleaning + json.loads parse used before the analysis schema, as the baseline"""
+    import re
+
+    response_str = re.sub(r'```json\s*', '', response_str)
+    response_str = re.sub(r'\s*```', '', response_str)
+    response_str = response_str.strip('"')
+    response_str = re.sub(r'\\n\s*', '', response_str)
+    response_str = response_str.replace('\\"', '"')
+    response_str = response_str.replace('\\', '')
+    response_str = re.sub(r',(\s*[}\]])', r'\1', response_str)
+    response = json.loads(response_str.strip())
+    objects = {obj["label"]: obj["attributes"] for obj in response["objects"]}
+    if not objects or not response["scene_annotation"]:
+        raise ValueError("empty analysis")
+    return objects, response["relationships"], response["scene_annotation"]
+
+
+def messy_analysis_responses(n):
+    """Model answers to IMAGE_ANALYSIS_PROMPT with the formatting mistakes seen in practice"""
+    import hashlib
+    import inference_service
+
+    def commented(text):
+        return text.replace('"contextual"', '// dimension copied from the prompt\n"contextual"')
+
+    variants = {
+        "clean": lambda text: text,
+        "code fence": lambda text: f"```json\n{text}\n```",
+        "trailing commas": lambda text: text.replace("]", ",]").replace("}", ",}"),
+        "comments": commented,
+        "prose around": lambda text: f"Here is the analysis of the image:\n{text}\nLet me know if you need more.",
+        "double encoded": lambda text: json.dumps(text),
+        "truncated": lambda text: text[:int(len(text) * 0.8)],
+        "refusal": lambda text: "I am unable to analyze objects and their relationships as there is no coffee mug or desk in the image.",
+    }
+    responses = []
+    for i in range(n):
+        analysis = inference_service.fake_analysis(hashlib.sha256(str(i).encode()).hexdigest())
+        analysis["relationships"] *= 4
+        text = json.dumps(analysis, indent=2)
+        name = list(variants)[i % len(variants)]
+        responses.append((name, variants[name](text)))
+    return responses
+
+
+@benchmark
+def bench_analysis_parsing(n="800"):
+    """
+    Parse-failure rate and parse time of the legacy regex cleaning against the schema
+    parser (strict, then tolerant) on messy model answers, sent through the HTTP JSON
+    encoding the ingestion pipeline receives. Then counts the model calls of
+    generate_analysis with a fake model giving those answers: unparseable answers get one
+    text-only repair call instead of a new image analysis.
+    """
+    from collections import Counter
+    import inference_service
+    from analysis_schema import parse_analysis, AnalysisParseError
+    from prompts import IMAGE_ANALYSIS_PROMPT
+
+    responses = messy_analysis_responses(int(n))
+    for label, parse in [("legacy regex", legacy_parse_analysis), ("schema parser", parse_analysis)]:
+        failures, timings = Counter(), []
+        for name, text in responses:
+            start = time.perf_counter()
+            try:
+                parse(json.dumps(text))
+            except Exception:
+                failures[name] += 1
+            timings.append(time.perf_counter() - start)
+        summarize(f"{label} parse", timings)
+        print(f"  failure rate {sum(failures.values()) / len(responses):.1%}: {dict(failures)}")
+
+    class MessyBackend(inference_service.FakeBackend):
+        """Answers image analyses with the messy responses, and repairs like a model would"""
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+
+        async def generate(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None, response_schema=None):
+            if prompt == IMAGE_ANALYSIS_PROMPT:
+                self.calls["image analysis"] += 1
+                return inference_service.Generation(responses[int(image_bytes)][1])
+            self.calls["repair"] += 1
+            broken = prompt.split("Text:", 1)[1]
+            try:
+                return inference_service.Generation(parse_analysis(broken)[0].model_dump_json())
+            except AnalysisParseError:
+                return inference_service.Generation(broken)
+
+    backend = MessyBackend()
+    inference_service.set_backend(backend)
+    inference_service.metrics = inference_service.InferenceMetrics()
+
+    async def run():
+        for i in range(len(responses)):
+            try:
+                await inference_service.generate_analysis(str(i).encode(), use_cache=False)
+            except AnalysisParseError:
+                pass
+
+    asyncio.run(run())
+    print(f"model calls: {dict(backend.calls)}")
+    print(f"parsing: {inference_service.metrics.snapshot()['analysis_parsing']}")
+
+
+@benchmark
+def bench_streaming(n="20", latency="0.5", chunk_latency="0.02", filename="", server="http://localhost:8000"):
+    """
+    Time to first byte of streamed inference against waiting for the whole answer, with
+    a fake model taking `latency` seconds before its first chunk and `chunk_latency` per
+    chunk after that.
+
+    In-process, generate_stream is compared with generate. With a filename, the same is
+    measured over HTTP for /inference/basic against /inference/basic/stream (first byte
+    and first token event); start the server with INFERENCE_BACKEND=fake and the same
+    FAKE_INFERENCE_LATENCY and FAKE_CHUNK_LATENCY.
+    """
+    import inference_service
+
+    n = int(n)
+    inference_service.set_backend(
+        inference_service.FakeBackend(latency=float(latency), chunk_latency=float(chunk_latency))
+    )
+    prompt = "Describe what happened before and after this scene."
+    image = os.urandom(1024)
+
+    async def whole():
+        timings = []
+        for _ in range(n):
+            start = time.perf_counter()
+            await inference_service.generate(prompt, image, use_cache=False)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    async def streamed():
+        first, total, texts = [], [], []
+        for _ in range(n):
+            start = time.perf_counter()
+            chunks = []
+            async for chunk in inference_service.generate_stream(prompt, image, use_cache=False):
+                if not chunks:
+                    first.append(time.perf_counter() - start)
+                chunks.append(chunk)
+            total.append(time.perf_counter() - start)
+            texts.append("".join(chunks))
+        return first, total, texts
+
+    summarize("generate (whole answer)", asyncio.run(whole()))
+    first, total, texts = asyncio.run(streamed())
+    summarize("generate_stream first chunk", first)
+    summarize("generate_stream complete", total)
+    expected = asyncio.run(inference_service.generate(prompt, image, use_cache=False))
+    assert all(text == expected for text in texts), "streamed text differs from the whole answer"
+    print("streamed text matches the whole answer")
+    print(inference_service.metrics.snapshot()["streaming"])
+
+    if not filename:
+        return
+
+    import aiohttp
+
+    async def over_http():
+        timings = {"json first byte": [], "stream first byte": [], "stream first token": [], "stream complete": []}
+        async with aiohttp.ClientSession() as session:
+            for _ in range(n):
+                start = time.perf_counter()
+                async with session.post(f"{server}/inference/basic", json={"filename": filename}) as response:
+                    await response.content.read(1)
+                    timings["json first byte"].append(time.perf_counter() - start)
+                    await response.read()
+
+                start = time.perf_counter()
+                first_byte = first_token = None
+                async with session.post(f"{server}/inference/basic/stream", json={"filename": filename}) as response:
+                    async for line in response.content:
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - start
+                        if first_token is None and line.startswith(b"event: token"):
+                            first_token = time.perf_counter() - start
+                timings["stream first byte"].append(first_byte)
+                timings["stream first token"].append(first_token)
+                timings["stream complete"].append(time.perf_counter() - start)
+        return timings
+
+    for label, values in asyncio.run(over_http()).items():
+        summarize(label, values)
+
+
+@benchmark
+def bench_enhanced_retrieval(n="50", latency="0.005", feedback="200"):
+    """
+    Latency of the enhanced-inference retrieval stages, run one after the other with one
+    image lookup per pattern (as before) against the concurrent pipeline with a single
+    batched image-name lookup. Every collection call of the fake collections takes
+    `latency` seconds, like a round-trip to Chroma.
+    """
+    import model_registry
+    import reasoning_loop
+    from relationship_store import RelationshipStore
+
+    n, latency, feedback = int(n), float(latency), int(feedback)
+    calls = {"collection": 0}
+    relationships = [
+        {"subject": "mug", "spatial": "on", "object": f"desk {i % 10}", "state": "stable",
+         "functional": "supports", "contextual": "typical" if i % 3 else "atypical", "confidence": 0.9}
+        for i in range(feedback)
+    ]
+    feedback_metadata = {
+        f"feedback_{i}": {
+            "image_id": f"image_{i}",
+            "inference": f"Someone left the mug on desk {i} after a meeting.",
+            "rating": 0.9,
+            "scene_type": "office",
+            "typical_relationships": json.dumps([r for r in relationships[i:i + 3] if r["contextual"] == "typical"]),
+            "atypical_relationships": json.dumps([r for r in relationships[i:i + 3] if r["contextual"] == "atypical"]),
+        }
+        for i in range(feedback)
+    }
+
+    class FakeCollection:
+        def __init__(self, metadatas):
+            self.metadatas = metadatas
+
+        def get(self, ids=None, include=None):
+            calls["collection"] += 1
+            time.sleep(latency)
+            ids = [i for i in ids if i in self.metadatas]
+            return {"ids": ids, "metadatas": [self.metadatas[i] for i in ids]}
+
+        def query(self, query_texts=None, n_results=3, where=None):
+            calls["collection"] += 1
+            time.sleep(latency)
+            ids = list(self.metadatas)[-n_results:]
+            return {"ids": [ids], "metadatas": [[self.metadatas[i] for i in ids]]}
+
+    class FakeIndex:
+        def query(self, keys, exclude_feedback_id=None, limit=3):
+            return [f"feedback_{i}" for i in range(0, feedback, 7)][:limit]
+
+    instances = {
+        "image_collection": FakeCollection({f"image_{i}": {"image_name": f"{i}.jpg"} for i in range(feedback)}),
+        "feedback_collection": FakeCollection(feedback_metadata),
+        "feedback_index": FakeIndex(),
+        "relationship_store": RelationshipStore(),
+    }
+    scene_context = {
+        "typical_relationships": [relationships[1]],
+        "atypical_relationships": [relationships[0]],
+        "scene_type": "office",
+    }
+
+    def sequential(limit=5):
+        """Retrieval as it ran before: searches in turn, one image lookup per pattern"""
+        from vector_db import get_feedback_by_relationships, get_similar_feedback, get_image_from_db
+
+        def extract(results):
+            names = {}
+            for metadata in results['metadatas'][0]:
+                image = get_image_from_db(metadata["image_id"])
+                names[metadata["image_id"]] = image["metadatas"][0].get("image_name", "")
+            return reasoning_loop.extract_patterns_from_results(results, names)
+
+        keys = reasoning_loop.extract_relationship_keys(scene_context)
+        patterns = extract(get_feedback_by_relationships("current", keys, limit))
+        if len(patterns) < limit:
+            existing = {p["inference"] for p in patterns}
+            for pattern in extract(get_similar_feedback("office", limit - len(patterns))):
+                if pattern["inference"] not in existing:
+                    patterns.append(pattern)
+        return patterns[:limit]
+
+    previous = dict(model_registry._instances)
+    model_registry._instances.update(instances)
+    try:
+        for limit in (3, 5):
+            calls["collection"] = 0
+            timings = []
+            for _ in range(n):
+                start = time.perf_counter()
+                expected = sequential(limit)
+                timings.append(time.perf_counter() - start)
+            summarize(f"sequential (limit={limit})", timings)
+            print(f"  collection calls per request: {calls['collection'] / n:.1f}")
+
+            calls["collection"] = 0
+            timings, stages = [], []
+            for _ in range(n):
+                stage_timings = {}
+                start = time.perf_counter()
+                patterns, _ = asyncio.run(
+                    reasoning_loop.find_relevant_inference_patterns("current", scene_context, limit, stage_timings)
+                )
+                timings.append(time.perf_counter() - start)
+                stages.append(stage_timings)
+            summarize(f"concurrent (limit={limit})", timings)
+            print(f"  collection calls per request: {calls['collection'] / n:.1f}")
+            print("  stages (mean ms):", {
+                stage: round(statistics.mean(s[stage] for s in stages), 2) for stage in stages[0]
+            })
+            assert [(p["image_name"], p["inference"]) for p in patterns] == \
+                [(p["image_name"], p["inference"]) for p in expected], "patterns differ"
+        print("concurrent retrieval returns the same patterns")
+    finally:
+        model_registry._instances.clear()
+        model_registry._instances.update(previous)
+
+
+@benchmark
+def bench_feedback_retrieval(entries="2000", queries="100", limit="3"):
+    """
+    Latency and precision of feedback retrieval by relationship with the substring index
+    against the embedded relationship triples. Queries name the objects with synonyms of
+    the stored ones ("cup" for "mug"), precision is the share of returned entries that
+    hold the queried relationship. Needs chromadb and its default ONNX text encoder;
+    everything is kept in memory or in a temporary directory.
+    """
+    import random
+    import tempfile
+    import chromadb
+    import model_registry
+    import vector_db
+    from feedback_index import FeedbackIndex
+    from relationship_store import RelationshipStore
+
+    entries, queries, limit = int(entries), int(queries), int(limit)
+    synonyms = [
+        ("mug", "cup"), ("sofa", "couch"), ("bicycle", "bike"), ("trash can", "garbage bin"),
+        ("television", "tv"), ("rug", "carpet"), ("cellphone", "mobile phone"), ("notebook", "notepad"),
+        ("kitten", "cat"), ("puppy", "dog"), ("automobile", "car"), ("pillow", "cushion"),
+    ]
+    spatials = ["on", "under", "next to"]
+    rng = random.Random(0)
+
+    def relationship(subject, spatial, obj):
+        return {"subject": subject, "spatial": spatial, "object": obj, "state": "resting",
+                "functional": "none", "contextual": "atypical", "confidence": 0.9}
+
+    stored = {}
+    metadatas = {}
+    for n in range(entries):
+        i, j = rng.sample(range(len(synonyms)), 2)
+        spatial = rng.choice(spatials)
+        stored[f"feedback_{n}"] = (i, spatial, j)
+        metadatas[f"feedback_{n}"] = {
+            "image_id": f"image_{n}",
+            "inference": f"inference {n}",
+            "rating": 0.9,
+            "atypical_relationships": json.dumps([relationship(synonyms[i][0], spatial, synonyms[j][0])]),
+            "typical_relationships": json.dumps([]),
+        }
+
+    cwd = os.getcwd()
+    previous = dict(model_registry._instances)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            client = chromadb.EphemeralClient()
+            model_registry._instances.update({
+                "chroma_client": client,
+                "feedback_index": FeedbackIndex(),
+                "relationship_store": RelationshipStore(),
+            })
+            feedback = client.get_or_create_collection("feedback")
+            model_registry._instances["feedback_collection"] = feedback
+            ids = list(metadatas)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                feedback.upsert(ids=chunk, documents=["" for _ in chunk], metadatas=[metadatas[i] for i in chunk])
+            vector_db.get_feedback_index().add_many(metadatas.items())
+
+            start = time.perf_counter()
+            vector_db.get_relationship_collection()
+            print(f"embedded the relationships of {entries} entries in {time.perf_counter() - start:.2f}s")
+
+            cases = []
+            for _ in range(queries):
+                i, j = rng.sample(range(len(synonyms)), 2)
+                spatial = rng.choice(spatials)
+                key = f"{synonyms[i][1]}-{spatial}-resting-none-atypical-{synonyms[j][1]}"
+                cases.append((key, (i, spatial, j)))
+
+            for mode in ("index", "embedding"):
+                vector_db.FEEDBACK_RETRIEVAL = mode
+                timings, relevant, returned = [], 0, 0
+                for key, expected in cases:
+                    start = time.perf_counter()
+                    results = vector_db.get_feedback_by_relationships("current", [key], limit)
+                    timings.append(time.perf_counter() - start)
+                    returned += len(results["ids"][0])
+                    relevant += sum(stored[i] == expected for i in results["ids"][0])
+                summarize(f"{mode} retrieval", timings)
+                print(f"  returned {returned / queries:.2f} entries per query, "
+                      f"precision {relevant / max(1, returned):.2f}, "
+                      f"relevant per query {relevant / queries:.2f} (of {limit})")
+        finally:
+            vector_db.FEEDBACK_RETRIEVAL = os.getenv("FEEDBACK_RETRIEVAL", "embedding")
+            model_registry._instances.clear()
+            model_registry._instances.update(previous)
+            os.chdir(cwd)
+
+
+@benchmark
+def bench_ann_index(n="50000", queries="200", k="10", dim="512", chroma="1"):
+    """
+    Recall@k against latency of the local ANN index (HNSW over efSearch, IVF-PQ over
+    nprobe) and of Chroma's own index, on n synthetic CLIP-like vectors: unit vectors
+    drawn around a few hundred cluster centres, queried by the id of a stored image like
+    get_n_similar_images does. Exact neighbours come from a brute-force search. Set
+    chroma=0 to skip the Chroma baseline. Runs in a temporary directory.
+    """
+    import tempfile
+    import numpy as np
+    from ann_index import AnnIndex
+
+    n, queries, k, dim = int(n), int(queries), int(k), int(dim)
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(max(8, n // 200), dim)).astype(np.float32)
+    vectors = centres[rng.integers(len(centres), size=n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"image_{i}" for i in range(n)]
+    query_rows = rng.choice(n, size=queries, replace=False)
+
+    truth = []
+    for row in query_rows:
+        distances = ((vectors - vectors[row]) ** 2).sum(1)
+        truth.append({ids[i] for i in np.argpartition(distances, k)[:k]})
+
+    def measure(label, query):
+        timings, recall = [], []
+        for row, expected in zip(query_rows, truth):
+            start = time.perf_counter()
+            found = query(ids[row])
+            timings.append(time.perf_counter() - start)
+            recall.append(len(expected & set(found)) / k)
+        summarize(label, timings)
+        print(f"  recall@{k}: {statistics.mean(recall):.3f}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        if chroma == "1":
+            import chromadb
+
+            collection = chromadb.EphemeralClient().get_or_create_collection("bench_ann")
+            start = time.perf_counter()
+            for offset in range(0, n, 5000):
+                collection.add(ids=ids[offset:offset + 5000], embeddings=vectors[offset:offset + 5000])
+            print(f"chroma: added {n} vectors in {time.perf_counter() - start:.1f}s")
+
+            def chroma_query(image_id):
+                embedding = collection.get(ids=[image_id], include=['embeddings'])['embeddings']
+                return collection.query(query_embeddings=embedding, n_results=k, include=['distances'])['ids'][0]
+
+            measure("chroma get + query", chroma_query)
+
+        settings = {
+            "hnsw": [{"ef_search": ef_search} for ef_search in (16, 32, 64, 128)],
+            "ivfpq": [{"nprobe": nprobe, "refine": refine} for refine in (4, 10, 20) for nprobe in (4, 16, 64)],
+        }
+        for kind, params in settings.items():
+            # About 4 * sqrt(n) inverted lists, the usual starting point for IVF
+            index = AnnIndex(kind, os.path.join(directory, kind), nlist=max(16, int(4 * n ** 0.5)))
+            start = time.perf_counter()
+            for offset in range(0, n, 5000):
+                index.add(ids[offset:offset + 5000], vectors[offset:offset + 5000])
+            index.save()
+            size = sum(os.path.getsize(os.path.join(index.directory, f)) for f in os.listdir(index.directory))
+            print(f"{kind}: added {n} vectors in {time.perf_counter() - start:.1f}s, {size / 2 ** 20:.1f}MB on disk")
+            for param in params:
+                index.set_params(**param)
+                label = " ".join(f"{name}={value}" for name, value in param.items())
+                measure(f"{kind} {label}", lambda image_id: index.query_by_id(image_id, k)[0])
+            index.close()
+
+
+@benchmark
+def bench_content_dedupe(n="40", index_size="100000", queries="200"):
+    """
+    Ingest n synthetic images, a quarter of them uploaded again as byte-identical copies and
+    a quarter as re-encoded, resized copies, with a fake analysis and write, in a throwaway
+    directory. Counts the model calls and embeddings made with and without
+    REUSE_NEAR_DUPLICATE_ANALYSIS, then times a pHash lookup against index_size stored images.
+    """
+    import io
+    import random
+    import shutil
+    import tempfile
+    import numpy as np
+    from PIL import Image
+
+    n, index_size, queries = int(n), int(index_size), int(queries)
+    rng = np.random.default_rng(0)
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    import ingestion_pipeline
+    import content_index
+    import image_mapping_store
+
+    def synthetic_image(seed):
+        """Smooth random shapes, so a resized copy keeps the same low frequencies"""
+        shapes = np.random.default_rng(seed).random((8, 8, 3)) * 255
+        return Image.fromarray(shapes.astype(np.uint8)).resize((320, 240), Image.BICUBIC)
+
+    def write_images(folder):
+        os.makedirs(folder)
+        for i in range(n):
+            synthetic_image(i).save(os.path.join(folder, f"img_{i:04d}.jpg"), quality=90)
+        for i in range(n // 4):
+            shutil.copy(os.path.join(folder, f"img_{i:04d}.jpg"), os.path.join(folder, f"copy_{i:04d}.jpg"))
+        for i in range(n // 4, n // 2):
+            image = synthetic_image(i).resize((288, 216))
+            image.save(os.path.join(folder, f"near_{i:04d}.jpg"), quality=70)
+
+    calls = {"analysis": 0, "embedding": 0}
+
+    async def fake_analysis(session, image_path):
+        calls["analysis"] += 1
+        return {'image_path': ingestion_pipeline.move_to_processed(image_path),
+                'objects': "{}", 'relationships': "[]", 'scene_description': os.path.basename(image_path)}
+
+    def fake_write(*args):
+        calls["embedding"] += 1
+
+    ingestion_pipeline.process_single_image = fake_analysis
+    ingestion_pipeline.add_image_to_db = fake_write
+
+    async def ingest(names):
+        journal = ingestion_pipeline.get_journal()
+        return [await ingestion_pipeline.run_ingestion_steps(None, journal, name) for name in names]
+
+    for reuse in (False, True):
+        run = os.path.join(workdir, f"reuse_{int(reuse)}")
+        os.makedirs(run)
+        os.chdir(run)
+        ingestion_pipeline._journal = None
+        content_index._index = None
+        image_mapping_store._store = None
+        ingestion_pipeline.REUSE_NEAR_DUPLICATE_ANALYSIS = reuse
+        write_images(ingestion_pipeline.IMAGE_FOLDER)
+        os.makedirs(ingestion_pipeline.PROCESSED_FOLDER)
+        calls.update(analysis=0, embedding=0)
+
+        originals = sorted(f for f in os.listdir(ingestion_pipeline.IMAGE_FOLDER) if f.startswith("img_"))
+        uploads = sorted(f for f in os.listdir(ingestion_pipeline.IMAGE_FOLDER) if not f.startswith("img_"))
+        start = time.perf_counter()
+        asyncio.run(ingest(originals))
+        ids = asyncio.run(ingest(uploads))
+        wall = time.perf_counter() - start
+
+        mapping = image_mapping_store.get_mapping_store()
+        copies = [name for name in uploads if name.startswith("copy_")]
+        assert all(mapping.get_id(name) == mapping.get_id("img_" + name[5:]) for name in copies)
+        flagged = content_index.get_content_index().near_duplicates()
+        print(
+            f"reuse_near={str(reuse):<5} images={len(originals) + len(uploads):<4} "
+            f"analyses={calls['analysis']:<4} embeddings={calls['embedding']:<4} "
+            f"linked copies={len(copies):<3} flagged near={len(flagged):<3} "
+            f"({wall * 1000 / len(ids):.1f}ms/upload)"
+        )
+
+    image = io.BytesIO()
+    synthetic_image(0).save(image, format="JPEG")
+    timings = []
+    for _ in range(20):
+        start = time.perf_counter()
+        content_index.perceptual_hash(image.getvalue())
+        content_index.content_hash(image.getvalue())
+        timings.append(time.perf_counter() - start)
+    summarize("hash one 320x240 jpeg", timings)
+
+    index = content_index.ContentIndex(os.path.join(workdir, "lookup.db"))
+    phashes = rng.integers(0, 1 << 63, size=index_size, dtype=np.int64).tolist()
+    index.add_many((f"{i}.jpg", str(i), f"{i:064x}", phash, None, None) for i, phash in enumerate(phashes))
+    probes = [phashes[random.Random(i).randrange(index_size)] ^ 0b101 for i in range(queries)]
+
+    timings = []
+    for probe in probes:
+        start = time.perf_counter()
+        assert index.find_near(probe)[2] == 2
+        timings.append(time.perf_counter() - start)
+    vectorized = summarize(f"find_near ({index_size} images)", timings)
+
+    timings = []
+    for probe in probes[:10]:
+        start = time.perf_counter()
+        min(phashes, key=lambda phash: bin(phash ^ probe).count("1"))
+        timings.append(time.perf_counter() - start)
+    loop = summarize(f"python loop ({index_size} images)", timings)
+    print(f"speedup: {loop / vectorized:.1f}x")
+    index.close()
+    shutil.rmtree(workdir)
+
+
+@benchmark
+def bench_image_preprocessing(n="10", mbps="20", latency="0.5"):
+    """
+    Bytes sent and latency per model call for a 12 MP phone photo and a COCO-sized image,
+    with and without the image preprocessor. The fake backend answers after `latency`
+    seconds and the upload of the base64 payload is simulated at `mbps` Mbit/s. Also times
+    the decode CLIP needs before embedding.
+    """
+    import io
+    import base64
+    import tempfile
+    import numpy as np
+    from PIL import Image
+    import inference_service
+    import image_preprocessing
+    from image_buffer import image_base64
+
+    n, mbps, latency = int(n), float(mbps), float(latency)
+    rng = np.random.default_rng(0)
+    workdir = tempfile.mkdtemp()
+
+    def photo(width, height):
+        """Smooth shapes plus sensor-like noise, with an EXIF orientation tag"""
+        base = Image.fromarray((rng.random((12, 16, 3)) * 255).astype(np.uint8)).resize((width, height), Image.BICUBIC)
+        noisy = np.asarray(base, dtype=np.int16) + rng.integers(-12, 12, size=(height, width, 3))
+        image = Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif[0x010F] = "Benchmark camera"
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=92, exif=exif.tobytes())
+        return output.getvalue()
+
+    images = {"12MP photo": photo(4032, 3024), "640x480": photo(640, 480)}
+    inference_service.set_backend(inference_service.FakeBackend(latency=latency))
+
+    def upload_time(payload):
+        return len(image_base64(payload)) * 8 / (mbps * 1e6)
+
+    async def call(data):
+        start = time.perf_counter()
+        prepared, _ = await asyncio.to_thread(image_preprocessing.prepare_images, data)
+        await asyncio.sleep(upload_time(prepared))
+        await inference_service.generate("Describe this scene.", data, endpoint="bench", use_cache=False)
+        return time.perf_counter() - start, len(prepared)
+
+    for label, data in images.items():
+        for enabled in (False, True):
+            image_preprocessing._preprocessor = (
+                image_preprocessing.ImagePreprocessor(folder=os.path.join(workdir, label)) if enabled else None
+            )
+            image_preprocessing.IMAGE_PREPROCESSING = enabled
+            start = time.perf_counter()
+            first, sent = asyncio.run(call(data))
+            timings = [asyncio.run(call(data))[0] for _ in range(n)]
+            name = f"{label} {'prepared' if enabled else 'raw'}"
+            print(f"{name:<22} sent={sent / 1024:9.1f}KB base64={len(base64.b64encode(b'x' * sent)) / 1024:9.1f}KB first call={first * 1000:8.1f}ms")
+            summarize("  repeat calls", timings)
+
+    preprocessor = image_preprocessing.ImagePreprocessor(folder=os.path.join(workdir, "clip"))
+    image_preprocessing._preprocessor = preprocessor
+    path = os.path.join(workdir, "photo.jpg")
+    with open(path, 'wb') as f:
+        f.write(images["12MP photo"])
+    for label, load in (("decode original", lambda: Image.open(path)),
+                        ("decode prepared", lambda: image_preprocessing.open_prepared_image(path))):
+        timings = []
+        for _ in range(n):
+            start = time.perf_counter()
+            load().convert("RGB")
+            timings.append(time.perf_counter() - start)
+        summarize(f"CLIP input, {label}", timings)
+    print(f"preprocessor: {preprocessor.snapshot()}")
+
+    import shutil
+    shutil.rmtree(workdir)
+
+
+@benchmark
+def bench_image_buffer(n="200", concurrency="32", size_mb="4", mode=""):
+    """
+    Peak RSS and Python allocations of n inference calls on the same image file, with
+    `concurrency` calls in flight, reading the file into bytes and base64-encoding it per
+    call (the previous path) versus sharing one mapped ImageBuffer and its cached base64.
+    Each mode runs in its own process so the peak RSS of one does not hide the other's.
+    The traced peak is the largest amount of Python allocations alive at once.
+    The backend is fake but builds the inline base64 payload like the Gemini backend, and
+    image preprocessing is off so the file is sent as it is.
+    """
+    import subprocess
+
+    if not mode:
+        env = dict(os.environ, IMAGE_PREPROCESSING="0", RESPONSE_CACHE="0")
+        for mode in ("read", "buffer"):
+            output = subprocess.run(
+                [sys.executable, __file__, "image_buffer", n, concurrency, size_mb, mode],
+                env=env, capture_output=True, text=True
+            )
+            print(output.stdout.strip() or output.stderr[-2000:])
+        return
+
+    import tempfile
+    import threading
+    import tracemalloc
+    import inference_service
+    from image_buffer import image_base64
+
+    n, concurrency = int(n), int(concurrency)
+    path = os.path.join(tempfile.mkdtemp(), "image.jpg")
+    with open(path, 'wb') as f:
+        f.write(os.urandom(int(float(size_mb) * 1024 * 1024)))
+
+    class PayloadBackend(inference_service.FakeBackend):
+        """Encodes every image to base64, as GeminiBackend.build_message does"""
+        async def generate(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None, response_schema=None):
+            payload = [image_base64(data) for data in inference_service.as_image_list(image_bytes)]
+            generation = await super().generate(prompt, image_bytes, mime_type, history, response_schema)
+            del payload
+            return generation
+
+    inference_service.set_backend(PayloadBackend(latency=0.05))
+
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def legacy_call():
+        image_bytes = await asyncio.to_thread(read)
+        return await inference_service.generate("Describe this scene.", image_bytes, endpoint="bench", use_cache=False)
+
+    async def buffer_call():
+        return await inference_service.generate_from_file("Describe this scene.", path, endpoint="bench", use_cache=False)
+
+    def rss():
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    peak = {"rss": rss()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.002):
+            peak["rss"] = max(peak["rss"], rss())
+
+    async def run(call):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await call()
+
+        await asyncio.gather(*(one() for _ in range(n)))
+
+    inference_service.configure_endpoint("bench", concurrency=concurrency)
+    call = legacy_call if mode == "read" else buffer_call
+    asyncio.run(run(call))
+    baseline = rss()
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+    asyncio.run(run(call))
+    wall = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    done.set()
+    sampler.join()
+    print(
+        f"{'read + base64 per call' if mode == 'read' else 'mapped ImageBuffer':<24} "
+        f"calls={n} in flight={concurrency} peak RSS +{(peak['rss'] - baseline) / 2**20:7.1f}MB "
+        f"traced peak={traced_peak / 2**20:7.1f}MB wall={wall:.2f}s"
+    )
+    os.remove(path)
+
+
+# Libraries that must only load on the code paths that use them
+HEAVY_MODULES = ["spacy", "plotly", "sklearn", "transformers", "open_clip", "torch", "matplotlib", "pandas"]
+
+
+@benchmark
+def bench_cold_start(budget_ms="1500", module="main"):
+    """
+    Regression check for the API server cold start using `python -X importtime`.
+
+    Fails (exit code 1) when importing the module takes longer than budget_ms or pulls in
+    any of HEAVY_MODULES. Prints the slowest top-level imports to show where time goes.
+    """
+    import subprocess
+
+    env = dict(os.environ, INFERENCE_BACKEND=os.getenv("INFERENCE_BACKEND", "fake"))
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True
+    )
+    if output.returncode != 0:
+        print(output.stderr[-2000:])
+        sys.exit(1)
+
+    imports = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((name.rstrip(), int(cumulative)))
+
+    total_ms = next(us for name, us in imports if name.strip() == module) / 1000
+    top_level = sorted(((name.strip(), us) for name, us in imports if not name.startswith("  ")),
+                       key=lambda item: -item[1])
+    loaded = {name.strip().split(".")[0] for name, _ in imports}
+    heavy = [name for name in HEAVY_MODULES if name in loaded]
+
+    for name, us in top_level[:10]:
+        print(f"{name:<40} {us / 1000:8.1f}ms")
+    print(f"import {module}: {total_ms:.1f}ms (budget {float(budget_ms):.0f}ms)")
+
+    if heavy:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(heavy)}")
+    if total_ms > float(budget_ms):
+        print("FAIL: cold start over budget")
+    if heavy or total_ms > float(budget_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"usage: python3 benchmarks.py [{'|'.join(BENCHMARKS)}] [args...]")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -1,14 +1,12 @@
-import json
 import asyncio
-import aiohttp
-import os
 from context_integration import analyze_image
 from reasoning_loop import (
     store_inference_feedback,
     extract_relationship_keys
 )
-import aiofiles
+import inference_service
 from time import sleep
+from dotenv import load_dotenv
 from vector_db import get_all_images_from_db
 
 
@@ -48,31 +46,7 @@ def extract_feedback_ratings(ai_response):
 async def generate_feedback(prompt, image_path):
     """Generate feedback about a scene"""
     try:
-        async with aiofiles.open(image_path, 'rb') as f:
-            file_data = await f.read()
-            
-        form_data = aiohttp.FormData()
-        form_data.add_field(
-            'image',
-            file_data,
-            filename=os.path.basename(image_path),
-            content_type='image/jpeg'
-        )
-        
-        form_data.add_field(
-            'text', 
-            json.dumps({"text": prompt}),
-            content_type='application/json'
-        )
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post("http://localhost:8000/analyze/all", data=form_data) as response:
-                if response.status == 200:
-                    return await response.text()
-                else:
-                    print(f"Error analyzing image {image_path}: {response.status}")
-                    return None
-                    
+        return await inference_service.generate_from_file(prompt, image_path, endpoint="bootstrap")
     except Exception as e:
         print(f"Error analyzing image {image_path}: {str(e)}")
         return None
@@ -142,4 +116,5 @@ def bootstrap_reasoning_pipeline_with_feedback():
             sleep(7)
 
 if __name__ == "__main__":
+    load_dotenv()
     bootstrap_reasoning_pipeline_with_feedback()
\ No newline at end of file
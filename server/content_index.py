@@ -0,0 +1,239 @@
+import io
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from image_buffer import ImageBuffer
+
+
+CONTENT_INDEX_FILE = "content_index.db"
+# Largest pHash Hamming distance (out of 64 bits) at which two images count as near-duplicates
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", "6"))
+# Set REUSE_NEAR_DUPLICATE_ANALYSIS=1 to give near-duplicates the analysis of the image
+# they duplicate instead of calling the model (they still get their own id and embedding)
+REUSE_NEAR_DUPLICATE_ANALYSIS = os.getenv("REUSE_NEAR_DUPLICATE_ANALYSIS", "0") == "1"
+
+# Number of set bits of every byte value, to count differing bits 8 at a time
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# DCT-II basis for 32x32 pHash inputs (same scale as scipy.fft.dct)
+_DCT = 2 * np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64)
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class UnreadableImageError(Exception):
+    """Raised for files Pillow can't decode, which are rejected before analysis"""
+
+
+def content_hash(data):
+    """SHA-256 of the file content (bytes or an ImageBuffer), identical only for byte-identical files"""
+    if isinstance(data, ImageBuffer):
+        return data.sha256()
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data):
+    """
+    64-bit pHash of an image: signs of the lowest 8x8 DCT frequencies of the 32x32
+    grayscale image against their median. Re-encoded, resized or slightly edited copies
+    of an image differ from it by a few bits only.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].flatten()
+    bits = low > np.median(low)
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def image_hashes(image_path):
+    """
+    Returns:
+        dict: sha256 and phash of an image file
+
+    Raises:
+        UnreadableImageError: If the file is not an image
+    """
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    try:
+        phash = perceptual_hash(data)
+    except Exception as e:
+        raise UnreadableImageError(f"{os.path.basename(image_path)} is not a readable image: {e}")
+    return {"sha256": content_hash(data), "phash": phash}
+
+
+def _signed(phash):
+    """pHash as a signed 64-bit integer, the range SQLite stores"""
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+class ContentIndex:
+    """
+    Content hashes of the stored images, to recognize an image uploaded again under
+    another name before it is analyzed and embedded.
+
+    Exact duplicates are found by SHA-256 through an SQLite index. Near-duplicates are
+    found by pHash Hamming distance: all the pHashes are kept in a numpy array, and a query
+    XORs it with the new hash and counts the differing bits of every entry at once. Rows
+    added by other processes (the server and the ingestion script) are loaded before
+    each query.
+    """
+
+    def __init__(self, path=CONTENT_INDEX_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS images (
+                image_name TEXT PRIMARY KEY,
+                image_id TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                phash INTEGER NOT NULL,
+                near_duplicate_of TEXT,
+                distance INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS images_sha256 ON images(sha256);
+        """)
+        self._names, self._positions = [], {}
+        self._phashes = np.zeros(0, dtype=np.uint64)
+        self._last_rowid = 0
+        self._refresh()
+
+    def __len__(self):
+        return len(self._names)
+
+    def find_exact(self, sha256):
+        """(image_name, image_id) of a stored image with the same content, or None"""
+        row = self._conn.execute(
+            "SELECT image_name, image_id FROM images WHERE sha256 = ? LIMIT 1", (sha256,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def find_near(self, phash, max_distance=NEAR_DUPLICATE_DISTANCE):
+        """
+        Closest stored image by pHash.
+
+        Returns:
+            tuple: (image_name, image_id, distance), or None if none is within max_distance
+        """
+        while True:
+            with self._lock:
+                self._refresh()
+                if not self._names:
+                    return None
+                differing = np.bitwise_xor(self._phashes, np.uint64(phash))
+                distances = _POPCOUNT[differing.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+                nearest = int(np.argmin(distances))
+                distance = int(distances[nearest])
+                image_name = self._names[nearest]
+            if distance > max_distance:
+                return None
+            row = self._conn.execute(
+                "SELECT image_id FROM images WHERE image_name = ?", (image_name,)
+            ).fetchone()
+            if row is not None:
+                return image_name, row[0], distance
+            # Removed by another process, look again without it
+            with self._lock:
+                self._remove_names([image_name])
+
+    def add_many(self, entries):
+        """
+        Record stored images.
+
+        Args:
+            entries (list): (image_name, image_id, sha256, phash, near_duplicate_of, distance)
+                tuples, the last two None for images that duplicate nothing
+        """
+        entries = list(entries)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO images (image_name, image_id, sha256, phash, near_duplicate_of, distance) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(image_name) DO UPDATE SET "
+                "image_id = excluded.image_id, sha256 = excluded.sha256, phash = excluded.phash, "
+                "near_duplicate_of = excluded.near_duplicate_of, distance = excluded.distance",
+                [(name, image_id, sha256, _signed(phash), of, distance)
+                 for name, image_id, sha256, phash, of, distance in entries]
+            )
+            new = {}
+            for image_name, _, _, phash, _, _ in entries:
+                if image_name in self._positions:
+                    # A re-stored image keeps its slot, with its new hash
+                    self._phashes[self._positions[image_name]] = np.uint64(phash)
+                else:
+                    new[image_name] = phash
+            for image_name in new:
+                self._positions[image_name] = len(self._names)
+                self._names.append(image_name)
+            if new:
+                self._phashes = np.concatenate([self._phashes, np.array(list(new.values()), dtype=np.uint64)])
+
+    def remove_image(self, image_id):
+        """Forget a deleted image, so new copies of it are analyzed again"""
+        with self._lock, self._conn:
+            names = [row[0] for row in self._conn.execute(
+                "SELECT image_name FROM images WHERE image_id = ?", (image_id,))]
+            self._conn.execute("DELETE FROM images WHERE image_id = ?", (image_id,))
+            self._remove_names(names)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM images")
+            self._names, self._positions = [], {}
+            self._phashes = np.zeros(0, dtype=np.uint64)
+            # Rowids start over once the table is empty
+            self._last_rowid = 0
+
+    def _refresh(self):
+        """Load the rows written since the last refresh, by this process or another one"""
+        rows = self._conn.execute(
+            "SELECT rowid, image_name, phash FROM images WHERE rowid > ? ORDER BY rowid", (self._last_rowid,)
+        ).fetchall()
+        if not rows:
+            return
+        self._last_rowid = rows[-1][0]
+        new = {}
+        for _, image_name, phash in rows:
+            phash = np.int64(phash).view(np.uint64)
+            if image_name in self._positions:
+                self._phashes[self._positions[image_name]] = phash
+            else:
+                new[image_name] = phash
+        for image_name in new:
+            self._positions[image_name] = len(self._names)
+            self._names.append(image_name)
+        if new:
+            self._phashes = np.concatenate([self._phashes, np.array(list(new.values()), dtype=np.uint64)])
+
+    def _remove_names(self, names):
+        if not names:
+            return
+        keep = [i for i, name in enumerate(self._names) if name not in set(names)]
+        self._names = [self._names[i] for i in keep]
+        self._positions = {name: i for i, name in enumerate(self._names)}
+        self._phashes = self._phashes[keep]
+
+    def near_duplicates(self):
+        """Stored images flagged as near-duplicates: (image_name, near_duplicate_of, distance) tuples"""
+        return self._conn.execute(
+            "SELECT image_name, near_duplicate_of, distance FROM images WHERE near_duplicate_of IS NOT NULL"
+        ).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+def get_content_index():
+    """Process-wide content index, created on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ContentIndex()
+    return _index
@@ -1,11 +1,21 @@
 
 from prompts import get_context_integration_prompt
-from vector_db import get_n_similar_images, get_image_from_db
-import json
-from ingestion_pipeline import clean_response_string
-import aiofiles
-import aiohttp
-import os   
+from vector_db import get_n_similar_images, get_image_from_db, get_relationship_store, get_relationship_stats, get_analysis_cache
+from relationship_store import relationship_codes, encode_relationships
+import inference_service
+import numpy as np
+import os
+
+
+# Number of neighbours compared in extract_relationships
+SIMILAR_IMAGES_N = int(os.getenv("SIMILAR_IMAGES_N", "6"))
+
+# is_similar_relationship weights in tenths for the spatial, functional, state and
+# contextual columns, a pair is similar when the score reaches SIMILARITY_THRESHOLD
+SIMILARITY_WEIGHTS = np.array([4, 3, 2, 1], dtype=np.int32)
+SIMILARITY_THRESHOLD = 3
+MIN_CONFIDENCE = 0.8
+TYPICAL_RATIO = 0.1  # Due to small dataset, we need to be more lenient
     
 #this shouldn't care about the object labels because they are based on similar images 
 # they are likely to have similar objects, so now we focus on the relationships between them
@@ -26,35 +36,43 @@ def extract_relationships(image_id, current_relationships, similar_relationships
     #i can eventually add a filter for common objects. where i only check for similar
     #relationships between images that have common objects/subjectsto the current scene
     #in this way if a current relationship has no similar relationships, it will be added as an atypical relationship
-    
+
+    # A current relationship matches a similar one when they share an object/subject or
+    # when is_similar_relationship holds. All pairs are compared at once on integer codes.
+    current = [rel for rel in current_relationships if rel['confidence'] >= MIN_CONFIDENCE]
+    neighbours = [
+        relationship_codes(similar_relationships)
+        for id, similar_relationships, _ in similar_relationships_array
+        if id != image_id and len(similar_relationships) > 0
+    ]
+    if not current or not neighbours:
+        return [], []
+
+    current_codes = encode_relationships(current)
+    similar_codes = np.concatenate(neighbours)
+    lengths = np.array([len(codes) for codes in neighbours])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    subjects, objects = current_codes[:, 0:1], current_codes[:, 1:2]
+    shared_objects = (
+        (subjects == similar_codes[:, 0]) | (subjects == similar_codes[:, 1]) |
+        (objects == similar_codes[:, 0]) | (objects == similar_codes[:, 1])
+    )
+    scores = (current_codes[:, None, 2:] == similar_codes[None, :, 2:]) @ SIMILARITY_WEIGHTS
+    matches = (shared_objects | (scores >= SIMILARITY_THRESHOLD)).astype(np.int32)
+
+    # Matches per (current relationship, similar image)
+    match_counts = np.add.reduceat(matches, starts, axis=1)
+    typical = match_counts / lengths >= TYPICAL_RATIO
+
     typical_relationships = []
     atypical_relationships = []
-    
-    
-    for id, similar_relationships,_ in similar_relationships_array:
-        if id == image_id:
-            continue
-        len_similar_relationships = len(similar_relationships)
-        
-        if len_similar_relationships == 0:
-            continue
-
-        for current_rel in current_relationships:
-            if current_rel['confidence'] >= 0.8:
-                match_count = 0
-                current_objects = {current_rel["object"], current_rel["subject"]}
-            
-                for rel in similar_relationships:
-                    similar_objects = {rel["object"], rel["subject"]}
-
-                    if current_objects.intersection(similar_objects) or is_similar_relationship(current_rel, rel):
-                        match_count += 1
-
-                
-                if match_count/len_similar_relationships >= 0.1: # Due to small dataset, we need to be more lenient
-                    typical_relationships.append(current_rel)
-                else:
-                    atypical_relationships.append(current_rel)
+    for image_index in range(len(neighbours)):
+        for rel_index, current_rel in enumerate(current):
+            if typical[rel_index, image_index]:
+                typical_relationships.append(current_rel)
+            else:
+                atypical_relationships.append(current_rel)
     
     return typical_relationships, atypical_relationships
 
@@ -79,7 +97,7 @@ def is_similar_relationship(rel1, rel2):
     return similarity_score >= 0.3
 
 
-def get_similar_images_metadata(image_id, n=6):
+def get_similar_images_metadata(image_id, n=SIMILAR_IMAGES_N):
     """
     Retrieve relationships from n most similar images based on embeddings.
     
@@ -88,21 +106,25 @@ def get_similar_images_metadata(image_id, n=6):
         n (int): Number of similar images to retrieve
     
     Returns:
-        list: List of tuples (image_id, relationships) from similar images
+        tuple: (similar, radius)
+            - similar: List of tuples (image_id, relationships, description) from similar images
+            - radius: Distance of the farthest of them
     """
-    similar_images = get_n_similar_images(image_id, n)
-    
-    similar_relationships = []
-    
-    for id,rels in zip(similar_images["ids"][0], similar_images['metadatas'][0]):
+    similar_images = get_n_similar_images(image_id, n, include=['distances'])
+    distances = similar_images["distances"][0]
 
-        similar_relationships.append((id,json.loads(rels["relationships"]), rels["description"]))
+    # Relationships come pre-parsed from the relationship store
+    records = get_relationship_store().get_images(similar_images["ids"][0])
 
-    return similar_relationships
+    similar = [(record.image_id, record.relationships, record.description) for record in records]
+    return similar, max(distances) if distances else None
 
 def analyze_image(image_id):
     """
     Complete image analysis pipeline combining visual analysis, context integration, and inference.
+
+    The neighbour-based part is cached per image until an image is ingested close enough
+    to change its neighbours, the dataset-wide statistics are always read fresh.
     
     Args:
         image_id (str): ID of the image to analyze
@@ -113,30 +135,36 @@ def analyze_image(image_id):
             - relationships: Object relationships in the scene
             - context: Scene context with typical/atypical patterns
             - inferences: Generated insights about the scene
+            - relationship_statistics: Dataset-wide frequency and calibrated typicality
+              of each relationship, overall and within the same scene type
     """
-    image_metadata = get_image_from_db(image_id)
-    
-    objects_str = image_metadata['metadatas'][0]['objects_in_image']
-    relationships_str = image_metadata['metadatas'][0]['relationships']
+    record = get_relationship_store().get_image(image_id)
+    if record is None:
+        return None
+
+    cache = get_analysis_cache()
+    analysis = cache.get(image_id)
+    if analysis is None:
+        version = cache.version(image_id)
+        similar_relationships, radius = get_similar_images_metadata(image_id)
+        # Stage 3: Context integration
+        typical_relationships, atypical_relationships = extract_relationships(image_id, record.relationships, similar_relationships)
+
+        analysis = {
+            "objects": dict(record.objects),
+            "typical_relationships": [rel.to_dict() for rel in typical_relationships],
+            "atypical_relationships": [rel.to_dict() for rel in atypical_relationships],
+            "scene_type": record.description,
+            # "similar_relationships": similar_relationships 
+        }
+        cache.put(image_id, version, analysis, radius)
 
-    objects = json.loads(clean_response_string(objects_str))
-    relationships = json.loads(clean_response_string(relationships_str))
-    
-    similar_relationships = get_similar_images_metadata(image_id)
-    # Stage 3: Context integration
-    typical_relationships, atypical_relationships = extract_relationships(image_id, relationships, similar_relationships)
-    
-    
- 
     return {
-        "objects": objects,
-        "typical_relationships": typical_relationships,
-        "atypical_relationships": atypical_relationships,
-        "scene_type": image_metadata['metadatas'][0]['description'],
-        # "similar_relationships": similar_relationships 
+        **analysis,
+        "relationship_statistics": get_relationship_stats().describe(record.relationships, record.description),
     }
     
-async def generate_inference(prompt, image_path):
+async def generate_inference(prompt, image_path, image_bytes=None):
     """
     Generate inferences about a scene based on context and visual analysis.
     
@@ -147,38 +175,15 @@ async def generate_inference(prompt, image_path):
             - atypical_relationships: List of unusual relationships
             - scene_type: General description of the scene
         image_path (str): Path to the image file
+        image_bytes (bytes): Content of the image file (or its ImageBuffer), when the caller already read it
     
     Returns:
         str: Generated inferences about the scene, including potential past/future events
     """
-    try:        
-        # Read the image file
-        async with aiofiles.open(image_path, 'rb') as f:
-            file_data = await f.read()
-            
-        # Create form data
-        form_data = aiohttp.FormData()
-        form_data.add_field('image',
-                          file_data,
-                          filename=os.path.basename(image_path),
-                          content_type='image/jpeg')
-        
-        
-        form_data.add_field('text', 
-                    json.dumps({"text": prompt}),  # Send as JSON string
-                    content_type='application/json')
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post("http://localhost:8000/analyze/all", data=form_data) as response:
-                
-                response_text = await response.text()
-                
-                if response.status == 200:
-                    return response_text
-                else:
-                    print(f"Error analyzing image {image_path}: {response.status}")
-                    return None
-                    
+    try:
+        if image_bytes is not None:
+            return await inference_service.generate(prompt, image_bytes, endpoint="inference")
+        return await inference_service.generate_from_file(prompt, image_path, endpoint="inference")
     except Exception as e:
         print(f"Error analyzing image {image_path}: {str(e)}")
         return None
@@ -186,6 +191,28 @@ async def generate_inference(prompt, image_path):
 
 
 
+async def generate_inference_stream(prompt, image_path, image_bytes=None):
+    """
+    Same as generate_inference, yielding the inference text in chunks as the model
+    produces it. Errors are raised to the caller, which already started its response.
+    """
+    if image_bytes is not None:
+        chunks = inference_service.generate_stream(prompt, image_bytes, endpoint="inference")
+    else:
+        chunks = inference_service.generate_from_file_stream(prompt, image_path, endpoint="inference")
+    async for chunk in chunks:
+        yield chunk
+
+
+async def stream_inference_from_context_integration(scene_context, image_id):
+    """Streaming version of get_inference_from_context_integration"""
+    image_metadata = get_image_from_db(image_id)
+    image_path = image_metadata['uris'][0]
+    prompt = get_context_integration_prompt(scene_context)
+    async for chunk in generate_inference_stream(prompt, image_path):
+        yield chunk
+
+
 async def get_inference_from_context_integration(scene_context, image_id):
     image_metadata = get_image_from_db(image_id)
     image_path = image_metadata['uris'][0]
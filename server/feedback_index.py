@@ -0,0 +1,281 @@
+import json
+import sqlite3
+import threading
+
+
+FEEDBACK_INDEX_FILE = "feedback_index.db"
+
+# Relationship dimensions that are indexed, in the order they appear in a relationship key
+KEY_DIMENSIONS = ["subject", "spatial", "state", "functional", "contextual", "object"]
+# Dimensions with postings lists; the others are stored on each relationship row and
+# checked only for the candidates matched through subject and object
+ENTITY_DIMENSIONS = ["subject", "object"]
+DETAIL_DIMENSIONS = ["spatial", "state", "functional", "contextual"]
+RELATIONSHIP_FIELDS = ["atypical_relationships", "typical_relationships"]
+MIN_RATING = 0.5
+
+
+def relationship_matches_key(data, key_parts):
+    """
+    Matching rule used for relationship keys: the key's subject and object must appear
+    (as substrings) in the relationship's subject or object, and at least one of the
+    spatial, state, functional or contextual parts must appear in the same dimension.
+    """
+    subject, spatial, state, functional, contextual, obj = key_parts
+    return (
+        (subject in data['subject'] or subject in data['object']) and
+        (
+            spatial in data['spatial'] or
+            state in data['state'] or
+            functional in data['functional'] or
+            contextual in data['contextual']
+        ) and
+        (obj in data['object'] or obj in data['subject'])
+    )
+
+
+def parse_relationship_fields(metadata):
+    """
+    Parsed relationship lists of a feedback entry, following the same rules as the
+    original full scan: stop at the first empty field, skip fields that are not valid JSON.
+
+    Returns:
+        list: (field, relationships) tuples
+    """
+    fields = []
+    for field in RELATIONSHIP_FIELDS:
+        field_data = metadata.get(field, "")
+        if field_data == "":
+            break
+        try:
+            fields.append((field, json.loads(field_data)))
+        except json.JSONDecodeError:
+            print(f"Error parsing JSON for {field}: {field_data}", flush=True)
+    return fields
+
+
+class FeedbackIndex:
+    """
+    Persistent inverted index from relationship terms to feedback entries.
+
+    Every distinct value of each relationship dimension is a term. Subject and object terms
+    have a postings list of the relationships that contain them, the spatial, state,
+    functional and contextual terms are stored on each relationship row. A query scans the
+    term vocabulary (kept in memory, much smaller than the corpus) for substring matches,
+    reads the postings of the matching subject/object terms, then checks the other
+    dimensions of those candidates only, so its cost follows the number of matches instead
+    of the number of feedback entries. The index is updated incrementally every time
+    feedback is added.
+    """
+
+    def __init__(self, path=FEEDBACK_INDEX_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS feedback (
+                feedback_id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                image_id TEXT,
+                rating REAL
+            );
+            CREATE TABLE IF NOT EXISTS rels (
+                rel_id INTEGER PRIMARY KEY,
+                feedback_id TEXT NOT NULL,
+                spatial INTEGER,
+                state INTEGER,
+                functional INTEGER,
+                contextual INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS rels_feedback ON rels(feedback_id);
+            CREATE TABLE IF NOT EXISTS terms (
+                term_id INTEGER PRIMARY KEY,
+                dim TEXT NOT NULL,
+                value TEXT NOT NULL,
+                UNIQUE(dim, value)
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER NOT NULL,
+                rel_id INTEGER NOT NULL,
+                PRIMARY KEY(term_id, rel_id)
+            ) WITHOUT ROWID;
+        """)
+        self.vocabulary = {dim: {} for dim in KEY_DIMENSIONS}
+        self._last_term_id = 0
+        self._refresh_vocabulary()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+
+    def _refresh_vocabulary(self):
+        """Load the terms added since the last refresh, including by other processes"""
+        for term_id, dim, value in self._conn.execute(
+            "SELECT term_id, dim, value FROM terms WHERE term_id > ? ORDER BY term_id", (self._last_term_id,)
+        ):
+            self.vocabulary[dim][value] = term_id
+            self._last_term_id = term_id
+
+    def _term_id(self, dim, value):
+        term_id = self.vocabulary[dim].get(value)
+        if term_id is None:
+            # Another process may have added the term since the last refresh
+            self._conn.execute("INSERT OR IGNORE INTO terms (dim, value) VALUES (?, ?)", (dim, value))
+            term_id = self._conn.execute(
+                "SELECT term_id FROM terms WHERE dim = ? AND value = ?", (dim, value)
+            ).fetchone()[0]
+            self.vocabulary[dim][value] = term_id
+        return term_id
+
+    def add(self, feedback_id, metadata):
+        """Index (or re-index) one feedback entry from its Chroma metadata"""
+        self.add_many([(feedback_id, metadata)])
+
+    def add_many(self, entries):
+        """Index several (feedback_id, metadata) entries in one transaction"""
+        with self._lock, self._conn:
+            seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM feedback").fetchone()[0]
+            for feedback_id, metadata in entries:
+                existing = self._conn.execute(
+                    "SELECT seq FROM feedback WHERE feedback_id = ?", (feedback_id,)
+                ).fetchone()
+                if existing:
+                    # Upsert keeps the entry's original position
+                    entry_seq = existing[0]
+                    self._remove(feedback_id)
+                else:
+                    seq += 1
+                    entry_seq = seq
+
+                self._conn.execute(
+                    "INSERT INTO feedback (feedback_id, seq, image_id, rating) VALUES (?, ?, ?, ?)",
+                    (feedback_id, entry_seq, metadata.get("image_id", ""), float(metadata.get("rating", 0)))
+                )
+
+                postings = []
+                for _, relationships in parse_relationship_fields(metadata):
+                    for rel in relationships:
+                        details = [
+                            self._term_id(dim, rel[dim]) if isinstance(rel.get(dim), str) else None
+                            for dim in DETAIL_DIMENSIONS
+                        ]
+                        rel_id = self._conn.execute(
+                            "INSERT INTO rels (feedback_id, spatial, state, functional, contextual) VALUES (?, ?, ?, ?, ?)",
+                            [feedback_id] + details
+                        ).lastrowid
+                        for dim in ENTITY_DIMENSIONS:
+                            if isinstance(rel.get(dim), str):
+                                postings.append((self._term_id(dim, rel[dim]), rel_id))
+                self._conn.executemany("INSERT OR IGNORE INTO postings (term_id, rel_id) VALUES (?, ?)", postings)
+
+    def remove(self, feedback_id):
+        with self._lock, self._conn:
+            self._remove(feedback_id)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM rels")
+            self._conn.execute("DELETE FROM feedback")
+
+    def _remove(self, feedback_id):
+        self._conn.execute(
+            "DELETE FROM postings WHERE rel_id IN (SELECT rel_id FROM rels WHERE feedback_id = ?)", (feedback_id,)
+        )
+        self._conn.execute("DELETE FROM rels WHERE feedback_id = ?", (feedback_id,))
+        self._conn.execute("DELETE FROM feedback WHERE feedback_id = ?", (feedback_id,))
+
+    def _matching_terms(self, dims, term):
+        """Ids of the terms of `dims` whose value contains `term`"""
+        return {
+            term_id
+            for dim in dims
+            for value, term_id in self.vocabulary[dim].items()
+            if term in value
+        }
+
+    def _postings(self, term_ids):
+        """Relationship ids containing any of the subject/object terms"""
+        term_ids = list(term_ids)
+        rel_ids = set()
+        for i in range(0, len(term_ids), 500):
+            chunk = term_ids[i:i + 500]
+            rel_ids.update(row[0] for row in self._conn.execute(
+                f"SELECT rel_id FROM postings WHERE term_id IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        return rel_ids
+
+    def match(self, relationship_keys):
+        """
+        Relationships matching any of the keys.
+
+        Returns:
+            set: Matching relationship ids
+        """
+        matched = set()
+        with self._lock:
+            # Feedback written by other processes (bootstrap script) may have added terms
+            self._refresh_vocabulary()
+            for key in relationship_keys:
+                subject, spatial, state, functional, contextual, obj = key.split("-")
+
+                candidates = self._postings(self._matching_terms(ENTITY_DIMENSIONS, subject))
+                if candidates:
+                    candidates &= self._postings(self._matching_terms(ENTITY_DIMENSIONS, obj))
+                if not candidates:
+                    continue
+
+                detail_terms = [
+                    self._matching_terms([dim], term)
+                    for dim, term in zip(DETAIL_DIMENSIONS, [spatial, state, functional, contextual])
+                ]
+                candidates = list(candidates)
+                for i in range(0, len(candidates), 500):
+                    chunk = candidates[i:i + 500]
+                    for rel_id, *details in self._conn.execute(
+                        f"""SELECT rel_id, spatial, state, functional, contextual FROM rels
+                            WHERE rel_id IN ({','.join('?' * len(chunk))})""",
+                        chunk
+                    ):
+                        if any(term_id in terms for term_id, terms in zip(details, detail_terms)):
+                            matched.add(rel_id)
+        return matched
+
+    def query(self, relationship_keys, exclude_feedback_id=None, limit=3, min_rating=MIN_RATING):
+        """
+        Find feedback entries matching the relationship keys.
+
+        Results are in insertion order, rated at least `min_rating`, with at most one
+        entry per image, like the original scan over the feedback collection.
+
+        Returns:
+            list: Matching feedback ids
+        """
+        rel_ids = list(self.match(relationship_keys))
+
+        candidates = {}
+        with self._lock:
+            for i in range(0, len(rel_ids), 500):
+                chunk = rel_ids[i:i + 500]
+                for feedback_id, seq, image_id, rating in self._conn.execute(
+                    f"""SELECT f.feedback_id, f.seq, f.image_id, f.rating FROM rels r
+                        JOIN feedback f ON f.feedback_id = r.feedback_id
+                        WHERE r.rel_id IN ({','.join('?' * len(chunk))})""",
+                    chunk
+                ):
+                    if rating >= min_rating and feedback_id != exclude_feedback_id:
+                        candidates[feedback_id] = (seq, image_id)
+
+        results = []
+        seen_image_ids = set()
+        for feedback_id, (_, image_id) in sorted(candidates.items(), key=lambda item: item[1][0]):
+            if image_id in seen_image_ids:
+                continue
+            seen_image_ids.add(image_id)
+            results.append(feedback_id)
+            if len(results) >= limit:
+                break
+        return results
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,98 @@
+import os
+from feedback_index import parse_relationship_fields, MIN_RATING
+
+
+# Collection holding one embedded document per relationship triple of each feedback entry
+RELATIONSHIP_COLLECTION = "feedback_relationships"
+# Triples retrieved per relationship key of the current scene
+RELATIONSHIP_NEIGHBOURS = int(os.getenv("FEEDBACK_RELATIONSHIP_NEIGHBOURS", "20"))
+# Cosine similarity below which a triple does not count as a match ("mug on desk" and
+# "cup on table" score well above it, unrelated triples well below)
+MIN_SIMILARITY = float(os.getenv("FEEDBACK_RELATIONSHIP_MIN_SIMILARITY", "0.6"))
+
+
+def triple_text(subject, spatial, obj):
+    """Text embedded for a relationship triple"""
+    return " ".join(part.strip() for part in (subject, spatial, obj) if part and part.strip())
+
+
+def key_text(relationship_key):
+    """Text of a "subject-spatial-state-functional-contextual-object" key, embedded like a stored triple"""
+    parts = relationship_key.split("-")
+    if len(parts) == 6:
+        return triple_text(parts[0], parts[1], parts[5])
+    return relationship_key.replace("-", " ")
+
+
+def relationship_documents(feedback_id, metadata):
+    """
+    One document per relationship of a feedback entry, following the same parsing rules as
+    the feedback index.
+
+    Returns:
+        tuple: (ids, documents, metadatas) ready for an upsert into the relationship collection
+    """
+    ids, documents, metadatas = [], [], []
+    for field, relationships in parse_relationship_fields(metadata):
+        for rel in relationships:
+            if not isinstance(rel, dict) or not all(isinstance(rel.get(k), str) for k in ("subject", "spatial", "object")):
+                continue
+            ids.append(f"{feedback_id}:{len(ids)}")
+            documents.append(triple_text(rel["subject"], rel["spatial"], rel["object"]))
+            metadatas.append({
+                "feedback_id": feedback_id,
+                "image_id": metadata.get("image_id", ""),
+                "rating": float(metadata.get("rating", 0)),
+                "field": field,
+            })
+    return ids, documents, metadatas
+
+
+def query_filter(exclude_feedback_id=None, min_rating=MIN_RATING):
+    """Chroma where clause keeping well rated triples of other feedback entries"""
+    rating = {"rating": {"$gte": min_rating}}
+    if not exclude_feedback_id:
+        return rating
+    return {"$and": [rating, {"feedback_id": {"$ne": exclude_feedback_id}}]}
+
+
+def rank_feedback(results, limit=3, min_similarity=MIN_SIMILARITY):
+    """
+    Aggregate the kNN results of all the keys of a scene into feedback scores.
+
+    A feedback entry scores, for each key, the similarity of its closest triple, summed
+    over the keys, so entries matching several relationships of the scene rank first and
+    many near-duplicate triples of one entry don't add up for a single key. Like the
+    feedback index, at most one entry is returned per image.
+
+    Args:
+        results (dict): Chroma query results with metadatas and cosine distances, one row per key
+        limit (int): Maximum number of feedback ids to return
+
+    Returns:
+        list: Feedback ids, best first
+    """
+    scores = {}
+    image_ids = {}
+    for metadatas, distances in zip(results.get('metadatas') or [], results.get('distances') or []):
+        best = {}
+        for metadata, distance in zip(metadatas, distances):
+            similarity = 1.0 - distance
+            if similarity < min_similarity:
+                continue
+            feedback_id = metadata["feedback_id"]
+            best[feedback_id] = max(best.get(feedback_id, 0.0), similarity)
+            image_ids[feedback_id] = metadata.get("image_id", "")
+        for feedback_id, similarity in best.items():
+            scores[feedback_id] = scores.get(feedback_id, 0.0) + similarity
+
+    ranked = []
+    seen_image_ids = set()
+    for feedback_id in sorted(scores, key=lambda f: (-scores[f], f)):
+        if image_ids[feedback_id] in seen_image_ids:
+            continue
+        seen_image_ids.add(image_ids[feedback_id])
+        ranked.append(feedback_id)
+        if len(ranked) >= limit:
+            break
+    return ranked
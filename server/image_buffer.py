@@ -0,0 +1,98 @@
+import io
+import os
+import mmap
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Image files kept mapped, with their base64 form once it was needed
+IMAGE_BUFFER_CACHE_SIZE = int(os.getenv("IMAGE_BUFFER_CACHE_SIZE", "128"))
+
+_buffers = OrderedDict()
+_buffers_lock = threading.Lock()
+
+
+class ImageBuffer:
+    """
+    Read-only image content shared by every step of a request without copies.
+
+    A file is memory-mapped, so its pages come from the OS page cache and are only read
+    when something looks at them; `view` is a memoryview over the mapping (or over the
+    bytes of an upload). The SHA-256 and base64 forms are computed once per buffer.
+    """
+    __slots__ = ("path", "view", "_sha256", "_base64")
+
+    def __init__(self, view, path=None):
+        self.path = path
+        self.view = view
+        self._sha256 = None
+        self._base64 = None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(memoryview(b""), path)
+            # The mapping stays valid after the file is closed
+            return cls(memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)), path)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(memoryview(data))
+
+    def __len__(self):
+        return self.view.nbytes
+
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.view).hexdigest()
+        return self._sha256
+
+    def base64(self):
+        """Base64 text of the content, as inline image parts need it"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.view).decode('ascii')
+        return self._base64
+
+    def open(self):
+        """A file object to decode the image from (Pillow), without copying it into memory"""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self.view.obj if isinstance(self.view.obj, bytes) else self.view)
+
+
+def image_view(data):
+    """memoryview of image bytes or of an ImageBuffer"""
+    return data.view if isinstance(data, ImageBuffer) else memoryview(data)
+
+
+def image_base64(data):
+    """Base64 text of image bytes, cached when data is an ImageBuffer"""
+    if isinstance(data, ImageBuffer):
+        return data.base64()
+    return base64.b64encode(data).decode('utf-8')
+
+
+def get_image_buffer(image_path):
+    """
+    Buffer of an image file, shared by all the requests for the same file.
+
+    Buffers are cached by path, size and modification time, so a replaced file is mapped
+    again. Evicted buffers are unmapped once no request uses them anymore.
+    """
+    stat = os.stat(image_path)
+    key = (os.path.realpath(image_path), stat.st_size, stat.st_mtime_ns)
+    with _buffers_lock:
+        buffer = _buffers.get(key)
+        if buffer is not None:
+            _buffers.move_to_end(key)
+            return buffer
+
+    buffer = ImageBuffer.from_file(image_path)
+    with _buffers_lock:
+        buffer = _buffers.setdefault(key, buffer)
+        while len(_buffers) > IMAGE_BUFFER_CACHE_SIZE:
+            _buffers.popitem(last=False)
+    return buffer
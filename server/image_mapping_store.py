@@ -0,0 +1,123 @@
+import os
+import json
+import sqlite3
+import threading
+
+
+MAPPING_DB_FILE = "image_mapping.db"
+# Mapping written by earlier versions, imported once when the store is created
+LEGACY_MAPPING_FILE = "image_mapping.json"
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class ImageMappingStore:
+    """
+    Image name <-> image id mapping shared by the server and the ingestion scripts.
+
+    Stored in SQLite with WAL, so every insert is atomic, survives a crash of the writing
+    process, and is seen right away by readers in other processes without rewriting anything. An id never
+    changes once assigned, so found pairs are also kept in memory and repeated lookups in
+    either direction are dict reads; misses always go to the database.
+    """
+
+    def __init__(self, path=MAPPING_DB_FILE, legacy_path=LEGACY_MAPPING_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS images (
+                image_name TEXT PRIMARY KEY,
+                image_id TEXT UNIQUE NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS aliases (
+                image_name TEXT PRIMARY KEY,
+                image_id TEXT NOT NULL
+            );
+        """)
+        self._id_by_name = {}
+        self._name_by_id = {}
+
+        if legacy_path and os.path.exists(legacy_path) and len(self) == 0:
+            with open(legacy_path, 'r') as f:
+                mapping = json.load(f)
+            print(f"Importing {len(mapping)} images from {legacy_path}", flush=True)
+            self.add_many(mapping.items())
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def __contains__(self, image_name):
+        return self.get_id(image_name) is not None
+
+    def _remember(self, image_name, image_id):
+        self._id_by_name[image_name] = image_id
+        self._name_by_id[image_id] = image_name
+
+    def get_id(self, image_name):
+        """Id of an image name (or of an alias), or None if it was never stored"""
+        image_id = self._id_by_name.get(image_name)
+        if image_id is None:
+            row = self._conn.execute("SELECT image_id FROM images WHERE image_name = ?", (image_name,)).fetchone()
+            if row:
+                image_id = row[0]
+                self._remember(image_name, image_id)
+            else:
+                row = self._conn.execute("SELECT image_id FROM aliases WHERE image_name = ?", (image_name,)).fetchone()
+                if row:
+                    image_id = self._id_by_name[image_name] = row[0]
+        return image_id
+
+    def get_name(self, image_id):
+        """Name of an image id, or None if it was never stored"""
+        image_name = self._name_by_id.get(image_id)
+        if image_name is None:
+            row = self._conn.execute("SELECT image_name FROM images WHERE image_id = ?", (image_id,)).fetchone()
+            if row:
+                image_name = row[0]
+                self._remember(image_name, image_id)
+        return image_name
+
+    def add(self, image_name, image_id):
+        self.add_many([(image_name, image_id)])
+
+    def add_many(self, pairs):
+        """Insert several (image_name, image_id) pairs in one transaction"""
+        pairs = list(pairs)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO images (image_name, image_id) VALUES (?, ?) "
+                "ON CONFLICT(image_name) DO UPDATE SET image_id = excluded.image_id",
+                pairs
+            )
+        for image_name, image_id in pairs:
+            self._remember(image_name, image_id)
+
+    def add_alias(self, image_name, image_id):
+        """Map another name to a stored image (e.g. a duplicate upload); get_name keeps the original name"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO aliases (image_name, image_id) VALUES (?, ?) "
+                "ON CONFLICT(image_name) DO UPDATE SET image_id = excluded.image_id",
+                (image_name, image_id)
+            )
+        self._id_by_name[image_name] = image_id
+
+    def image_ids(self):
+        return [row[0] for row in self._conn.execute("SELECT image_id FROM images")]
+
+    def close(self):
+        self._conn.close()
+
+
+def get_mapping_store():
+    """Process-wide mapping store, created on first use"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ImageMappingStore()
+    return _store
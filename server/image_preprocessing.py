@@ -0,0 +1,200 @@
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from content_index import content_hash
+from image_buffer import ImageBuffer, get_image_buffer
+
+
+# Set IMAGE_PREPROCESSING=0 to send images to the model exactly as uploaded
+IMAGE_PREPROCESSING = os.getenv("IMAGE_PREPROCESSING", "1") == "1"
+# Longest side, in pixels, of the images sent to the model and to CLIP
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+PREPROCESSED_FOLDER = "preprocessed_images"
+IMAGE_CACHE_MAX_BYTES = int(float(os.getenv("IMAGE_CACHE_MAX_MB", "64")) * 1024 * 1024)
+
+_preprocessor = None
+_preprocessor_lock = threading.Lock()
+
+
+class ImagePreprocessor:
+    """
+    Downscales and re-encodes images before they are sent to the model or embedded.
+
+    An image is decoded once (JPEGs straight at a reduced scale), turned upright from
+    its EXIF orientation, resized to fit `max_side` and saved as a JPEG of `quality`
+    without metadata. Images already small enough and without metadata are kept as they
+    are, so they don't lose quality to a second encoding.
+
+    Results are keyed by the SHA-256 of the original bytes and the settings, and kept in
+    an in-memory LRU of `max_bytes` and in `folder`, so the server and the ingestion
+    process share them and an image is only prepared once for analysis and embedding.
+    Prepared images are ImageBuffers, so their base64 form is also computed only once.
+    """
+
+    # Marks images sent as they are in the LRU
+    UNCHANGED = b""
+
+    def __init__(self, max_side=IMAGE_MAX_SIDE, quality=IMAGE_QUALITY, folder=PREPROCESSED_FOLDER,
+                 max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.max_side = max_side
+        self.quality = quality
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _key(self, data):
+        return f"{content_hash(data)}-{self.max_side}-q{self.quality}"
+
+    def prepare(self, data):
+        """
+        Args:
+            data: Image bytes or an ImageBuffer
+
+        Returns:
+            The image to send: an ImageBuffer of a JPEG, or `data` itself if it is kept as
+            it is or can't be decoded
+        """
+        key = self._key(data)
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if prepared is None and self.folder and os.path.exists(os.path.join(self.folder, key + ".jpg")):
+            prepared = get_image_buffer(os.path.join(self.folder, key + ".jpg"))
+            self.disk_hits += 1
+            self._remember(key, prepared)
+        elif prepared is None:
+            encoded = self._encode(data)
+            self.misses += 1
+            if encoded is None:
+                prepared = self.UNCHANGED
+            else:
+                prepared = ImageBuffer.from_bytes(encoded)
+                if self.folder:
+                    self._write(os.path.join(self.folder, key + ".jpg"), encoded)
+            self._remember(key, prepared)
+
+        if prepared is self.UNCHANGED:
+            prepared = data
+        self.bytes_in += len(data)
+        self.bytes_out += len(prepared)
+        return prepared
+
+    def _write(self, path, encoded):
+        """
+        Store a prepared image in the folder. Other threads or processes may prepare the
+        same image at the same time; they write the same content, so whichever file lands
+        last is kept and a failed write only costs a later cache miss.
+        """
+        if os.path.exists(path):
+            # Lost the race: the copy already stored is as good as this one
+            return
+        # A temporary file of its own, renamed so a concurrent reader never sees half a file
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".tmp", delete=False) as f:
+                temp_path = f.name
+                f.write(encoded)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error caching preprocessed image {path}: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _encode(self, data):
+        """JPEG bytes of the prepared image, or None to send the image as it is"""
+        from PIL import Image, ImageOps
+
+        try:
+            source = data.open() if isinstance(data, ImageBuffer) else io.BytesIO(data)
+            with source, Image.open(source) as image:
+                if (image.format == "JPEG" and max(image.size) <= self.max_side
+                        and not image.info.get("exif") and not image.info.get("icc_profile")):
+                    return None
+                # Let the JPEG decoder skip detail the resize would throw away
+                image.draft("RGB", (self.max_side, self.max_side))
+                image = ImageOps.exif_transpose(image).convert("RGB")
+                image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                output = io.BytesIO()
+                image.save(output, format="JPEG", quality=self.quality, optimize=True)
+        except Exception as e:
+            print(f"Error preprocessing image, sending it as is: {e}")
+            return None
+        return output.getvalue()
+
+    def _remember(self, key, prepared):
+        with self._lock:
+            if key in self._entries or len(prepared) > self.max_bytes:
+                return
+            self._entries[key] = prepared
+            self.size += len(prepared)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def snapshot(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "size_bytes": self.size,
+        }
+
+
+def get_image_preprocessor():
+    """Return the process-wide image preprocessor, or None when IMAGE_PREPROCESSING=0"""
+    global _preprocessor
+    if _preprocessor is None and IMAGE_PREPROCESSING:
+        with _preprocessor_lock:
+            if _preprocessor is None:
+                _preprocessor = ImagePreprocessor()
+    return _preprocessor
+
+
+def prepare_images(image_bytes, mime_type="image/jpeg"):
+    """
+    Prepare one image or a list of images for the model.
+
+    Returns:
+        tuple: (image_bytes, mime_type), the mime type is image/jpeg once images are re-encoded
+    """
+    preprocessor = get_image_preprocessor()
+    if preprocessor is None or image_bytes is None:
+        return image_bytes, mime_type
+    if isinstance(image_bytes, (list, tuple)):
+        prepared = [preprocessor.prepare(data) for data in image_bytes]
+        changed = any(p is not data for p, data in zip(prepared, image_bytes))
+    else:
+        prepared = preprocessor.prepare(image_bytes)
+        changed = prepared is not image_bytes
+    return prepared, "image/jpeg" if changed else mime_type
+
+
+def open_prepared_image(image_path):
+    """Open an image file for embedding, from its prepared copy when preprocessing is on"""
+    from PIL import Image
+
+    preprocessor = get_image_preprocessor()
+    if preprocessor is None:
+        return Image.open(image_path)
+    with preprocessor.prepare(get_image_buffer(image_path)).open() as f:
+        image = Image.open(f)
+        image.load()
+    return image
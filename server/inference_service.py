@@ -0,0 +1,666 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import weakref
+from collections import deque
+from typing import List
+from prompts import IMAGE_ANALYSIS_PROMPT, get_batch_analysis_prompt, get_analysis_repair_prompt
+from analysis_schema import ImageAnalysis, BatchImageAnalysis, AnalysisParseError, parse_analysis, parse_batch_analysis
+from response_cache import ResponseCache, RESPONSE_CACHE, response_key
+from image_preprocessing import prepare_images
+from image_buffer import get_image_buffer, image_view, image_base64
+
+
+MODEL_NAME = "gemini-2.0-flash"
+
+# Defaults for endpoints that were not configured explicitly
+DEFAULT_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", "8"))
+DEFAULT_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "60"))
+
+# Optional conversation sessions are short-lived and capped so their cost stays bounded
+SESSION_TTL = float(os.getenv("INFERENCE_SESSION_TTL", "300"))
+SESSION_MAX_TURNS = int(os.getenv("INFERENCE_SESSION_MAX_TURNS", "6"))
+
+# Rough token cost of one inline image, used by backends that don't report usage
+IMAGE_TOKENS = 258
+
+
+class InferenceTimeout(Exception):
+    """Raised when a model call takes longer than the endpoint timeout"""
+
+
+class Generation:
+    """Text returned by a backend along with the token usage of the call"""
+    __slots__ = ("text", "input_tokens", "output_tokens")
+
+    def __init__(self, text, input_tokens=0, output_tokens=0):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+
+class InferenceBackend:
+    """
+    Base class for model backends. A backend takes a prompt, optional image bytes (or a
+    list of them for multi-image requests) and an optional history of previous
+    (role, text) turns, and returns a Generation. With a response_schema (a pydantic
+    model or a list of one), the backend asks the model for JSON following it.
+    Every call is stateless: nothing is kept between calls unless a history is passed in.
+    """
+    name = "base"
+
+    async def generate(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None, response_schema=None):
+        raise NotImplementedError
+
+    async def generate_stream(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None):
+        """
+        Yield the answer as Generations holding the next chunk of text and the token
+        usage so far. Backends without streaming return the whole answer as one chunk.
+        """
+        yield await self.generate(prompt, image_bytes, mime_type, history)
+
+
+class GeminiBackend(InferenceBackend):
+    """Backend that sends requests to the Gemini API"""
+    name = "gemini"
+
+    def __init__(self, api_key=None, model=MODEL_NAME):
+        from google import genai
+
+        api_key = api_key or os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise RuntimeError("API key not configured")
+
+        self.model = model
+        self.client = genai.Client(api_key=api_key)
+
+    def build_message(self, prompt, image_bytes=None, mime_type="image/jpeg"):
+        from google.genai.types import Part, PartDict
+
+        message = [Part(text=prompt)]
+        for data in as_image_list(image_bytes):
+            message.append(
+                Part(
+                    inline_data=PartDict(
+                        mime_type=mime_type,
+                        data=image_base64(data)
+                    )
+                )
+            )
+        return message
+
+    def build_contents(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None):
+        from google.genai.types import Content, Part
+
+        contents = [
+            Content(role=role, parts=[Part(text=text)])
+            for role, text in (history or [])
+        ]
+        contents.append(Content(role="user", parts=self.build_message(prompt, image_bytes, mime_type)))
+        return contents
+
+    async def generate(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None, response_schema=None):
+        from google.genai.types import GenerateContentConfig
+
+        config = None
+        if response_schema is not None:
+            config = GenerateContentConfig(response_mime_type="application/json", response_schema=response_schema)
+        response = await self.client.aio.models.generate_content(
+            model=self.model,
+            contents=self.build_contents(prompt, image_bytes, mime_type, history),
+            config=config
+        )
+        return self.to_generation(response)
+
+    async def generate_stream(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None):
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=self.build_contents(prompt, image_bytes, mime_type, history)
+        )
+        async for response in stream:
+            yield self.to_generation(response)
+
+    @staticmethod
+    def to_generation(response):
+        usage = response.usage_metadata
+        return Generation(
+            response.text or "",
+            input_tokens=(usage.prompt_token_count or 0) if usage else 0,
+            output_tokens=(usage.candidates_token_count or 0) if usage else 0
+        )
+
+
+class FakeBackend(InferenceBackend):
+    """
+    Deterministic local backend for tests and benchmarks. The same prompt and image
+    always produce the same answer, and image analysis prompts get a valid analysis JSON.
+    `latency` (or FAKE_INFERENCE_LATENCY) simulates the model round-trip in seconds, and
+    `chunk_latency` (or FAKE_CHUNK_LATENCY) the time to produce each chunk of
+    STREAM_CHUNK_CHARS characters, so streamed answers arrive like a real model's.
+    """
+    name = "fake"
+    STREAM_CHUNK_CHARS = 16
+
+    def __init__(self, latency=None, chunk_latency=None):
+        if latency is None:
+            latency = float(os.getenv("FAKE_INFERENCE_LATENCY", "0"))
+        if chunk_latency is None:
+            chunk_latency = float(os.getenv("FAKE_CHUNK_LATENCY", "0"))
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+
+    def chunks(self, text):
+        return [text[i:i + self.STREAM_CHUNK_CHARS] for i in range(0, len(text), self.STREAM_CHUNK_CHARS)]
+
+    async def generate(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None, response_schema=None):
+        generation = self.answer(prompt, image_bytes, history)
+        delay = self.latency + self.chunk_latency * len(self.chunks(generation.text))
+        if delay:
+            await asyncio.sleep(delay)
+        return generation
+
+    async def generate_stream(self, prompt, image_bytes=None, mime_type="image/jpeg", history=None):
+        generation = self.answer(prompt, image_bytes, history)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for index, chunk in enumerate(self.chunks(generation.text), start=1):
+            if self.chunk_latency:
+                await asyncio.sleep(self.chunk_latency)
+            streamed = generation.text[:index * self.STREAM_CHUNK_CHARS]
+            yield Generation(chunk, generation.input_tokens, estimate_tokens(streamed))
+
+    def answer(self, prompt, image_bytes=None, history=None):
+        images = as_image_list(image_bytes)
+        digest = fake_digest(prompt, images)
+
+        if prompt == IMAGE_ANALYSIS_PROMPT:
+            text = json.dumps(fake_analysis(digest))
+        elif images and prompt == get_batch_analysis_prompt(len(images)):
+            # Same analysis per image as a single-image call would return
+            text = json.dumps([
+                dict(image_index=index, **fake_analysis(fake_digest(IMAGE_ANALYSIS_PROMPT, [data])))
+                for index, data in enumerate(images, start=1)
+            ])
+        else:
+            text = (
+                f"The scene ({digest[:8]}) shows objects arranged for everyday use. "
+                "Someone likely placed them there recently. "
+                "They will probably be used again soon."
+            )
+
+        input_tokens = estimate_tokens(prompt) + sum(estimate_tokens(turn) for _, turn in (history or []))
+        input_tokens += IMAGE_TOKENS * len(images)
+        return Generation(text, input_tokens, estimate_tokens(text))
+
+
+def fake_digest(prompt, images):
+    digest = hashlib.sha256(prompt.encode('utf-8'))
+    for data in images:
+        digest.update(image_view(data))
+    return digest.hexdigest()
+
+
+def as_image_list(image_bytes):
+    """Images of a request as a list: none, one, or several for multi-image requests"""
+    if image_bytes is None:
+        return []
+    if isinstance(image_bytes, (list, tuple)):
+        return list(image_bytes)
+    return [image_bytes]
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token)"""
+    return max(1, len(text) // 4)
+
+
+def fake_analysis(digest):
+    """Build a small, valid image analysis payload seeded by a hex digest"""
+    subjects = ["coffee mug", "book", "laptop", "phone", "plate", "lamp"]
+    objects = ["desk", "table", "shelf", "counter"]
+    spatial = ["on", "next to", "on the edge of", "near", "under"]
+    states = ["stable", "unstable", "resting", "tilted"]
+
+    seed = int(digest[:8], 16)
+    subject = subjects[seed % len(subjects)]
+    obj = objects[(seed // 7) % len(objects)]
+
+    return {
+        "objects": [
+            {"label": subject, "attributes": ["white"]},
+            {"label": obj, "attributes": ["wooden"]}
+        ],
+        "relationships": [
+            {
+                "subject": subject,
+                "object": obj,
+                "spatial": spatial[(seed // 11) % len(spatial)],
+                "functional": "supports",
+                "state": states[(seed // 13) % len(states)],
+                "contextual": "typical" if seed % 3 else "atypical",
+                "confidence": 0.9
+            }
+        ],
+        "scene_annotation": f"Indoor scene with a {subject} and a {obj}"
+    }
+
+
+class EndpointLimit:
+    """
+    Concurrency limit and timeout for the model calls made by one endpoint.
+    Semaphores are created per event loop so scripts calling asyncio.run repeatedly still work.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[loop]
+
+
+class InferenceMetrics:
+    """
+    Token and latency metrics for every model call. Keeps running totals and the most
+    recent calls so the per-request cost can be compared across the server's uptime.
+    """
+
+    def __init__(self, window=1000):
+        self.started_at = time.time()
+        self.recent = deque(maxlen=window)
+        self.first = deque(maxlen=100)
+        self.requests = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latency = 0.0
+        self.batches = 0
+        self.batch_images = 0
+        self.batch_fallbacks = 0
+        self.parses = {"strict": 0, "tolerant": 0, "repaired": 0, "failed": 0}
+        self.streams = 0
+        self.first_chunk_latency = 0.0
+
+    def record(self, endpoint, latency, generation=None, session_id=None):
+        self.requests += 1
+        self.latency += latency
+        entry = {
+            "endpoint": endpoint,
+            "latency_ms": round(latency * 1000, 2),
+            "input_tokens": generation.input_tokens if generation else 0,
+            "output_tokens": generation.output_tokens if generation else 0,
+            "session_id": session_id,
+            "timestamp": time.time(),
+        }
+        if generation is None:
+            self.errors += 1
+        else:
+            self.input_tokens += generation.input_tokens
+            self.output_tokens += generation.output_tokens
+        self.recent.append(entry)
+        if len(self.first) < self.first.maxlen:
+            self.first.append(entry)
+
+    def record_batch(self, images, fallbacks):
+        """Count a batch analysis of `images` images, `fallbacks` of which needed a single-image call"""
+        self.batches += 1
+        self.batch_images += images
+        self.batch_fallbacks += fallbacks
+
+    def record_first_chunk(self, latency):
+        """Time from the start of a streamed call to its first chunk of text"""
+        self.streams += 1
+        self.first_chunk_latency += latency
+
+    def record_parse(self, outcome):
+        """Count how an image analysis was parsed: strict, tolerant, repaired or failed"""
+        self.parses[outcome] += 1
+
+    @staticmethod
+    def _averages(entries):
+        if not entries:
+            return {"requests": 0, "avg_latency_ms": 0.0, "avg_input_tokens": 0.0, "avg_output_tokens": 0.0}
+        return {
+            "requests": len(entries),
+            "avg_latency_ms": round(sum(e["latency_ms"] for e in entries) / len(entries), 2),
+            "avg_input_tokens": round(sum(e["input_tokens"] for e in entries) / len(entries), 1),
+            "avg_output_tokens": round(sum(e["output_tokens"] for e in entries) / len(entries), 1),
+        }
+
+    def snapshot(self):
+        """Totals plus averages of the first and the most recent calls"""
+        recent = list(self.recent)[-100:]
+        total_parses = sum(self.parses.values())
+        return {
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "requests": self.requests,
+            "errors": self.errors,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "avg_latency_ms": round(self.latency * 1000 / self.requests, 2) if self.requests else 0.0,
+            "first_requests": self._averages(list(self.first)),
+            "recent_requests": self._averages(recent),
+            "active_sessions": len(_sessions),
+            "batch_analysis": {
+                "batches": self.batches,
+                "images": self.batch_images,
+                "fallbacks": self.batch_fallbacks,
+            },
+            "streaming": {
+                "streams": self.streams,
+                "avg_first_chunk_ms": round(self.first_chunk_latency * 1000 / self.streams, 2) if self.streams else 0.0,
+            },
+            "analysis_parsing": dict(
+                self.parses,
+                failure_rate=round(self.parses["failed"] / total_parses, 3) if total_parses else 0.0
+            ),
+        }
+
+
+class Session:
+    """Short-lived conversation history for requests that really need context"""
+    __slots__ = ("turns", "expires_at")
+
+    def __init__(self):
+        self.turns = []
+        self.expires_at = time.time() + SESSION_TTL
+
+    def add(self, prompt, response):
+        self.turns.extend([("user", prompt), ("model", response)])
+        # Keep only the last SESSION_MAX_TURNS exchanges so the prompt size stays bounded
+        self.turns = self.turns[-2 * SESSION_MAX_TURNS:]
+        self.expires_at = time.time() + SESSION_TTL
+
+
+BACKENDS = {
+    GeminiBackend.name: GeminiBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+_backend = None
+_response_cache = None
+_endpoint_limits = {}
+_sessions = {}
+metrics = InferenceMetrics()
+
+
+def get_backend():
+    """Return the process-wide backend, created from INFERENCE_BACKEND on first use"""
+    global _backend
+    if _backend is None:
+        name = os.getenv("INFERENCE_BACKEND", GeminiBackend.name)
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {name}")
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the process-wide backend (used by scripts and benchmarks)"""
+    global _backend
+    _backend = backend
+
+
+def get_response_cache():
+    """Return the process-wide response cache, or None when RESPONSE_CACHE=0"""
+    global _response_cache
+    if _response_cache is None and RESPONSE_CACHE:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+def configure_endpoint(endpoint, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+    """Set the concurrency limit and timeout (seconds) used for an endpoint's model calls"""
+    _endpoint_limits[endpoint] = EndpointLimit(concurrency, timeout)
+    return _endpoint_limits[endpoint]
+
+
+def get_endpoint_limit(endpoint):
+    if endpoint not in _endpoint_limits:
+        configure_endpoint(endpoint)
+    return _endpoint_limits[endpoint]
+
+
+def get_session(session_id):
+    """Return the live session for a key (image id, user id...), dropping expired ones"""
+    now = time.time()
+    for key in [key for key, session in _sessions.items() if session.expires_at < now]:
+        del _sessions[key]
+    if session_id not in _sessions:
+        _sessions[session_id] = Session()
+    return _sessions[session_id]
+
+
+async def generate(prompt, image_bytes=None, mime_type="image/jpeg", endpoint="default", session_id=None,
+                   use_cache=True, response_schema=None):
+    """
+    Generate text for a prompt and an optional image in-process.
+
+    Each call is a stateless generate_content request. Pass a session_id only when the
+    previous turns are really needed, they are kept for a short time and a few turns.
+    Responses are cached by model, prompt and image content; session calls depend on
+    their history and always go to the model.
+
+    Args:
+        prompt (str): Text prompt sent to the model
+        image_bytes (bytes): Raw image bytes or an ImageBuffer, downscaled by the image
+            preprocessor and encoded once by the backend
+        mime_type (str): Mime type of the image
+        endpoint (str): Name of the calling endpoint, selects the concurrency limit and timeout
+        session_id (str): Optional key of a short-lived conversation session
+        use_cache (bool): Set to False to bypass the response cache
+        response_schema: Optional pydantic model (or list of one) the answer must follow as JSON
+
+    Returns:
+        str: Generated text
+
+    Raises:
+        InferenceTimeout: If the model call exceeds the endpoint timeout
+    """
+    session = get_session(session_id) if session_id else None
+    backend = get_backend()
+    if image_bytes is not None:
+        image_bytes, mime_type = await asyncio.to_thread(prepare_images, image_bytes, mime_type)
+
+    cache = get_response_cache()
+    key = None
+    if cache is not None:
+        if use_cache and session is None:
+            model = f"{backend.name}:{getattr(backend, 'model', '')}"
+            if response_schema is not None:
+                model += f":{response_schema!r}"
+            # Hashing the image and the SQLite lookup stay off the event loop
+            key = await asyncio.to_thread(response_key, model, prompt, image_bytes, mime_type)
+            cached = await asyncio.to_thread(cache.get, key)
+            if cached is not None:
+                return cached[0]
+        else:
+            cache.bypassed += 1
+
+    limit = get_endpoint_limit(endpoint)
+    async with limit.semaphore():
+        start = time.perf_counter()
+        generation = None
+        try:
+            generation = await asyncio.wait_for(
+                backend.generate(prompt, image_bytes, mime_type, session.turns if session else None, response_schema),
+                timeout=limit.timeout
+            )
+        except asyncio.TimeoutError:
+            raise InferenceTimeout(f"Model call for {endpoint} timed out after {limit.timeout}s")
+        finally:
+            metrics.record(endpoint, time.perf_counter() - start, generation, session_id)
+
+    if session and generation.text:
+        session.add(prompt, generation.text)
+    if key is not None and generation.text:
+        await asyncio.to_thread(cache.put, key, generation.text, generation.input_tokens, generation.output_tokens)
+    return generation.text
+
+
+async def generate_from_file(prompt, image_path, endpoint="default", session_id=None, use_cache=True):
+    """Generate text for an image on disk, mapped rather than read into memory"""
+    image_bytes = await asyncio.to_thread(get_image_buffer, image_path)
+    return await generate(prompt, image_bytes, endpoint=endpoint, session_id=session_id, use_cache=use_cache)
+
+
+async def generate_stream(prompt, image_bytes=None, mime_type="image/jpeg", endpoint="default", use_cache=True):
+    """
+    Same as generate, yielding the text in chunks as the model produces it.
+
+    A cached answer is yielded as a single chunk, and a streamed answer is cached once
+    it is complete. The endpoint timeout applies to the whole stream.
+
+    Yields:
+        str: The next chunk of generated text
+
+    Raises:
+        InferenceTimeout: If the stream does not complete within the endpoint timeout
+    """
+    backend = get_backend()
+    if image_bytes is not None:
+        image_bytes, mime_type = await asyncio.to_thread(prepare_images, image_bytes, mime_type)
+
+    cache = get_response_cache()
+    key = None
+    if cache is not None:
+        if use_cache:
+            key = await asyncio.to_thread(
+                response_key, f"{backend.name}:{getattr(backend, 'model', '')}", prompt, image_bytes, mime_type
+            )
+            cached = await asyncio.to_thread(cache.get, key)
+            if cached is not None:
+                yield cached[0]
+                return
+        else:
+            cache.bypassed += 1
+
+    limit = get_endpoint_limit(endpoint)
+    async with limit.semaphore():
+        start = time.perf_counter()
+        deadline = start + limit.timeout
+        chunks = []
+        last = None
+        generation = None
+        stream = backend.generate_stream(prompt, image_bytes, mime_type)
+        try:
+            while True:
+                try:
+                    last = await asyncio.wait_for(stream.__anext__(), timeout=deadline - time.perf_counter())
+                except StopAsyncIteration:
+                    break
+                if not chunks:
+                    metrics.record_first_chunk(time.perf_counter() - start)
+                chunks.append(last.text)
+                yield last.text
+            # Usage reported with the last chunk covers the whole answer
+            generation = Generation(
+                "".join(chunks), last.input_tokens if last else 0, last.output_tokens if last else 0
+            )
+        except asyncio.TimeoutError:
+            raise InferenceTimeout(f"Model stream for {endpoint} timed out after {limit.timeout}s")
+        finally:
+            await stream.aclose()
+            metrics.record(endpoint, time.perf_counter() - start, generation)
+
+    if key is not None and generation is not None and generation.text:
+        await asyncio.to_thread(cache.put, key, generation.text, generation.input_tokens, generation.output_tokens)
+
+
+async def generate_from_file_stream(prompt, image_path, endpoint="default", use_cache=True):
+    """Stream the text generated for an image on disk"""
+    image_bytes = await asyncio.to_thread(get_image_buffer, image_path)
+    async for chunk in generate_stream(prompt, image_bytes, endpoint=endpoint, use_cache=use_cache):
+        yield chunk
+
+
+async def generate_analysis(image_bytes, mime_type="image/jpeg", endpoint="default", use_cache=True):
+    """
+    Analyze one image with IMAGE_ANALYSIS_PROMPT in JSON response mode.
+
+    The answer is parsed strictly, then with the tolerant parser. If it still holds no
+    usable analysis, the same answer is sent back once, without the image, to be
+    rewritten as valid JSON, instead of analyzing the image again.
+
+    Returns:
+        str: The analysis as JSON with objects, relationships and scene_annotation
+
+    Raises:
+        AnalysisParseError: If neither the answer nor its repair holds a usable analysis
+    """
+    text = await generate(
+        IMAGE_ANALYSIS_PROMPT, image_bytes, mime_type, endpoint=endpoint, use_cache=use_cache,
+        response_schema=ImageAnalysis
+    )
+    try:
+        analysis, strict = parse_analysis(text)
+        metrics.record_parse("strict" if strict else "tolerant")
+        return analysis.model_dump_json()
+    except AnalysisParseError:
+        pass
+
+    repaired = await generate(
+        get_analysis_repair_prompt(text), endpoint=endpoint, use_cache=use_cache, response_schema=ImageAnalysis
+    )
+    try:
+        analysis, _ = parse_analysis(repaired)
+    except AnalysisParseError:
+        metrics.record_parse("failed")
+        raise
+    metrics.record_parse("repaired")
+    return analysis.model_dump_json()
+
+
+async def analyze_images(images, mime_type="image/jpeg", endpoint="default", use_cache=True):
+    """
+    Analyze several images with a single multimodal request.
+
+    The batch prompt is sent once for all the images, and the answer is split back per
+    image. Images whose entry is missing or does not parse are analyzed again, one
+    request each, with generate_analysis.
+
+    Args:
+        images (list): Raw bytes of each image
+        mime_type (str): Mime type of the images
+        endpoint (str): Name of the calling endpoint, selects the concurrency limit and timeout
+        use_cache (bool): Set to False to bypass the response cache
+
+    Returns:
+        list: Analysis JSON of each image, in the same format as generate_analysis, or
+            None for images that could not be analyzed
+    """
+    async def analyze_single(image_bytes):
+        try:
+            return await generate_analysis(image_bytes, mime_type, endpoint=endpoint, use_cache=use_cache)
+        except AnalysisParseError as e:
+            print(f"Error parsing image analysis: {e}", flush=True)
+            return None
+
+    if len(images) == 1:
+        return [await analyze_single(images[0])]
+
+    try:
+        text = await generate(
+            get_batch_analysis_prompt(len(images)), images, mime_type, endpoint=endpoint, use_cache=use_cache,
+            response_schema=List[BatchImageAnalysis]
+        )
+        analyses = [
+            analysis.model_dump_json() if analysis is not None else None
+            for analysis in parse_batch_analysis(text, len(images))
+        ]
+    except InferenceTimeout:
+        analyses = [None] * len(images)
+
+    missing = [index for index, analysis in enumerate(analyses) if analysis is None]
+    fallbacks = await asyncio.gather(*(analyze_single(images[index]) for index in missing))
+    for index, analysis in zip(missing, fallbacks):
+        analyses[index] = analysis
+
+    metrics.record_batch(len(images), len(missing))
+    return analyses
@@ -0,0 +1,149 @@
+import json
+import time
+import sqlite3
+import threading
+
+
+JOURNAL_FILE = "ingestion_journal.db"
+
+# Ingestion states, in order
+PENDING = "pending"
+ANALYZED = "analyzed"
+EMBEDDED = "embedded"
+STORED = "stored"
+STATES = [PENDING, ANALYZED, EMBEDDED, STORED]
+
+
+class IngestionJournal:
+    """
+    Durable record of the ingestion state of every image, stored in SQLite.
+
+    Each image moves through pending -> analyzed -> embedded -> stored. The model output
+    is saved with the analyzed state, so a restarted run resumes each image from its last
+    state without calling the model again. Image ids are allocated once, from a
+    monotonic counter, when the image is first seen.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                image_name TEXT PRIMARY KEY,
+                image_id TEXT UNIQUE NOT NULL,
+                state TEXT NOT NULL,
+                analysis TEXT,
+                error TEXT,
+                updated_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS images_state ON images(state)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def seed_ids(self, last_used_id):
+        """Make sure new ids start after `last_used_id` (ids created before the journal existed)"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO counters (name, value) VALUES ('image_id', ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                (last_used_id,)
+            )
+
+    def allocate_id(self):
+        """Atomically allocate the next image id"""
+        with self._lock:
+            return self._allocate_id()
+
+    def _allocate_id(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('image_id', 0)")
+            self._conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'image_id'")
+            value = self._conn.execute("SELECT value FROM counters WHERE name = 'image_id'").fetchone()[0]
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return f"id{value}"
+
+    def add_pending(self, image_name):
+        """
+        Register an image, allocating its id if it is new.
+
+        Returns:
+            dict: The journal entry of the image
+        """
+        with self._lock:
+            entry = self._get(image_name)
+            if entry is None:
+                image_id = self._allocate_id()
+                self._conn.execute(
+                    "INSERT INTO images (image_name, image_id, state, updated_at) VALUES (?, ?, ?, ?)",
+                    (image_name, image_id, PENDING, time.time())
+                )
+                entry = self._get(image_name)
+            return entry
+
+    def mark(self, image_name, state, analysis=None, error=None):
+        """Move an image to `state`, saving the analysis result when given"""
+        with self._lock:
+            if analysis is not None:
+                self._conn.execute(
+                    "UPDATE images SET state = ?, analysis = ?, error = NULL, updated_at = ? WHERE image_name = ?",
+                    (state, json.dumps(analysis), time.time(), image_name)
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE images SET state = ?, error = ?, updated_at = ? WHERE image_name = ?",
+                    (state, error, time.time(), image_name)
+                )
+
+    def get(self, image_name):
+        with self._lock:
+            return self._get(image_name)
+
+    def _get(self, image_name):
+        row = self._conn.execute(
+            "SELECT image_name, image_id, state, analysis, error FROM images WHERE image_name = ?",
+            (image_name,)
+        ).fetchone()
+        return self._entry(row) if row else None
+
+    def unfinished(self):
+        """Entries of every image that has not reached the stored state"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT image_name, image_id, state, analysis, error FROM images WHERE state != ?",
+                (STORED,)
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def counts(self):
+        """Number of images in each state"""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM images GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    @staticmethod
+    def _entry(row):
+        return {
+            "image_name": row[0],
+            "image_id": row[1],
+            "state": row[2],
+            "analysis": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+def last_used_id(image_ids, processed_count=0):
+    """Highest numeric id among existing image ids, or the processed image count"""
+    last = processed_count
+    for image_id in image_ids:
+        if isinstance(image_id, str) and image_id.startswith("id") and image_id[2:].isdigit():
+            last = max(last, int(image_id[2:]))
+    return last
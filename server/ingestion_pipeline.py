@@ -4,45 +4,30 @@ import asyncio
 import aiohttp
 import aiofiles
 from pathlib import Path
-from vector_db import add_image_to_db
-from time import sleep  
-import json
-import re
+from vector_db import add_image_to_db, ImageBatchWriter, INGESTION_BATCH_SIZE
+from ingestion_scheduler import IngestionScheduler, RateLimiter, RetryableError, RETRYABLE_STATUSES, INGESTION_WORKERS, TOKENS_PER_IMAGE
+from ingestion_journal import IngestionJournal, last_used_id, PENDING, ANALYZED, EMBEDDED, STORED
+from single_flight import SingleFlight
+from image_mapping_store import get_mapping_store
+from analysis_schema import parse_analysis, AnalysisParseError
+from content_index import get_content_index, image_hashes, UnreadableImageError, REUSE_NEAR_DUPLICATE_ANALYSIS
 
 
 # Configuration
 IMAGE_FOLDER = "images"  # Change this to your image folder path
 PROCESSED_FOLDER = "processed_images"  # Folder to move processed images
 API_ENDPOINT = "http://localhost:8000/analyze/relationships/image"
+BATCH_API_ENDPOINT = "http://localhost:8000/analyze/relationships/images"
 SUPPORTED_FORMATS = {'.jpg', '.jpeg'}
+DEAD_LETTER_FILE = "dead_letters.json"
+# Images analyzed per model call during backfills, 1 sends one request per image
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", "1"))
 
+_journal = None
 
-def clean_response_string(response_str):
-    """
-    Clean the response string to make it valid JSON
-    
-    response_str (str): String response from the analysis endpoint
-
-    Returns:
-        str: Cleaned response string
-    """
-    response_str = re.sub(r'```json\s*', '', response_str)
-
-    response_str = re.sub(r'\s*```', '', response_str)
-    
-    response_str = response_str.strip('"')
+# Concurrent ingestions of the same file share one analysis and one write
+ingestion_flight = SingleFlight("ingestion")
 
-    response_str = re.sub(r'\\n\s*', '', response_str)
-
-    response_str = response_str.replace('\\"', '"')
-
-    response_str = response_str.replace('\\', '')
-    
-    response_str = re.sub(r',(\s*[}\]])', r'\1', response_str)
-    
-    response_str = response_str.strip()
-    
-    return response_str
 
 def parse_analysis_result(response_str):
     """
@@ -55,26 +40,60 @@ def parse_analysis_result(response_str):
         tuple: (objects_list, relationships_list, scene_description)
     """
     try:
-        # Clean and parse the response string
-        cleaned_response = clean_response_string(response_str)
-        response = json.loads(cleaned_response)
+        analysis, _ = parse_analysis(response_str)
 
         objects = {}  
-        for obj in response["objects"]:
-            objects[obj["label"]] = obj["attributes"]
+        for obj in analysis.objects:
+            objects[obj.label] = obj.attributes
 
         
-        return objects, response["relationships"], response["scene_annotation"]
+        return objects, [rel.model_dump() for rel in analysis.relationships], analysis.scene_annotation
         
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON: {e}")
-        print("Raw response:", cleaned_response)
+    except AnalysisParseError as e:
+        print(f"Error parsing analysis: {e}")
+        print("Raw response:", response_str)
         return {}, [], ""
     except Exception as e:
         print(f"Unexpected error: {e}")
         return {}, [], ""
  
 
+def move_to_processed(image_path):
+    """Move an image to PROCESSED_FOLDER, returning its new path"""
+    processed_path = Path(PROCESSED_FOLDER) / os.path.basename(image_path)
+    if Path(image_path) != processed_path:
+        os.rename(image_path, processed_path)
+    return str(processed_path)
+
+
+def store_analysis(image_path, result):
+    """
+    Parse the analysis of an image and move the image to PROCESSED_FOLDER.
+
+    Returns:
+        dict: image_path, objects, relationships and scene_description, or None if the
+            analysis does not parse
+    """
+    try:
+        objects, relationships, scene_description = parse_analysis_result(result)
+
+        if not objects or scene_description == "":
+            raise Exception("parse_analysis_result failed to parse objects, relationships and scene_description")
+            
+        analysis_result = {
+            'image_path': move_to_processed(image_path),
+            'objects': json.dumps(objects),
+            'relationships': json.dumps(relationships),
+            'scene_description': scene_description
+        }
+        
+        return analysis_result
+    except Exception as e:
+        print(f"Error parsing analysis result for {image_path}: {str(e)}")
+        print(f"Raw response: {result}")
+        return None
+
+
 async def process_single_image(session, image_path):
     try:
         # Prepare the file for upload
@@ -91,88 +110,262 @@ async def process_single_image(session, image_path):
         # Send request to the API
         async with session.post(API_ENDPOINT, data=form_data) as response:
             if response.status == 200:
-                result = await response.text()
-                try:
-                    objects, relationships, scene_description = parse_analysis_result(result)
-
-                    if not objects or scene_description == "":
-                        raise Exception("parse_analysis_result failed to parse objects, relationships and scene_description")
-                        
-                    # Move the processed image
-                    processed_path = Path(PROCESSED_FOLDER) / os.path.basename(image_path)
-                    os.rename(image_path, processed_path)
-
-                    analysis_result = {
-                        'image_path': str(processed_path),
-                        'objects': json.dumps(objects),
-                        'relationships': json.dumps(relationships),
-                        'scene_description': scene_description
-                    }
-                    
-                    return analysis_result
-                except Exception as e:
-                    print(f"Error parsing analysis result for {image_path}: {str(e)}")
-                    print(f"Raw response: {result}")
-                    return None
+                return store_analysis(image_path, await response.text())
             else:
                 error_text = await response.text()
+                if response.status in RETRYABLE_STATUSES:
+                    raise RetryableError(f"{response.status}: {error_text}", response.status)
                 print(f"Error processing {image_path}: {response.status}")
                 print(f"Error details: {error_text}")
                 return None
-                
+
+    except RetryableError:
+        raise
+    except aiohttp.ClientConnectionError as e:
+        raise RetryableError(f"Connection error: {e}")
     except Exception as e:
         print(f"Error processing {image_path}: {str(e)}")
         return None
 
 
+async def process_image_batch(session, image_paths):
+    """
+    Analyze several images with one call to the batch analysis endpoint.
+
+    Returns:
+        list: For each image, the same result as process_single_image (None on failure)
+    """
+    try:
+        form_data = aiohttp.FormData()
+        for image_path in image_paths:
+            async with aiofiles.open(image_path, 'rb') as f:
+                form_data.add_field('images',
+                                  await f.read(),
+                                  filename=os.path.basename(image_path),
+                                  content_type='image/jpeg')
+
+        async with session.post(BATCH_API_ENDPOINT, data=form_data) as response:
+            if response.status == 200:
+                analyses = (await response.json())["analyses"]
+                return [
+                    store_analysis(image_path, analysis) if analysis else None
+                    for image_path, analysis in zip(image_paths, analyses)
+                ]
+            error_text = await response.text()
+            if response.status in RETRYABLE_STATUSES:
+                raise RetryableError(f"{response.status}: {error_text}", response.status)
+            print(f"Error processing batch of {len(image_paths)} images: {response.status}")
+            print(f"Error details: {error_text}")
+
+    except RetryableError:
+        raise
+    except aiohttp.ClientConnectionError as e:
+        raise RetryableError(f"Connection error: {e}")
+    except Exception as e:
+        print(f"Error processing batch of {len(image_paths)} images: {str(e)}")
+    return [None] * len(image_paths)
+
+
+async def analyze_batch(session, journal, image_names):
+    """
+    Analyze the pending images of a group with one batch call and record the results in
+    the journal. Images whose analysis failed stay pending, run_ingestion_steps then
+    analyzes them one by one.
+    """
+    pending = []
+    for image_name in image_names:
+        entry = journal.get(image_name)
+        if entry is not None and entry["state"] != PENDING:
+            continue
+        image_path = pending_image_path(image_name)
+        try:
+            hashes = await asyncio.to_thread(image_hashes, image_path)
+        except UnreadableImageError:
+            # Rejected on its own by run_ingestion_steps, without failing the group
+            continue
+        if entry is None and get_content_index().find_exact(hashes['sha256']):
+            # Linked to the stored copy by run_ingestion_steps
+            continue
+        journal.add_pending(image_name)
+        result = near_duplicate_analysis(journal, image_name, image_path, hashes)
+        if result is not None:
+            journal.mark(image_name, ANALYZED, analysis=dict(result, **hashes))
+            continue
+        pending.append((image_name, image_path, hashes))
+
+    if len(pending) < 2:
+        return
+
+    results = await process_image_batch(session, [image_path for _, image_path, _ in pending])
+    for (image_name, _, hashes), result in zip(pending, results):
+        if result:
+            journal.mark(image_name, ANALYZED, analysis=dict(result, **hashes))
+
+
+def get_journal():
+    """Process-wide ingestion journal, seeded so new ids never collide with existing ones"""
+    global _journal
+    if _journal is None:
+        _journal = IngestionJournal()
+        processed_count = len(os.listdir(PROCESSED_FOLDER)) if os.path.isdir(PROCESSED_FOLDER) else 0
+        _journal.seed_ids(last_used_id(get_mapping_store().image_ids(), processed_count))
+    return _journal
+
+
+def finish_ingestion(journal, records):
+    """Record written images as embedded, then add them to the mapping and content index and mark them stored"""
+    for record in records:
+        journal.mark(record['image_name'], EMBEDDED)
+
+    get_mapping_store().add_many((record['image_name'], record['image_id']) for record in records)
+    get_content_index().add_many(
+        (record['image_name'], record['image_id'], record['sha256'], record['phash'],
+         record.get('near_duplicate_of'), record.get('duplicate_distance'))
+        for record in records if 'sha256' in record
+    )
+
+    for record in records:
+        journal.mark(record['image_name'], STORED)
+
+
+def pending_image_path(image_name):
+    image_path = os.path.join(IMAGE_FOLDER, image_name)
+    if not os.path.exists(image_path):
+        # Moved by a run that stopped before recording the analysis
+        image_path = os.path.join(PROCESSED_FOLDER, image_name)
+    return image_path
+
+
+def link_exact_duplicate(image_name, image_path, hashes):
+    """
+    If a stored image has the same content, make the name an alias of it and move the file
+    to PROCESSED_FOLDER, so it is neither analyzed nor embedded again.
+
+    Returns:
+        str: The id of the stored image, or None if the content is new
+    """
+    duplicate = get_content_index().find_exact(hashes['sha256'])
+    if duplicate is None:
+        return None
+    original_name, image_id = duplicate
+    move_to_processed(image_path)
+    get_mapping_store().add_alias(image_name, image_id)
+    print(f"{image_name} is a copy of {original_name}, linked to {image_id}", flush=True)
+    return image_id
+
+
+def near_duplicate_analysis(journal, image_name, image_path, hashes):
+    """
+    Flag an image that looks like a stored one (by pHash distance) and, with
+    REUSE_NEAR_DUPLICATE_ANALYSIS, reuse the stored image's analysis.
+
+    Returns:
+        dict: The reused analysis (image moved to PROCESSED_FOLDER), or None to analyze the image
+    """
+    near = get_content_index().find_near(hashes['phash'])
+    if near is None:
+        return None
+    original_name, _, distance = near
+    hashes.update(near_duplicate_of=original_name, duplicate_distance=distance)
+    print(f"{image_name} is a near-duplicate of {original_name} (pHash distance {distance})", flush=True)
+
+    original = journal.get(original_name)
+    if not REUSE_NEAR_DUPLICATE_ANALYSIS or not original or not original["analysis"]:
+        return None
+    return dict(original["analysis"], image_path=move_to_processed(image_path))
+
+
+async def run_ingestion_steps(session, journal, image_name, writer=None):
+    """
+    Move one image through the journal states, resuming from the state it was left in.
+
+    Args:
+        session (aiohttp.ClientSession): Session used to call the analysis endpoint
+        journal (IngestionJournal): Journal recording the state of each image
+        image_name (str): File name of the image
+        writer (ImageBatchWriter): Optional batch writer, when given the image is queued for
+            a batched write and stored once its batch is flushed
+
+    New images whose content is already stored are linked to the stored image instead.
+
+    Returns:
+        str: The image id
+
+    Raises:
+        UnreadableImageError: If the file is not an image, it is left in IMAGE_FOLDER
+            and never recorded in the journal
+    """
+    entry = journal.get(image_name)
+    if entry is None or entry["state"] == PENDING:
+        image_path = pending_image_path(image_name)
+        hashes = await asyncio.to_thread(image_hashes, image_path)
+        if entry is None:
+            duplicate_id = link_exact_duplicate(image_name, image_path, hashes)
+            if duplicate_id is not None:
+                return duplicate_id
+
+    entry = journal.add_pending(image_name)
+    image_id = entry["image_id"]
+
+    if entry["state"] == PENDING:
+        result = near_duplicate_analysis(journal, image_name, image_path, hashes)
+        if result is None:
+            result = await process_single_image(session, image_path)
+        if not result:
+            journal.mark(image_name, PENDING, error="analysis failed")
+            raise Exception("analysis failed")
+        result.update(hashes)
+
+        journal.mark(image_name, ANALYZED, analysis=result)
+        entry.update(state=ANALYZED, analysis=result)
+
+    record = dict(entry["analysis"] or {}, image_id=image_id, image_name=image_name)
+
+    if entry["state"] == ANALYZED:
+        if writer is not None:
+            writer.add(record)
+            return image_id
+
+        await asyncio.to_thread(
+            add_image_to_db, image_id, record['image_path'], record['objects'],
+            record['scene_description'], image_name, record['relationships']
+        )
+
+    if entry["state"] in (ANALYZED, EMBEDDED):
+        finish_ingestion(journal, [record])
+
+    return image_id
 
 
 async def ingest_single_image(image_name):
-    """Process and ingest a single image from the images folder"""
+    """
+    Process and ingest a single image from the images folder.
+    Concurrent calls for the same image wait for the same ingestion and get the same id.
+    """
+    return await ingestion_flight.do(image_name, _ingest_single_image, image_name)
+
+
+async def _ingest_single_image(image_name):
     try:
+        journal = get_journal()
+        entry = journal.get(image_name)
+        if entry and entry["state"] == STORED:
+            return entry["image_id"]
+
         image_path = f"{IMAGE_FOLDER}/{image_name}"
-        if not os.path.exists(image_path):
+        if not entry and not os.path.exists(image_path):
+            # Linked to a stored copy of the same content
+            linked_id = get_mapping_store().get_id(image_name)
+            if linked_id:
+                return linked_id
             print(f"Image {image_name} not found in server/images/")
             return None
             
         # Create processed images folder if it doesn't exist
         os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-        # Load existing mapping if it exists
-        mapping_file = "image_mapping.json"
-        if os.path.exists(mapping_file):
-            with open(mapping_file, 'r') as f:
-                image_mapping = json.load(f)
-        else:
-            image_mapping = {}
-
-        # Generate unique image ID
-        image_id = f"id{len(os.listdir(PROCESSED_FOLDER)) + 1}"
-
         async with aiohttp.ClientSession() as session:
-            result = await process_single_image(session, image_path)
-        
-
-        if result['objects'] is None:
-            print("Failed to process image in ingest_single_image, Gemini API is not working", flush=True)
-            return None
-        
-        add_image_to_db(
-            image_id, 
-            result['image_path'], 
-            result['objects'], 
-            result['scene_description'], 
-            image_name, 
-            result['relationships']
-        )
-         
-        
-        image_mapping[image_name] = image_id
-        
-        with open(mapping_file, 'w') as f:
-            json.dump(image_mapping, f, indent=4)
-        
-        return image_id
+            return await run_ingestion_steps(session, journal, image_name)
         
     except Exception as e:
         print(f"Error ingesting image: {e}")
@@ -180,62 +373,117 @@ async def ingest_single_image(image_name):
 
 
 
-async def process_images():
+async def process_images(workers=INGESTION_WORKERS, rate_limiter=None, batch_size=INGESTION_BATCH_SIZE,
+                         analysis_batch_size=ANALYSIS_BATCH_SIZE):
+    """
+    Analyze and ingest every image in IMAGE_FOLDER with concurrent, rate-limited workers.
+    Analyzed images are embedded and written to the collection in batches of `batch_size`.
+    With `analysis_batch_size` > 1, images are analyzed in groups of that size with one
+    model call per group, images of a group that fail are analyzed one by one.
+    Images left unfinished by a previous run are resumed from their journal state, and
+    images that still fail after retries are written to DEAD_LETTER_FILE.
+    """
     # Create processed images folder if it doesn't exist
     os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-    # Load existing mapping if it exists
-    mapping_file = "image_mapping.json"
-    if os.path.exists(mapping_file):
-        with open(mapping_file, 'r') as f:
-            image_mapping = json.load(f)
-    else:
-        image_mapping = {}
-
-    id_to_name_file = "id_to_name_mapping.json" 
-    if os.path.exists(id_to_name_file):
-        with open(id_to_name_file, 'r') as f:
-            id_to_name = json.load(f)
-    else:
-        id_to_name = {}
-
-    cur_dataset_size = len(list(Path(PROCESSED_FOLDER).iterdir())) + 1
-    # Get list of images to process
-    image_files = [
-        f for f in Path(IMAGE_FOLDER).iterdir()
-        if f.suffix.lower() in SUPPORTED_FORMATS
-    ]
+    journal = get_journal()
+
+    # Unfinished images from a previous run first, then new images
+    image_names = [entry["image_name"] for entry in journal.unfinished()]
+    queued = set(image_names)
+    for f in Path(IMAGE_FOLDER).iterdir():
+        if f.suffix.lower() not in SUPPORTED_FORMATS or f.name in queued:
+            continue
+        entry = journal.get(f.name)
+        if entry and entry["state"] == STORED:
+            print(f"Skipping {f.name}, already ingested as {entry['image_id']}")
+            continue
+        image_names.append(f.name)
     
-    if len(image_files) == 0:
+    if len(image_names) == 0:
         print("No images found to process! Maybe you need to run get_dataset.py first")
         return
 
-    # Process images concurrently
+    writer = ImageBatchWriter(
+        batch_size=batch_size,
+        on_flush=lambda records: finish_ingestion(journal, records)
+    )
+
     async with aiohttp.ClientSession() as session:
-        # Process images one at a time
-        for image_path in image_files:
-            image_name = os.path.basename(image_path)
-            result = await process_single_image(session, str(image_path))  # Use actual image path
-            if not result:
-                print(f"Error processing {image_path}")
-                return None  # Continue with next image instead of returning None
-            
-            image_id = "id" + str(cur_dataset_size)
-            add_image_to_db(image_id, result['image_path'], result['objects'], result['scene_description'], image_name, result['relationships'])
-            
-            # Add to mapping
-            image_mapping[image_name] = image_id
-            id_to_name[image_id] = image_name
-            
-            # Save mapping after each image
-            with open(mapping_file, 'w') as f:
-                json.dump(image_mapping, f, indent=4)
-            
-            print(cur_dataset_size)
-            cur_dataset_size += 1
-            sleep(10)
-    
-    print(f"Processed {cur_dataset_size} images successfully")
+        queued_ids = {}
+
+        async def ingest(image_name):
+            # A retried group must not queue its already written images again
+            if image_name in queued_ids:
+                return queued_ids[image_name]
+            image_id = await run_ingestion_steps(session, journal, image_name, writer)
+            queued_ids[image_name] = image_id
+            print(image_id, flush=True)
+            return image_id
+
+        def needs_model(image_name):
+            entry = journal.get(image_name)
+            return entry is None or entry["state"] == PENDING
+
+        # Images of a group that failed with their last error, and those not worth retrying
+        failed = {}
+        rejected = set()
+
+        if analysis_batch_size > 1:
+            async def ingest_group(group):
+                # Failures are kept per image, so one bad image doesn't hold back the rest of its group
+                retry = None
+                try:
+                    await analyze_batch(session, journal, group)
+                except RetryableError as e:
+                    failed.update((image_name, str(e)) for image_name in group if image_name not in queued_ids)
+                    raise
+                except Exception as e:
+                    print(f"Error analyzing group {group}, analyzing its images one by one: {e}", flush=True)
+                for image_name in group:
+                    if image_name in queued_ids or image_name in rejected:
+                        continue
+                    try:
+                        await ingest(image_name)
+                        failed.pop(image_name, None)
+                    except RetryableError as e:
+                        failed[image_name] = str(e)
+                        retry = e
+                    except Exception as e:
+                        print(f"Error processing {image_name}: {e}", flush=True)
+                        failed[image_name] = str(e)
+                        rejected.add(image_name)
+                if retry is not None:
+                    # The group is retried, its written and rejected images are skipped
+                    raise retry
+                return [queued_ids.get(image_name) for image_name in group]
+
+            items = [tuple(image_names[i:i + analysis_batch_size]) for i in range(0, len(image_names), analysis_batch_size)]
+            handler = ingest_group
+            group_needs_model = lambda group: any(needs_model(image_name) for image_name in group)
+        else:
+            items, handler, group_needs_model = image_names, ingest, needs_model
+
+        scheduler = IngestionScheduler(
+            handler, workers=workers, rate_limiter=rate_limiter or RateLimiter(),
+            tokens_per_item=TOKENS_PER_IMAGE * analysis_batch_size, needs_model=group_needs_model
+        )
+        _, dead_letters = await scheduler.run(items)
+        await writer.close()
+
+    if analysis_batch_size > 1:
+        # Dead-lettered per image rather than per group
+        dead_letters = [{"item": image_name, "error": error} for image_name, error in failed.items()]
+    dead_letters += writer.failed
+    if dead_letters:
+        with open(DEAD_LETTER_FILE, 'w') as f:
+            json.dump(dead_letters, f, indent=4)
+        print(f"{len(dead_letters)} images failed, see {DEAD_LETTER_FILE}")
+
+    processed = len(queued_ids) - len(writer.failed)
+    images_per_minute = processed * 60.0 / scheduler.elapsed if scheduler.elapsed else 0.0
+    print(f"Processed {processed} images successfully ({images_per_minute:.1f} images/min, {scheduler.retries} retries)")
+    print(f"Journal: {journal.counts()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+import os
+import time
+import random
+import asyncio
+
+
+# Model quotas and worker count used by the ingestion scheduler
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "4"))
+MODEL_RPM = float(os.getenv("MODEL_RPM", "15"))
+MODEL_TPM = float(os.getenv("MODEL_TPM", "1000000"))
+TOKENS_PER_IMAGE = int(os.getenv("TOKENS_PER_IMAGE", "1500"))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """Raised by a handler when the item can be retried later (429 or 5xx from the model)"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class TokenBucket:
+    """
+    Token bucket that refills `rate` tokens per second up to `capacity`.
+    acquire() waits until enough tokens are available.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Respects both the requests-per-minute and tokens-per-minute quotas of the model"""
+
+    def __init__(self, rpm=MODEL_RPM, tpm=MODEL_TPM):
+        self.requests = TokenBucket(rpm / 60.0, max(1.0, rpm / 60.0))
+        self.tokens = TokenBucket(tpm / 60.0, tpm / 60.0) if tpm else None
+
+    async def acquire(self, tokens=TOKENS_PER_IMAGE):
+        await self.requests.acquire()
+        if self.tokens:
+            await self.tokens.acquire(tokens)
+
+
+class IngestionScheduler:
+    """
+    Runs an async handler over many items with a fixed number of workers, a shared rate
+    limiter and exponential backoff on retryable errors. Items that still fail are put on
+    a dead-letter list instead of aborting the whole run.
+
+    Args:
+        handler (callable): async function(item) returning the item's result
+        workers (int): Number of concurrent workers
+        rate_limiter (RateLimiter): Limiter shared by all workers, None to disable
+        max_retries (int): Retries for a retryable error before giving up
+        base_delay (float): First backoff delay in seconds, doubled on each retry
+        max_delay (float): Upper bound for a single backoff delay
+        tokens_per_item (int): Estimated model tokens used by one item
+        needs_model (callable): Optional predicate, items for which it returns False
+            don't call the model and skip the rate limiter
+    """
+
+    def __init__(self, handler, workers=INGESTION_WORKERS, rate_limiter=None,
+                 max_retries=5, base_delay=1.0, max_delay=60.0, tokens_per_item=TOKENS_PER_IMAGE,
+                 needs_model=None):
+        self.handler = handler
+        self.needs_model = needs_model
+        self.workers = workers
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokens_per_item = tokens_per_item
+
+        self.results = []
+        self.dead_letters = []
+        self.retries = 0
+        self.elapsed = 0.0
+
+    def backoff(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _process(self, item):
+        attempt = 0
+        while True:
+            if self.rate_limiter and (self.needs_model is None or self.needs_model(item)):
+                await self.rate_limiter.acquire(self.tokens_per_item)
+            try:
+                return await self.handler(item)
+            except RetryableError as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retries += 1
+                delay = self.backoff(attempt)
+                print(f"Retrying {item} in {delay:.1f}s ({e})", flush=True)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _worker(self, queue):
+        while True:
+            item = await queue.get()
+            try:
+                self.results.append((item, await self._process(item)))
+            except Exception as e:
+                print(f"Error processing {item}: {e}", flush=True)
+                self.dead_letters.append({"item": str(item), "error": str(e)})
+            finally:
+                queue.task_done()
+
+    async def run(self, items):
+        """
+        Process all items.
+
+        Returns:
+            tuple: (results, dead_letters)
+                - results: List of (item, result) for the items that succeeded
+                - dead_letters: List of {"item", "error"} for the items that failed
+        """
+        start = time.perf_counter()
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        self.elapsed = time.perf_counter() - start
+        return self.results, self.dead_letters
+
+    def throughput(self):
+        """Successfully processed items per minute during the last run"""
+        return len(self.results) * 60.0 / self.elapsed if self.elapsed else 0.0
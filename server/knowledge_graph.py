@@ -1,11 +1,5 @@
 import networkx as nx
-import spacy
 from context_integration import analyze_image
-import plotly.graph_objects as go
-import plotly.express as px
-
-# Initialize global dependencies
-nlp = spacy.load("en_core_web_sm")
 
 def build_scene_graph(scene_analysis):
     """
@@ -111,6 +105,8 @@ def visualize_scene_graph(graph):
     Args:
         graph (nx.DiGraph): Scene knowledge graph
     """
+    import plotly.graph_objects as go
+
     # Get node positions using networkx spring layout
     pos = nx.spring_layout(graph)
     
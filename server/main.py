@@ -1,20 +1,23 @@
 from fastapi import FastAPI, UploadFile, HTTPException, Form, File, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import base64
 import os
 import json
 import asyncio
 from typing import Optional, List
-from context_integration import analyze_image, generate_inference, get_inference_from_context_integration
-from reasoning_loop import generate_enhanced_inference, store_inference_feedback
-from google import genai
-from google.genai.types import Part, PartDict
-from ingestion_pipeline import ingest_single_image
-from prompts import IMAGE_ANALYSIS_PROMPT
+from context_integration import analyze_image, generate_inference, get_inference_from_context_integration, generate_inference_stream, stream_inference_from_context_integration
+from reasoning_loop import generate_enhanced_inference, store_inference_feedback, create_enhanced_prompt, read_image, timed_stage
+from ingestion_pipeline import ingest_single_image, ingestion_flight
+from single_flight import SingleFlight
+from image_mapping_store import get_mapping_store
+from image_preprocessing import get_image_preprocessor
+import inference_service
 from fastapi.staticfiles import StaticFiles
+import model_registry
+from vector_db import get_analysis_cache
 import sys
 
 # Load environment variables
@@ -37,31 +40,56 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure Gemini
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    raise HTTPException(status_code=500, detail="API key not configured")
+# Configure the model backend (Gemini by default, INFERENCE_BACKEND=fake for local runs)
+inference_service.get_backend()
 
-client = genai.Client(api_key=api_key)
-chat = client.chats.create(model='gemini-2.0-flash')
+# Concurrency limit and timeout (seconds) for the model calls of each endpoint
+inference_service.configure_endpoint("/analyze/all", concurrency=8, timeout=60)
+inference_service.configure_endpoint("/analyze/relationships/image", concurrency=4, timeout=90)
+inference_service.configure_endpoint("/analyze/relationships/images", concurrency=2, timeout=180)
+inference_service.configure_endpoint("/analyze/text", concurrency=8, timeout=30)
+inference_service.configure_endpoint("inference", concurrency=8, timeout=60)
+
+# Concurrent basic inference requests for the same image share one analysis
+analysis_flight = SingleFlight("analysis")
+
+# Set WARM_UP_MODELS=1 to load the embedding model and DB at startup instead of on the first request
+WARM_UP_MODELS = os.getenv("WARM_UP_MODELS", "0") == "1"
 
 # Constants
 PROCESSED_FOLDER = "processed_images"
 IMAGE_FOLDER = "images"
 
-# Load image mappings
-name_to_id = {}
+# Image name <-> id mapping shared with the ingestion scripts
+image_mapping = get_mapping_store()
 
-try:
-    
-    with open('image_mapping.json', 'r') as f:
-        name_to_id = json.load(f)
-except Exception as e:
-    print(f"Error loading mappings: {e}")
+# Headers for server-sent event responses, also disabling proxy buffering so events go out right away
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+async def stream_tokens(chunks):
+    """Forward model chunks as token events, then send the full text in a done event"""
+    text = []
+    async for chunk in chunks:
+        text.append(chunk)
+        yield sse_event("token", {"text": chunk})
+    if not "".join(text):
+        raise RuntimeError("Failed to generate inference")
+    yield sse_event("done", {"text": "".join(text)})
+
+def error_status(e):
+    """HTTP status for a model error, keeps 429/5xx from the API so clients can retry"""
+    code = getattr(e, "code", None)
+    return code if isinstance(code, int) and 400 <= code < 600 else 500
 
 # Pydantic models
 class TextRequest(BaseModel):
     text: str
+    session_id: Optional[str] = None
+    no_cache: bool = False
 
 class ExistingImageRequest(BaseModel):
     filename: str
@@ -81,6 +109,12 @@ class EnhancedInferenceRequest(BaseModel):
 class UploadUrlRequest(BaseModel):
     fileName: str
 
+@app.on_event("startup")
+async def warm_up_models():
+    if WARM_UP_MODELS:
+        loaded = await asyncio.to_thread(model_registry.warm_up)
+        print(f"Warmed up: {', '.join(loaded)}", flush=True)
+
 @app.get("/files")
 async def get_files():
     """Return list of available image files"""
@@ -98,18 +132,15 @@ async def basic_inference(request: ExistingImageRequest):
     """Inference on an image using relationships stored in the vector database"""
     try:
         filename = request.filename
-        image_id = "-1"
-        if filename in name_to_id:
-            image_id = name_to_id[filename]
-        else:
+        image_id = image_mapping.get_id(filename)
+        if image_id is None:
             image_id = await ingest_single_image(filename)
-            name_to_id[filename] = image_id
 
-        if image_id == "-1":
+        if image_id is None:
             raise HTTPException(status_code=400, detail="Failed to process image into the database. please retry.")
             
-        # Get scene analysis\
-        scene_analysis = analyze_image(image_id)
+        # Get scene analysis, shared by concurrent requests for the same image
+        scene_analysis = await analysis_flight.do(image_id, asyncio.to_thread, analyze_image, image_id)
         
 
         if scene_analysis is None or not scene_analysis['typical_relationships']:
@@ -127,6 +158,37 @@ async def basic_inference(request: ExistingImageRequest):
         print(f"Full error details: {e}", flush=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/inference/basic/stream")
+async def basic_inference_stream(request: ExistingImageRequest):
+    """
+    /inference/basic as server-sent events: a scene_analysis event as soon as the analysis
+    is ready, token events as the model generates the inference, then a done event with
+    the full text. Failures after the stream started are sent as an error event.
+    """
+    filename = request.filename
+    image_id = image_mapping.get_id(filename)
+    if image_id is None:
+        image_id = await ingest_single_image(filename)
+
+    if image_id is None:
+        raise HTTPException(status_code=400, detail="Failed to process image into the database. please retry.")
+
+    async def events():
+        try:
+            scene_analysis = await analysis_flight.do(image_id, asyncio.to_thread, analyze_image, image_id)
+            if scene_analysis is None or not scene_analysis['typical_relationships']:
+                yield sse_event("error", {"detail": "Failed to analyze image. please retry"})
+                return
+            yield sse_event("scene_analysis", scene_analysis)
+
+            async for event in stream_tokens(stream_inference_from_context_integration(scene_analysis, image_id)):
+                yield event
+        except Exception as e:
+            print(f"Error in basic inference stream: {str(e)}", flush=True)
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.post("/inference/enhanced")
 async def enhanced_inference(request: EnhancedInferenceRequest):
     """Inference on an image using relationships(from image) and feedback(from users) stored in the vector database"""
@@ -135,7 +197,7 @@ async def enhanced_inference(request: EnhancedInferenceRequest):
         scene_analysis = request.scene_analysis
         feedback_id = request.feedback_id
         
-        if filename not in name_to_id:
+        if filename not in image_mapping:
             raise HTTPException(status_code=400, detail=f"Image not found: {filename}")
         
         image_path = f"{PROCESSED_FOLDER}/{filename}"
@@ -143,10 +205,12 @@ async def enhanced_inference(request: EnhancedInferenceRequest):
             raise HTTPException(status_code=400, detail=f"Image file not found at {image_path}")
         
         # Get enhanced analysis
+        timings = {}
         result, relevant_patterns, relationship_keys = await generate_enhanced_inference(
             feedback_id=feedback_id,
             scene_context=scene_analysis,
-            image_path=image_path
+            image_path=image_path,
+            timings=timings
         )
         
         if not result:
@@ -155,7 +219,8 @@ async def enhanced_inference(request: EnhancedInferenceRequest):
         return {
             "text": result,
             "relevant_patterns": relevant_patterns,
-            "relationship_keys": relationship_keys
+            "relationship_keys": relationship_keys,
+            "timings_ms": timings
         }
         
     except Exception as e:
@@ -163,71 +228,123 @@ async def enhanced_inference(request: EnhancedInferenceRequest):
         print(f"Full error details: ", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/inference/enhanced/stream")
+async def enhanced_inference_stream(request: EnhancedInferenceRequest):
+    """
+    /inference/enhanced as server-sent events: a patterns event with the relevant patterns
+    and relationship keys, token events as the model generates the inference, then a
+    done event with the full text. Failures after the stream started are sent as an error event.
+    """
+    filename = request.filename
+    if filename not in image_mapping:
+        raise HTTPException(status_code=400, detail=f"Image not found: {filename}")
+
+    image_path = f"{PROCESSED_FOLDER}/{filename}"
+    if not os.path.exists(image_path):
+        raise HTTPException(status_code=400, detail=f"Image file not found at {image_path}")
+
+    async def events():
+        try:
+            # The image is read while the patterns are retrieved and the prompt is built
+            timings = {}
+            (enhanced_prompt, relevant_patterns, relationship_keys), image_bytes = await asyncio.gather(
+                create_enhanced_prompt(request.feedback_id, request.scene_analysis, timings),
+                timed_stage(timings, "image_read", read_image(image_path))
+            )
+            yield sse_event("patterns", {
+                "relevant_patterns": relevant_patterns,
+                "relationship_keys": relationship_keys,
+                "timings_ms": timings
+            })
+
+            async for event in stream_tokens(generate_inference_stream(enhanced_prompt, image_path, image_bytes)):
+                yield event
+        except Exception as e:
+            print(f"Error in enhanced inference stream: {str(e)}", flush=True)
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.post("/analyze/all")
-async def inference(image: UploadFile, text: str = Form()):
+async def inference(image: UploadFile, text: str = Form(), session_id: Optional[str] = Form(None),
+                    no_cache: bool = Form(False)):
     try:
         # Read the image file
         image_contents = await image.read()
-       
-        message = [
-            Part(text=text),
-            Part(
-                inline_data=PartDict(
-                    mime_type="image/jpeg",
-                    data=base64.b64encode(image_contents).decode('utf-8')
-                )
-            )
-        ]
-        
-        response = chat.send_message(message)
-        return response.text
 
+        return await inference_service.generate(
+            text, image_contents, endpoint="/analyze/all", session_id=session_id, use_cache=not no_cache
+        )
+
+    except inference_service.InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=error_status(e), detail=str(e))
 
 @app.post("/analyze/relationships/image")
-async def analyze_image_route(image: UploadFile):
+async def analyze_image_route(image: UploadFile, no_cache: bool = Form(False)):
     """Analyze a newly uploaded image and derive relationships"""
     try:
         
         image_contents = await image.read()
+
+        return await inference_service.generate_analysis(
+            image_contents, endpoint="/analyze/relationships/image", use_cache=not no_cache
+        )
         
-        message = [
-            Part(text=IMAGE_ANALYSIS_PROMPT),
-            Part(
-                inline_data=PartDict(
-                    mime_type="image/jpeg",
-                    data=base64.b64encode(image_contents).decode('utf-8')
-                )
-            )
-        ]
-        
-        response = chat.send_message(message)
-        
-        # For demo purposes, we'll just use the same analysis twice
-        # In a real implementation, you'd process the image through your pipeline
-        # and generate the enhanced analysis with few-shot learning
-        
-        return response.text
-        
+    except inference_service.InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except inference_service.AnalysisParseError as e:
+        raise HTTPException(status_code=422, detail=f"Could not parse the image analysis: {e}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=error_status(e), detail=str(e))
+
+@app.post("/analyze/relationships/images")
+async def analyze_images_route(images: List[UploadFile] = File(...), no_cache: bool = Form(False)):
+    """Analyze several uploaded images with one model call, returns one analysis per image in upload order"""
+    try:
+        image_contents = [await image.read() for image in images]
+
+        analyses = await inference_service.analyze_images(
+            image_contents, endpoint="/analyze/relationships/images", use_cache=not no_cache
+        )
+        return {"analyses": analyses}
+
+    except inference_service.InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=error_status(e), detail=str(e))
 
 @app.post("/analyze/text")
 async def analyze_text(request: TextRequest):
     try:
-        response = chat.send_message(request.text)
-        return {"analysis": response.text}
+        analysis = await inference_service.generate(
+            request.text, endpoint="/analyze/text", session_id=request.session_id, use_cache=not request.no_cache
+        )
+        return {"analysis": analysis}
+    except inference_service.InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics")
+async def get_metrics():
+    """Token and latency metrics of the model calls and cache hit rates since startup"""
+    return {
+        "inference": inference_service.metrics.snapshot(),
+        "response_cache": inference_service.get_response_cache().snapshot() if inference_service.RESPONSE_CACHE else None,
+        "single_flight": {flight.name: flight.snapshot() for flight in (ingestion_flight, analysis_flight)},
+        "analysis_cache": get_analysis_cache().snapshot() if model_registry.is_loaded("analysis_cache") else None,
+        "image_preprocessing": get_image_preprocessor().snapshot() if get_image_preprocessor() else None
+    }
+
 @app.post("/feedback")
 async def submit_feedback(request: FeedbackRequest):
     """Store user feedback on analyses"""
     try:
         # Find image ID from filename
         
-        image_id = name_to_id[request.filename]
+        image_id = image_mapping.get_id(request.filename)
         
         if not image_id:
             raise HTTPException(status_code=400, detail="Image not found")
@@ -0,0 +1,50 @@
+import threading
+
+
+_factories = {}
+_instances = {}
+# One lock per name, so a factory can get() the singletons it depends on
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def register(name, factory):
+    """
+    Register a factory for a lazily created singleton (embedding model, DB client...).
+    Nothing is loaded until get(name) is called.
+    """
+    _factories[name] = factory
+
+
+def get(name):
+    """Return the singleton for `name`, creating it on first use"""
+    instance = _instances.get(name)
+    if instance is not None:
+        return instance
+
+    if name not in _factories:
+        raise KeyError(f"No model registered under {name}")
+    with _locks_lock:
+        lock = _locks.setdefault(name, threading.Lock())
+
+    with lock:
+        if name not in _instances:
+            _instances[name] = _factories[name]()
+        return _instances[name]
+
+
+def is_loaded(name):
+    return name in _instances
+
+
+def warm_up(names=None):
+    """
+    Load the given singletons (all registered ones by default) ahead of the first request.
+
+    Returns:
+        list: Names that were loaded
+    """
+    names = list(_factories) if names is None else names
+    for name in names:
+        get(name)
+    return names
@@ -1,3 +1,13 @@
+IMAGE_ANALYSIS_RULES = """
+            Important: 
+            Include spatial relationships limited to: on top of, in, on, under, inside, above, below, next to, near, far from, in front of, behind, contains, within, on the edge of, between, in the middle of.
+            functional relationships is up to you to determine based on the image.
+            state relationships limited to: stable, unstable, moving, stationary, open, closed, empty, full, secure, loose, flat, tilted, resting, hanging, level, uneven, grounded, suspended, confined, free, attached, detached, aligned, misaligned.
+            contextual relationships limited to: atypical, typical.
+            confidence score between 0 and 1 on how confident you are about the relationship.
+            scene_annotation is a brief scene description at the end.
+            """
+
 IMAGE_ANALYSIS_PROMPT = """
             Analyze this image and extract objects and their relationships. Provide your response in the JSON format below, this is just an example of the format:
 
@@ -19,15 +29,61 @@ IMAGE_ANALYSIS_PROMPT = """
                 ],
                 "scene_annotation": "Office workspace with interrupted activity"
             }
+""" + IMAGE_ANALYSIS_RULES
 
-            Important: 
-            Include spatial relationships limited to: on top of, in, on, under, inside, above, below, next to, near, far from, in front of, behind, contains, within, on the edge of, between, in the middle of.
-            functional relationships is up to you to determine based on the image.
-            state relationships limited to: stable, unstable, moving, stationary, open, closed, empty, full, secure, loose, flat, tilted, resting, hanging, level, uneven, grounded, suspended, confined, free, attached, detached, aligned, misaligned.
-            contextual relationships limited to: atypical, typical.
-            confidence score between 0 and 1 on how confident you are about the relationship.
-            scene_annotation is a brief scene description at the end.
-            """
+# Several images analyzed in one request, so the instructions are paid once per batch
+BATCH_IMAGE_ANALYSIS_PROMPT = """
+            You are given {count} images. Analyze each image separately and extract its objects and their relationships. Provide your response as a JSON array with exactly one entry per image, in the same order as the images, this is just an example of the format:
+
+            [
+                {
+                    "image_index": 1,
+                    "objects": [
+                        {"label": "coffee mug", "attributes": ["white", "ceramic", "full"]},
+                        {"label": "desk", "attributes": ["wooden", "office"]}
+                    ],
+                    "relationships": [
+                        {
+                            "subject": "coffee mug",
+                            "object": "desk",
+                            "spatial": "on edge of",
+                            "functional": "on",
+                            "state": "unstable position", // state of the subject relative to the object
+                            "contextual": "atypical", // could be atypical, typical
+                            "confidence": 0.95
+                        }
+                    ],
+                    "scene_annotation": "Office workspace with interrupted activity"
+                }
+            ]
+
+            image_index is the position of the image in the request, starting at 1. Never mix objects or relationships of different images.
+""" + IMAGE_ANALYSIS_RULES
+
+def get_batch_analysis_prompt(count):
+    return BATCH_IMAGE_ANALYSIS_PROMPT.replace("{count}", str(count))
+
+def get_analysis_repair_prompt(response):
+    return f"""
+    The text below was meant to be an image analysis in JSON, with "objects" (label and attributes),
+    "relationships" (subject, object, spatial, functional, state, contextual and confidence) and
+    "scene_annotation", but it could not be parsed.
+    Rewrite it as valid JSON with exactly these fields, keeping its content. Do not add objects or
+    relationships that are not in the text.
+
+    Text:
+    {response}
+    """
+
+def format_relationship_statistics(statistics):
+    lines = []
+    for stat in statistics:
+        line = (f"- {stat['subject']} {stat['spatial']} {stat['object']}: "
+                f"{stat['frequency']:.1%} of all images")
+        if stat['scene']:
+            line += f", {stat['scene_frequency']:.1%} of {stat['scene_images']} similar {stat['scene']} scenes"
+        lines.append(line)
+    return "\n    ".join(lines) if lines else "none"
 
 def get_context_integration_prompt(scene_context):
     return f"""
@@ -38,8 +94,11 @@ def get_context_integration_prompt(scene_context):
     Scene type: {scene_context['scene_type']}
     Common scene elements: {scene_context.get('common_scene_elements', [])}
     Similar scene categories: {scene_context.get('similar_scene_types', [])}
+    Relationship frequencies in the database:
+    {format_relationship_statistics(scene_context.get('relationship_statistics', []))}
 
     Focus especially on the atypical relationships, as these often indicate meaningful deviations from expected patterns.
+    When a relationship is rare, you can quote its frequency (e.g. "this occurs in only 3% of similar desk scenes").
 
     Consider the common elements found across similar scenes to inform your understanding of what is normal for this type of scene.
 
@@ -1,7 +1,10 @@
 import json
+import time
+import asyncio
 from datetime import datetime
-from vector_db import add_feedback_to_db, get_feedback_by_relationships, get_similar_feedback, get_image_from_db
+from vector_db import add_feedback_to_db, get_feedback_by_relationships, get_similar_feedback, get_image_names, get_relationship_store
 from context_integration import generate_inference
+from image_buffer import get_image_buffer
 import sys
 import logging
 
@@ -90,37 +93,68 @@ def extract_relationship_keys(scene_context):
                     i+=1
     return list(keys)
 
-def find_relevant_inference_patterns(feedback_id,scene_context, limit=5):
+async def timed_stage(timings, stage, coro):
+    """Await coro, recording how long it took in milliseconds under timings[stage]"""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 2)
+
+async def find_relevant_inference_patterns(feedback_id, scene_context, limit=5, timings=None):
     """
     Find relevant inference patterns based on relationship structures.
+
+    The relationship search and the text-similarity search run concurrently, the text
+    results only filling the patterns the relationship search did not find. Image names
+    of all the results are then looked up with one batched query.
         
     Args:
         feedback_id (str): ID of the feedback entry
         scene_context (dict): Current scene context
         limit (int): Maximum number of patterns to return
+        timings (dict): Optional dict filled with the latency of each stage in milliseconds
             
         Returns:
         list: Relevant inference patterns from past analyses
     """
     print("Starting find_relevant_inference_patterns", flush=True)
+    timings = {} if timings is None else timings
     
     # Extract relationship keys from the current scene
     relationship_keys = extract_relationship_keys(scene_context)
     print(f"=== Relationship Keys we are looking for ===\n{relationship_keys}\n========================", flush=True)
     
-    # If we have relationship keys, search by relationship structure first
-    patterns = []
-    if relationship_keys:
-        rel_results = get_feedback_by_relationships(feedback_id,relationship_keys, limit)
-        # print(f"=== Relationship Results ===\n{rel_results}\n==========================", flush=True)
-        patterns = extract_patterns_from_results(rel_results)
-        print(f"Found {len(patterns)} patterns from relationships", flush=True)
+    # Search by relationship structure and by text similarity at the same time
+    async def no_results():
+        return {"ids": [[]], "metadatas": [[]]}
+
+    rel_results, text_results = await asyncio.gather(
+        timed_stage(
+            timings, "relationship_search",
+            asyncio.to_thread(get_feedback_by_relationships, feedback_id, relationship_keys, limit)
+            if relationship_keys else no_results()
+        ),
+        timed_stage(
+            timings, "text_search",
+            asyncio.to_thread(get_similar_feedback, scene_context.get("scene_type", ""), limit)
+        )
+    )
+
+    # One lookup for the image names of every result
+    image_ids = [
+        metadata.get("image_id", "")
+        for results in (rel_results, text_results) if results and results.get('metadatas')
+        for metadata in results['metadatas'][0] or []
+    ]
+    image_names = await timed_stage(timings, "image_name_lookup", asyncio.to_thread(get_image_names, image_ids))
+
+    patterns = extract_patterns_from_results(rel_results, image_names)
+    print(f"Found {len(patterns)} patterns from relationships", flush=True)
 
     # If we didn't find enough patterns by relationships, supplement with text similarity
     if len(patterns) < limit:
-        remaining = limit - len(patterns)
-        text_results = get_similar_feedback(scene_context.get("scene_type", ""), remaining)
-        text_patterns = extract_patterns_from_results(text_results)
+        text_patterns = extract_patterns_from_results(text_results, image_names)
         
         # Add only patterns we haven't already included
         existing_inferences = {p.get("inference") for p in patterns}
@@ -155,12 +189,13 @@ def find_relevant_inference_patterns(feedback_id,scene_context, limit=5):
     # print("patterns", patterns, flush=True)
     return patterns, relationship_keys
 
-def extract_patterns_from_results(results):
+def extract_patterns_from_results(results, image_names=None):
     """
     Extract clean pattern objects from ChromaDB results.
     
     Args:
         results (dict): ChromaDB results with metadatas
+        image_names (dict): image_id -> image_name, looked up in one query when not given
         
     Returns:
         list: Cleaned pattern objects
@@ -169,8 +204,12 @@ def extract_patterns_from_results(results):
     
     if not results or 'metadatas' not in results or not results['metadatas'][0]:
         return patterns
+
+    store = get_relationship_store()
+    if image_names is None:
+        image_names = get_image_names(metadata.get("image_id", "") for metadata in results['metadatas'][0])
         
-    for metadata in results['metadatas'][0]:
+    for feedback_id, metadata in zip(results['ids'][0], results['metadatas'][0]):
         try:
             # Get inference text
             inference = metadata.get("inference", "")
@@ -178,26 +217,18 @@ def extract_patterns_from_results(results):
                 inference = metadata.get("item", "")
                 print(f"No inference found for {metadata.get('image_id', 'unknown')}")
                 
-            # Parse JSON strings if needed
-            typical_rels = metadata.get("typical_relationships", "[]")
-            if isinstance(typical_rels, str):
-                typical_rels = json.loads(typical_rels)
-                
-            atypical_rels = metadata.get("atypical_relationships", "[]")
-            if isinstance(atypical_rels, str):
-                atypical_rels = json.loads(atypical_rels)
+            # Relationships are parsed once per feedback entry and kept in the store
+            typical_rels, atypical_rels = store.get_feedback(feedback_id, metadata)
 
-            image_id = metadata.get("image_id", "")
-            image_metadata = get_image_from_db(image_id)
-            image_name = image_metadata.get("metadatas", [{}])[0].get("image_name", "")
+            image_name = image_names.get(metadata.get("image_id", ""), "")
             
             # Create pattern object
             pattern = {
                 "image_name": image_name,
                 "inference": inference,
                 "scene_type": metadata.get("scene_type", ""),
-                "typical_relationships": typical_rels,
-                "atypical_relationships": atypical_rels,
+                "typical_relationships": [rel.to_dict() for rel in typical_rels],
+                "atypical_relationships": [rel.to_dict() for rel in atypical_rels],
                 "rating": float(metadata.get("rating", 0.5))
             }
             patterns.append(pattern)
@@ -226,17 +257,20 @@ def format_relationship_summary(relationship):
     
     return f"{subject}-{spatial}-{obj}"
 
-def create_enhanced_prompt(feedback_id,scene_context):
+async def create_enhanced_prompt(feedback_id, scene_context, timings=None):
     """
     Create an enhanced prompt with learned inference patterns.
     
     Args:
         feedback_id (str): ID of the feedback entry
         scene_context (dict): Current scene context
+        timings (dict): Optional dict filled with the latency of each stage in milliseconds
         
     Returns:
         str: Enhanced prompt for inference generation
     """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
     # Start with base prompt
     prompt = f"""
     Given this scene context:
@@ -249,7 +283,9 @@ def create_enhanced_prompt(feedback_id,scene_context):
     """
     
     # Find relevant patterns from past successful analyses
-    relevant_patterns, relationship_keys = find_relevant_inference_patterns(feedback_id,scene_context)
+    relevant_patterns, relationship_keys = await timed_stage(
+        timings, "retrieval", find_relevant_inference_patterns(feedback_id, scene_context, timings=timings)
+    )
     
 
 
@@ -290,26 +326,38 @@ def create_enhanced_prompt(feedback_id,scene_context):
 
     just output the 3 sentences along with your reasoning based on the visual evidence.
     """
-    
+
+    # Time spent formatting the prompt, retrieval excluded
+    timings["prompt_build"] = round((time.perf_counter() - start) * 1000 - timings["retrieval"], 2)
     return prompt, relevant_patterns, relationship_keys
 
-async def generate_enhanced_inference(feedback_id, scene_context, image_path):
+async def read_image(image_path):
+    """Map the image file, shared with other requests for it, instead of copying it into memory"""
+    return await asyncio.to_thread(get_image_buffer, image_path)
+
+async def generate_enhanced_inference(feedback_id, scene_context, image_path, timings=None):
     """
     Generate inferences with few-shot learning enhancement.
+
+    The image is read from disk while the patterns are retrieved and the prompt is built.
     
     Args:
         feedback_id (str): ID of the feedback entrys
         scene_context (dict): Scene context with objects and relationships
         image_path (str): Path to the image file
-        generate_function (function): Async function that generates inferences given prompt and image path
+        timings (dict): Optional dict filled with the latency of each stage in milliseconds
         
     Returns:
         str: Generated inferences
     """
+    timings = {} if timings is None else timings
 
-    # Create enhanced prompt with learned patterns
-    enhanced_prompt, relevant_patterns, relationship_keys = create_enhanced_prompt(feedback_id,scene_context)
-    
+    # Create enhanced prompt with learned patterns while the image is read
+    (enhanced_prompt, relevant_patterns, relationship_keys), image_bytes = await asyncio.gather(
+        create_enhanced_prompt(feedback_id, scene_context, timings),
+        timed_stage(timings, "image_read", read_image(image_path))
+    )
     
     # Call the provided generation function
-    return await generate_inference(enhanced_prompt, image_path), relevant_patterns, relationship_keys
\ No newline at end of file
+    result = await timed_stage(timings, "generation", generate_inference(enhanced_prompt, image_path, image_bytes))
+    return result, relevant_patterns, relationship_keys
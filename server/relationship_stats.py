@@ -0,0 +1,237 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+
+STATS_FILE = "relationship_stats.db"
+
+# "exact" keeps exact counters, "sketch" stores the high-cardinality triple counts in
+# count-min sketches, "auto" picks sketch when the corpus is larger than SKETCH_THRESHOLD
+STATS_MODE = os.getenv("STATS_MODE", "auto")
+SKETCH_THRESHOLD = int(os.getenv("STATS_SKETCH_THRESHOLD", "500000"))
+SKETCH_WIDTH = 2 ** 18
+SKETCH_DEPTH = 4
+
+# Pseudo-count of the prior used to calibrate scene frequencies with few observations
+PRIOR_STRENGTH = 5.0
+
+# Triple counts are the high-cardinality ones, the marginals always stay exact
+SKETCHED_KINDS = {"triple", "triple_scene"}
+
+SCENE_STOPWORDS = {
+    "a", "an", "the", "with", "and", "or", "of", "in", "on", "at", "to", "for", "by", "from",
+    "some", "several", "various", "its", "their", "his", "her", "is", "are", "being", "has",
+    "scene", "image", "photo", "view", "setting", "area", "showing", "shows", "featuring",
+    "indoor", "outdoor", "interrupted", "activity", "while", "near", "into", "up", "down",
+}
+
+
+def normalize(value):
+    return " ".join(str(value).lower().split())
+
+
+def triple_key(rel):
+    return f"{normalize(rel['subject'])}|{normalize(rel['spatial'])}|{normalize(rel['object'])}"
+
+
+def scene_tags(description):
+    """Content words of a scene description, used as scene types ("desk", "kitchen"...)"""
+    words = re.findall(r"[a-z]+", description.lower())
+    return sorted({word for word in words if len(word) > 2 and word not in SCENE_STOPWORDS})
+
+
+class CountMinSketch:
+    """Count-min sketch: fixed memory, never under-counts, over-counts by a bounded error"""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else np.zeros((depth, width), dtype=np.uint32)
+
+    def _columns(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8 * self.depth).digest()
+        return [int.from_bytes(digest[8 * row:8 * row + 8], "little") % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        for row, column in enumerate(self._columns(key)):
+            self.table[row, column] += count
+
+    def estimate(self, key):
+        return int(min(self.table[row, column] for row, column in enumerate(self._columns(key))))
+
+
+class RelationshipStats:
+    """
+    Dataset-wide relationship frequency statistics, updated incrementally on ingestion.
+
+    Counts the number of images containing each (subject, spatial, object) triple, each
+    triple per scene type, each scene type, and each subject and object. Every image is
+    counted once, so re-ingesting an image does not inflate the counts. Lookups are O(1)
+    primary-key reads (or sketch reads), no neighbour scan is needed.
+    """
+
+    def __init__(self, path=STATS_FILE, mode=STATS_MODE, corpus_size=0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS images (image_id TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS counts (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY(kind, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS sketches (kind TEXT PRIMARY KEY, data BLOB, version INTEGER);
+        """)
+
+        stored_mode = self._meta("mode")
+        if stored_mode is None:
+            # The mode is fixed when the store is created, switching would need a rebuild
+            if mode == "auto":
+                mode = "sketch" if corpus_size > SKETCH_THRESHOLD else "exact"
+            with self._conn:
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('mode', ?)", (mode,))
+            stored_mode = mode
+        self.mode = stored_mode
+
+        self._sketches = {}
+        self._sketch_versions = {}
+
+    def _meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        return self.count("image", "")
+
+    def _sketch(self, kind):
+        """In-memory sketch of a kind, reloaded when another process saved a newer one"""
+        row = self._conn.execute("SELECT version FROM sketches WHERE kind = ?", (kind,)).fetchone()
+        version = row[0] if row else 0
+        if kind not in self._sketches or self._sketch_versions.get(kind) != version:
+            table = None
+            if row:
+                data = self._conn.execute("SELECT data FROM sketches WHERE kind = ?", (kind,)).fetchone()[0]
+                table = np.frombuffer(data, dtype=np.uint32).reshape(SKETCH_DEPTH, SKETCH_WIDTH).copy()
+            self._sketches[kind] = CountMinSketch(table=table)
+            self._sketch_versions[kind] = version
+        return self._sketches[kind]
+
+    def add_image(self, image_id, description, relationships):
+        """
+        Count one image. Returns False if the image was already counted.
+
+        Args:
+            image_id (str): ID of the image
+            description (str): Scene description, split into scene tags
+            relationships (list): Relationships of the image (dicts or store records)
+        """
+        return self.add_images([(image_id, description, relationships)]) > 0
+
+    def add_images(self, images):
+        """Count several (image_id, description, relationships) in one transaction"""
+        with self._lock, self._conn:
+            increments = {}
+            added = 0
+            for image_id, description, relationships in images:
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO images (image_id) VALUES (?)", (image_id,)
+                ).rowcount
+                if not inserted:
+                    continue
+                added += 1
+
+                tags = scene_tags(description or "")
+                keys = {("image", "")}
+                keys.update(("scene", tag) for tag in tags)
+                for rel in relationships:
+                    triple = triple_key(rel)
+                    keys.add(("triple", triple))
+                    keys.add(("subject", normalize(rel['subject'])))
+                    keys.add(("object", normalize(rel['object'])))
+                    keys.update(("triple_scene", f"{triple}|{tag}") for tag in tags)
+                for key in keys:
+                    increments[key] = increments.get(key, 0) + 1
+
+            sketched = {}
+            for (kind, key), count in increments.items():
+                if self.mode == "sketch" and kind in SKETCHED_KINDS:
+                    sketched.setdefault(kind, []).append((key, count))
+                    continue
+                self._conn.execute(
+                    "INSERT INTO counts (kind, key, count) VALUES (?, ?, ?) "
+                    "ON CONFLICT(kind, key) DO UPDATE SET count = count + excluded.count",
+                    (kind, key, count)
+                )
+
+            for kind, updates in sketched.items():
+                sketch = self._sketch(kind)
+                for key, count in updates:
+                    sketch.add(key, count)
+                version = self._sketch_versions[kind] + 1
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sketches (kind, data, version) VALUES (?, ?, ?)",
+                    (kind, sketch.table.tobytes(), version)
+                )
+                self._sketch_versions[kind] = version
+            return added
+
+    def count(self, kind, key):
+        """Number of images counted under (kind, key)"""
+        if self.mode == "sketch" and kind in SKETCHED_KINDS:
+            with self._lock:
+                return self._sketch(kind).estimate(key)
+        row = self._conn.execute("SELECT count FROM counts WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else 0
+
+    def relationship_frequency(self, rel, description):
+        """
+        Frequency of a relationship in the whole dataset and among images of the same scene type.
+
+        The scene type is the tag of the description seen in the most images. The
+        typicality score is the scene frequency shrunk towards the global frequency, so
+        rare scene types with few images don't produce extreme values.
+
+        Returns:
+            dict: subject, spatial, object, images (containing the triple), frequency,
+                scene, scene_images, scene_frequency and typicality
+        """
+        total = len(self)
+        triple = triple_key(rel)
+        triple_count = self.count("triple", triple)
+        frequency = triple_count / total if total else 0.0
+
+        scene, scene_total = "", 0
+        for tag in scene_tags(description or ""):
+            tag_count = self.count("scene", tag)
+            if tag_count > scene_total:
+                scene, scene_total = tag, tag_count
+
+        scene_count = min(self.count("triple_scene", f"{triple}|{scene}"), scene_total) if scene else 0
+        scene_frequency = scene_count / scene_total if scene_total else frequency
+        typicality = (scene_count + PRIOR_STRENGTH * frequency) / (scene_total + PRIOR_STRENGTH)
+
+        return {
+            "subject": rel['subject'],
+            "spatial": rel['spatial'],
+            "object": rel['object'],
+            "images": triple_count,
+            "frequency": round(frequency, 4),
+            "scene": scene,
+            "scene_images": scene_total,
+            "scene_frequency": round(scene_frequency, 4),
+            "typicality": round(typicality, 4),
+        }
+
+    def describe(self, relationships, description):
+        """relationship_frequency for every relationship of a scene"""
+        return [self.relationship_frequency(rel, description) for rel in relationships]
+
+    def close(self):
+        self._conn.close()
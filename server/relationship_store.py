@@ -0,0 +1,211 @@
+import sys
+import json
+import threading
+import numpy as np
+import tolerant_json
+
+
+# Columns of the integer-coded relationship arrays
+CODE_COLUMNS = ("subject", "object", "spatial", "functional", "state", "contextual")
+
+_codes = {}
+_codes_lock = threading.Lock()
+
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def parse_json_field(value, default):
+    """Parse a JSON metadata field, falling back to the tolerant parser for old entries"""
+    if not isinstance(value, str):
+        return value if value is not None else default
+    if value == "":
+        return default
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return tolerant_json.loads(value)[0]
+
+
+class Relationship:
+    """
+    One relationship between two objects. Strings are interned, so the labels repeated
+    across thousands of images are stored once. Supports rel["subject"] style access so
+    code written against the parsed JSON dicts keeps working.
+    """
+    __slots__ = ("subject", "object", "spatial", "functional", "state", "contextual", "confidence")
+
+    def __init__(self, subject, object, spatial, functional, state, contextual, confidence):
+        self.subject = subject
+        self.object = object
+        self.spatial = spatial
+        self.functional = functional
+        self.state = state
+        self.contextual = contextual
+        self.confidence = confidence
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            intern_str(data.get("subject", "")),
+            intern_str(data.get("object", "")),
+            intern_str(data.get("spatial", "")),
+            intern_str(data.get("functional", "")),
+            intern_str(data.get("state", "")),
+            intern_str(data.get("contextual", "")),
+            float(data.get("confidence", 0.0))
+        )
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"Relationship({self.to_dict()})"
+
+
+class ImageRecord:
+    """Parsed metadata of an image in the collection"""
+    __slots__ = ("image_id", "image_name", "description", "objects", "relationships")
+
+    def __init__(self, image_id, image_name, description, objects, relationships):
+        self.image_id = image_id
+        self.image_name = image_name
+        self.description = description
+        self.objects = objects
+        self.relationships = relationships
+
+
+class RelationshipTuple(tuple):
+    """Immutable tuple of relationships that caches its integer-coded array"""
+
+    @property
+    def codes(self):
+        codes = self.__dict__.get("codes")
+        if codes is None:
+            codes = self.__dict__["codes"] = encode_relationships(self)
+        return codes
+
+
+def parse_relationships(relationships):
+    return RelationshipTuple(Relationship.from_dict(rel) for rel in relationships)
+
+
+def code_of(value):
+    """Integer code of a relationship string, shared by every image"""
+    code = _codes.get(value)
+    if code is None:
+        with _codes_lock:
+            code = _codes.setdefault(value, len(_codes))
+    return code
+
+
+def encode_relationships(relationships):
+    """
+    Encode relationships as an int32 array with one row per relationship and one column
+    per CODE_COLUMNS entry. Equal strings get equal codes, so comparisons become integer ones.
+    """
+    relationships = list(relationships)
+    return np.array(
+        [[code_of(rel[column]) for column in CODE_COLUMNS] for rel in relationships],
+        dtype=np.int32
+    ).reshape(len(relationships), len(CODE_COLUMNS))
+
+
+def relationship_codes(relationships):
+    """Coded array of a relationship list, cached when it comes from the store"""
+    if isinstance(relationships, RelationshipTuple):
+        return relationships.codes
+    return encode_relationships(relationships)
+
+
+class RelationshipStore:
+    """
+    Memory-resident store of parsed objects and relationships, keyed by image id and by
+    feedback id. Entries are parsed once, at ingestion time or the first time an id is
+    looked up, so the analysis and pattern extraction paths never re-parse JSON metadata.
+
+    Args:
+        fetch_images (callable): function(ids) returning a Chroma get() result with the
+            metadatas of the given image ids, used to load ids that are not in memory yet
+    """
+
+    def __init__(self, fetch_images=None):
+        self.fetch_images = fetch_images
+        self._images = {}
+        self._feedback = {}
+        self._lock = threading.Lock()
+
+    def add_image(self, image_id, metadata):
+        """Parse and store the Chroma metadata of an image"""
+        record = ImageRecord(
+            image_id,
+            metadata.get("image_name", ""),
+            metadata.get("description", ""),
+            {intern_str(label): attributes
+             for label, attributes in parse_json_field(metadata.get("objects_in_image"), {}).items()},
+            parse_relationships(parse_json_field(metadata.get("relationships"), []))
+        )
+        with self._lock:
+            self._images[image_id] = record
+        return record
+
+    def get_images(self, image_ids):
+        """
+        Records of the given image ids, loading the missing ones with a single fetch.
+
+        Returns:
+            list: ImageRecord for each id found, in the order of image_ids
+        """
+        missing = [image_id for image_id in image_ids if image_id not in self._images]
+        if missing and self.fetch_images:
+            fetched = self.fetch_images(missing)
+            for image_id, metadata in zip(fetched["ids"], fetched["metadatas"]):
+                self.add_image(image_id, metadata)
+        return [self._images[image_id] for image_id in image_ids if image_id in self._images]
+
+    def get_image(self, image_id):
+        records = self.get_images([image_id])
+        return records[0] if records else None
+
+    def remove_image(self, image_id):
+        with self._lock:
+            self._images.pop(image_id, None)
+
+    def add_feedback(self, feedback_id, metadata):
+        """
+        Parse and store the relationships of a feedback entry.
+
+        Returns:
+            tuple: (typical_relationships, atypical_relationships)
+        """
+        relationships = (
+            parse_relationships(parse_json_field(metadata.get("typical_relationships"), [])),
+            parse_relationships(parse_json_field(metadata.get("atypical_relationships"), []))
+        )
+        with self._lock:
+            self._feedback[feedback_id] = relationships
+        return relationships
+
+    def get_feedback(self, feedback_id, metadata):
+        """Parsed (typical, atypical) relationships of a feedback entry, parsing its metadata on first use"""
+        relationships = self._feedback.get(feedback_id)
+        if relationships is None:
+            relationships = self.add_feedback(feedback_id, metadata)
+        return relationships
+
+    def clear_feedback(self):
+        with self._lock:
+            self._feedback.clear()
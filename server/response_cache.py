@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from image_buffer import image_view
+
+
+RESPONSE_CACHE_FILE = "response_cache.db"
+# Set RESPONSE_CACHE=0 to send every request to the model
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+
+def response_key(model, prompt, image_bytes=None, mime_type="image/jpeg"):
+    """Content address of a request: hash of the model name, prompt text and image bytes (one or a list)"""
+    digest = hashlib.sha256()
+    for part in (model.encode("utf-8"), prompt.encode("utf-8"), mime_type.encode("utf-8")):
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    images = image_bytes if isinstance(image_bytes, (list, tuple)) else [image_bytes]
+    for data in images:
+        if data is not None:
+            view = image_view(data)
+            digest.update(view.nbytes.to_bytes(8, "little"))
+            digest.update(view)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of model responses in SQLite.
+
+    Entries expire `ttl` seconds after they were written. When the stored text exceeds
+    `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_FILE, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses(used_at);
+        """)
+        self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Cached response of a request.
+
+        Returns:
+            tuple: (text, input_tokens, output_tokens), or None if missing or expired
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT text, input_tokens, output_tokens, size, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[4] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= row[3]
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0], row[1], row[2]
+
+    def put(self, key, text, input_tokens=0, output_tokens=0):
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self._lock, self._conn:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, text, input_tokens, output_tokens, size, now, now)
+            )
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Drop expired entries, then the least recently used ones until the cache is back
+        under 90% of max_bytes, so eviction doesn't run again on the next write
+        """
+        self.evictions += self._conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)
+        ).rowcount
+        self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY used_at").fetchall():
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size -= size
+            self.evictions += 1
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self.size,
+        }
+
+    def close(self):
+        self._conn.close()
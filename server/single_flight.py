@@ -0,0 +1,37 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller starts the work, the
+    others await the same future, and the key is released once it completes so later
+    calls run again (and can hit whatever cache the work filled).
+
+    A caller that gets cancelled does not cancel the shared work for the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        """Await fn(*args, **kwargs), sharing the call with concurrent callers of the same key"""
+        loop = asyncio.get_running_loop()
+        future = self._calls.get((loop, key))
+        if future is None:
+            future = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[(loop, key)] = future
+            future.add_done_callback(lambda _: self._calls.pop((loop, key), None))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def snapshot(self):
+        return {
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from ann_index import AnnIndex
+
+
+@pytest.mark.parametrize("kind", ["hnsw", "ivfpq"])
+def test_writers_sharing_a_directory_get_distinct_rows(tmp_path, kind):
+    """Two processes (here two instances) adding to the same index see each other's vectors"""
+    rng = np.random.default_rng(0)
+    vectors = rng.random((40, 16), dtype=np.float32)
+    server = AnnIndex(kind, str(tmp_path), nlist=4, pq_m=4)
+    ingestion = AnnIndex(kind, str(tmp_path), nlist=4, pq_m=4)
+    server.set_params(ef_search=64, nprobe=4)
+
+    for i in range(0, 40, 4):
+        writer = server if i % 8 else ingestion
+        writer.add([f"id{j}" for j in range(i, i + 4)], vectors[i:i + 4])
+    server._sync()
+    ingestion._sync()
+
+    assert len(server) == len(ingestion) == 40
+    assert server.row_by_id == ingestion.row_by_id
+    for j in (0, 5, 39):
+        ids, distances = server.search([vectors[j]], 1)
+        assert ids == [[f"id{j}"]] and distances[0][0] < 1e-3
+
+
+def test_removal_in_another_process_is_seen(tmp_path):
+    vectors = np.eye(8, dtype=np.float32)
+    server = AnnIndex("hnsw", str(tmp_path))
+    ingestion = AnnIndex("hnsw", str(tmp_path))
+    ingestion.add([f"id{j}" for j in range(8)], vectors)
+    ingestion.remove("id3")
+    # Re-adding an image in one process retires its old row in the other
+    ingestion.add(["id4"], vectors[5:6])
+    server._sync()
+
+    assert "id3" not in server
+    assert len(server) == 7
+    assert set(server.search([vectors[5]], 2)[0][0]) == {"id4", "id5"}
@@ -0,0 +1,16 @@
+from content_index import ContentIndex
+
+
+def test_content_index_sees_images_stored_by_another_process(tmp_path):
+    path = str(tmp_path / "content_index.db")
+    server, ingestion = ContentIndex(path), ContentIndex(path)
+    phash = (1 << 63) | 0b1011
+    assert server.find_near(phash) is None
+
+    ingestion.add_many([("scene.jpg", "image_1", "sha", phash ^ 0b1, None, None)])
+    assert server.find_near(phash) == ("scene.jpg", "image_1", 1)
+
+    ingestion.remove_image("image_1")
+    assert server.find_near(phash) is None
+    server.close()
+    ingestion.close()
@@ -0,0 +1,36 @@
+import io
+import os
+import threading
+from PIL import Image
+from image_preprocessing import ImagePreprocessor
+
+
+def test_concurrent_writers_share_the_cache_folder(tmp_path):
+    """Threads and processes preparing the same new image all get it and leave one file"""
+    output = io.BytesIO()
+    Image.new("RGB", (3000, 2000), (120, 60, 30)).save(output, format="JPEG")
+    data = output.getvalue()
+    folder = str(tmp_path / "preprocessed_images")
+    # One preprocessor per writer, like the server and the ingestion process
+    preprocessors = [ImagePreprocessor(max_side=512, folder=folder) for _ in range(8)]
+    start = threading.Barrier(len(preprocessors))
+    results, errors = [], []
+
+    def prepare(preprocessor):
+        start.wait()
+        try:
+            results.append(preprocessor.prepare(data))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=prepare, args=(p,)) for p in preprocessors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(results) == len(preprocessors)
+    assert all(max(Image.open(r.open()).size) == 512 for r in results)
+    assert [name for name in os.listdir(folder) if name.endswith(".jpg")] == [preprocessors[0]._key(data) + ".jpg"]
+    assert not [name for name in os.listdir(folder) if name.endswith(".tmp")]
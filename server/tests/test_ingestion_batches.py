@@ -0,0 +1,81 @@
+import json
+import asyncio
+import pytest
+from PIL import Image
+import vector_db
+import content_index
+import image_mapping_store
+import image_preprocessing
+import inference_service
+import ingestion_pipeline
+from ingestion_journal import STORED
+from ingestion_scheduler import RateLimiter
+
+
+@pytest.fixture
+def batch_pipeline(tmp_path, monkeypatch):
+    """Batched ingestion in a temporary directory with counted fake model calls and DB writes"""
+    monkeypatch.chdir(tmp_path)
+    for module, name in [(ingestion_pipeline, "_journal"), (image_mapping_store, "_store"),
+                         (content_index, "_index"), (image_preprocessing, "_preprocessor"),
+                         (inference_service, "_response_cache")]:
+        monkeypatch.setattr(module, name, None)
+    calls = {"batch": [], "single": 0, "written": []}
+
+    async def analyze_batch(session, image_paths):
+        calls["batch"].append(len(image_paths))
+        return [{
+            'image_path': ingestion_pipeline.move_to_processed(image_path),
+            'objects': json.dumps([]),
+            'relationships': json.dumps([]),
+            'scene_description': "a plain square"
+        } for image_path in image_paths]
+
+    async def analyze_single(session, image_path):
+        calls["single"] += 1
+        return None
+
+    def write(records):
+        calls["written"].extend(record['image_name'] for record in records)
+
+    monkeypatch.setattr(ingestion_pipeline, "process_image_batch", analyze_batch)
+    monkeypatch.setattr(ingestion_pipeline, "process_single_image", analyze_single)
+    monkeypatch.setattr(vector_db, "add_images_to_db", write)
+    (tmp_path / ingestion_pipeline.IMAGE_FOLDER).mkdir()
+    (tmp_path / ingestion_pipeline.PROCESSED_FOLDER).mkdir()
+    yield tmp_path, calls
+    ingestion_pipeline.get_journal().close()
+    image_mapping_store.get_mapping_store().close()
+    content_index.get_content_index().close()
+
+
+def test_bad_files_fail_alone_in_their_group(batch_pipeline, capsys):
+    tmp_path, calls = batch_pipeline
+    images = tmp_path / ingestion_pipeline.IMAGE_FOLDER
+    good = [f"good{i}.jpg" for i in range(6)]
+    bad = ["bad0.jpg", "bad1.jpg"]
+    for i, name in enumerate(good):
+        # Far apart in pHash, so none is taken for a near-duplicate of another
+        Image.effect_noise((64, 64), 60 + i * 10).convert("RGB").save(images / name)
+    for name in bad:
+        (images / name).write_bytes(b"not an image")
+
+    asyncio.run(ingestion_pipeline.process_images(
+        workers=2, rate_limiter=RateLimiter(rpm=60000, tpm=0), batch_size=2, analysis_batch_size=4
+    ))
+
+    journal = ingestion_pipeline.get_journal()
+    for name in good:
+        assert journal.get(name)["state"] == STORED
+        assert image_mapping_store.get_mapping_store().get_id(name) == journal.get(name)["image_id"]
+    for name in bad:
+        assert journal.get(name) is None
+        assert (images / name).exists()
+    assert sorted(calls["written"]) == good
+    # The good images of each group are analyzed together, the bad ones never reach the model
+    assert sum(calls["batch"]) == len(good) and calls["single"] == 0
+
+    with open(tmp_path / ingestion_pipeline.DEAD_LETTER_FILE) as f:
+        dead_letters = json.load(f)
+    assert sorted(letter["item"] for letter in dead_letters) == bad
+    assert "Processed 6 images successfully" in capsys.readouterr().out
@@ -0,0 +1,63 @@
+import random
+import pytest
+from context_integration import extract_relationships, is_similar_relationship
+from relationship_store import parse_relationships
+
+
+def classify_relationships_loop(image_id, current_relationships, similar_relationships_array):
+    """The original pure-Python extract_relationships, kept here as the reference implementation"""
+    typical_relationships = []
+    atypical_relationships = []
+    for id, similar_relationships, _ in similar_relationships_array:
+        if id == image_id or len(similar_relationships) == 0:
+            continue
+        for current_rel in current_relationships:
+            if current_rel['confidence'] >= 0.8:
+                match_count = 0
+                current_objects = {current_rel["object"], current_rel["subject"]}
+                for rel in similar_relationships:
+                    if current_objects.intersection({rel["object"], rel["subject"]}) or is_similar_relationship(current_rel, rel):
+                        match_count += 1
+                if match_count / len(similar_relationships) >= 0.1:
+                    typical_relationships.append(current_rel)
+                else:
+                    atypical_relationships.append(current_rel)
+    return typical_relationships, atypical_relationships
+
+
+def synthetic_scene(rng, n_relationships, labels=30):
+    """Random relationships drawn from small vocabularies so that matches actually happen"""
+    return parse_relationships([
+        {
+            "subject": f"object {rng.randrange(labels)}", "object": f"object {rng.randrange(labels)}",
+            "spatial": rng.choice(["on", "in", "under", "next to", "near"]),
+            "functional": rng.choice(["supports", "holds", "covers"]),
+            "state": rng.choice(["stable", "unstable", "resting", "tilted"]),
+            "contextual": rng.choice(["typical", "atypical"]),
+            "confidence": rng.choice([0.5, 0.8, 0.9, 0.95])
+        }
+        for _ in range(n_relationships)
+    ])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vectorized_classification_matches_loop(seed):
+    """Same relationships, in the same order, as the original loops on random scenes"""
+    rng = random.Random(seed)
+    for case in range(100):
+        current = synthetic_scene(rng, rng.randrange(0, 8), labels=rng.choice([3, 10, 30]))
+        similar = [
+            (f"id{i}", synthetic_scene(rng, rng.randrange(0, 12), labels=rng.choice([3, 10, 30])), "")
+            for i in range(rng.randrange(0, 10))
+        ]
+        image_id = rng.choice(["id0", "id1", "query"])
+        expected = classify_relationships_loop(image_id, current, similar)
+        found = extract_relationships(image_id, current, similar)
+        assert [list(map(id, rels)) for rels in found] == [list(map(id, rels)) for rels in expected], case
+
+
+def test_self_and_empty_neighbours_are_skipped():
+    rng = random.Random(0)
+    current = synthetic_scene(rng, 5, labels=3)
+    similar = [("query", synthetic_scene(rng, 5, labels=3), ""), ("empty", [], "")]
+    assert extract_relationships("query", current, similar) == ([], [])
@@ -0,0 +1,93 @@
+import json
+import asyncio
+import pytest
+from PIL import Image
+import content_index
+import image_mapping_store
+import image_preprocessing
+import inference_service
+import ingestion_pipeline
+from prompts import IMAGE_ANALYSIS_PROMPT
+from single_flight import SingleFlight
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Ingestion in a temporary directory with the fake model and a counted fake DB write"""
+    monkeypatch.chdir(tmp_path)
+    for module, name in [(ingestion_pipeline, "_journal"), (image_mapping_store, "_store"),
+                         (content_index, "_index"), (image_preprocessing, "_preprocessor"),
+                         (inference_service, "_response_cache")]:
+        monkeypatch.setattr(module, name, None)
+    inference_service.set_backend(inference_service.FakeBackend(latency=0.05))
+    calls = {"model": 0, "write": 0}
+
+    async def analyze(session, image_path):
+        calls["model"] += 1
+        with open(image_path, 'rb') as f:
+            text = await inference_service.generate(IMAGE_ANALYSIS_PROMPT, f.read(), use_cache=False)
+        objects, relationships, scene_description = ingestion_pipeline.parse_analysis_result(text)
+        return {
+            'image_path': ingestion_pipeline.move_to_processed(image_path),
+            'objects': json.dumps(objects),
+            'relationships': json.dumps(relationships),
+            'scene_description': scene_description
+        }
+
+    def write(*args):
+        calls["write"] += 1
+
+    monkeypatch.setattr(ingestion_pipeline, "process_single_image", analyze)
+    monkeypatch.setattr(ingestion_pipeline, "add_image_to_db", write)
+    (tmp_path / ingestion_pipeline.IMAGE_FOLDER).mkdir()
+    (tmp_path / ingestion_pipeline.PROCESSED_FOLDER).mkdir()
+    yield tmp_path / ingestion_pipeline.IMAGE_FOLDER, calls
+    ingestion_pipeline.get_journal().close()
+    image_mapping_store.get_mapping_store().close()
+    content_index.get_content_index().close()
+
+
+def test_concurrent_ingestions_share_one_analysis_and_write(pipeline):
+    images, calls = pipeline
+    Image.new("RGB", (64, 48), (120, 80, 40)).save(images / "new.jpg")
+
+    async def run():
+        return await asyncio.gather(*(ingestion_pipeline.ingest_single_image("new.jpg") for _ in range(20)))
+
+    ids = asyncio.run(run())
+    assert calls == {"model": 1, "write": 1}
+    assert len(set(ids)) == 1 and ids[0] is not None
+    assert image_mapping_store.get_mapping_store().get_id("new.jpg") == ids[0]
+
+
+def test_unreadable_image_is_rejected(pipeline, capsys):
+    images, calls = pipeline
+    (images / "broken.jpg").write_bytes(b"not an image")
+
+    assert asyncio.run(ingestion_pipeline.ingest_single_image("broken.jpg")) is None
+    assert calls == {"model": 0, "write": 0}
+    assert "broken.jpg is not a readable image" in capsys.readouterr().out
+    assert ingestion_pipeline.get_journal().get("broken.jpg") is None
+    assert (images / "broken.jpg").exists()
+
+
+def test_single_flight_shares_result_and_error():
+    flight = SingleFlight("test")
+    started = []
+
+    async def work(value):
+        started.append(value)
+        await asyncio.sleep(0.01)
+        if value == "fail":
+            raise ValueError("boom")
+        return value
+
+    async def run():
+        ok = await asyncio.gather(*(flight.do("a", work, "ok") for _ in range(5)))
+        failed = await asyncio.gather(*(flight.do("b", work, "fail") for _ in range(3)), return_exceptions=True)
+        return ok, failed
+
+    ok, failed = asyncio.run(run())
+    assert ok == ["ok"] * 5
+    assert all(isinstance(e, ValueError) for e in failed)
+    assert started == ["ok", "fail"]
@@ -0,0 +1,216 @@
+import json
+
+
+class TolerantJSONError(ValueError):
+    """Raised when no JSON object or array can be recovered from a text"""
+
+
+_MISSING = object()
+_WHITESPACE = " \t\r\n"
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class _Parser:
+    """
+    Single-pass recursive descent parser accepting the mistakes models make in JSON:
+    prose or code fences around it, // and /* */ comments, trailing or missing commas,
+    single-quoted strings, unquoted keys, Python literals, and output cut off mid-way
+    (unfinished values are dropped, open containers are closed).
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.end = len(text)
+        self.truncated = False
+
+    def skip(self):
+        text, end = self.text, self.end
+        while self.pos < end:
+            char = text[self.pos]
+            if char in _WHITESPACE or char == ",":
+                self.pos += 1
+            elif text.startswith("//", self.pos):
+                newline = text.find("\n", self.pos)
+                self.pos = end if newline == -1 else newline + 1
+            elif text.startswith("/*", self.pos):
+                close = text.find("*/", self.pos + 2)
+                self.pos = end if close == -1 else close + 2
+            else:
+                return
+
+    def value(self):
+        self.skip()
+        if self.pos >= self.end:
+            self.truncated = True
+            return _MISSING
+        char = self.text[self.pos]
+        if char == "{":
+            return self.object()
+        if char == "[":
+            return self.array()
+        if char in "\"'":
+            return self.string()
+        return self.scalar()
+
+    def object(self):
+        self.pos += 1
+        result = {}
+        while True:
+            self.skip()
+            if self.pos >= self.end:
+                self.truncated = True
+                return result
+            char = self.text[self.pos]
+            if char == "}":
+                self.pos += 1
+                return result
+            if char == "]":
+                # Mismatched bracket, close the object here
+                return result
+            key = self.string() if char in "\"'" else self.bare_word()
+            if key is _MISSING:
+                return result
+            self.skip()
+            if self.pos < self.end and self.text[self.pos] in ":=":
+                self.pos += 1
+            value = self.value()
+            if value is _MISSING:
+                return result
+            result[str(key)] = value
+
+    def array(self):
+        self.pos += 1
+        result = []
+        while True:
+            self.skip()
+            if self.pos >= self.end:
+                self.truncated = True
+                return result
+            char = self.text[self.pos]
+            if char == "]":
+                self.pos += 1
+                return result
+            if char == "}":
+                return result
+            value = self.value()
+            if value is _MISSING:
+                return result
+            result.append(value)
+
+    def string(self, partial=False):
+        """Quoted string at the current position; if it is cut off, the text so far when
+        `partial` is set, _MISSING otherwise"""
+        quote = self.text[self.pos]
+        self.pos += 1
+        text, end = self.text, self.end
+        parts = []
+        start = self.pos
+        while self.pos < end:
+            char = text[self.pos]
+            if char == quote:
+                parts.append(text[start:self.pos])
+                self.pos += 1
+                return "".join(parts)
+            if char == "\\":
+                parts.append(text[start:self.pos])
+                if self.pos + 1 >= end:
+                    break
+                escape = text[self.pos + 1]
+                if escape == "u" and self.pos + 6 <= end:
+                    try:
+                        parts.append(chr(int(text[self.pos + 2:self.pos + 6], 16)))
+                        self.pos += 6
+                    except ValueError:
+                        parts.append(escape)
+                        self.pos += 2
+                else:
+                    parts.append(_ESCAPES.get(escape, escape))
+                    self.pos += 2
+                start = self.pos
+            elif char == "\n" and quote == "'":
+                break
+            else:
+                self.pos += 1
+        self.truncated = True
+        self.pos = end
+        if partial:
+            parts.append(text[start:end])
+            return "".join(parts)
+        return _MISSING
+
+    def bare_word(self):
+        start = self.pos
+        text, end = self.text, self.end
+        while self.pos < end and text[self.pos] not in ":=,{}[]\"'" + _WHITESPACE:
+            self.pos += 1
+        if self.pos == start:
+            # Unexpected character, skip it
+            self.pos += 1
+            return self.bare_word() if self.pos < end else _MISSING
+        return text[start:self.pos]
+
+    def scalar(self):
+        start = self.pos
+        text, end = self.text, self.end
+        while self.pos < end and text[self.pos] not in ",}]" + _WHITESPACE:
+            self.pos += 1
+        word = text[start:self.pos]
+        if self.pos >= end and word not in _LITERALS:
+            # A number or literal at the very end may be cut off
+            try:
+                float(word)
+            except ValueError:
+                self.truncated = True
+                return _MISSING
+        if word in _LITERALS:
+            return _LITERALS[word]
+        try:
+            return int(word)
+        except ValueError:
+            pass
+        try:
+            return float(word)
+        except ValueError:
+            return word
+
+
+def _start(text):
+    """Position of the first object or array, skipping prose and code fences before it"""
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    return min(starts) if starts else -1
+
+
+def loads(text):
+    """
+    Parse JSON strictly when possible, tolerantly otherwise.
+
+    A JSON string containing JSON (a response that went through an extra json.dumps)
+    is decoded first.
+
+    Returns:
+        tuple: (value, strict) where strict tells whether json.loads accepted the text as is
+
+    Raises:
+        TolerantJSONError: If the text contains no object or array
+    """
+    text = text.strip()
+    try:
+        value = json.loads(text)
+        if isinstance(value, str):
+            return loads(value)[0], False
+        return value, True
+    except json.JSONDecodeError:
+        pass
+
+    if text.startswith('"'):
+        # Escaped JSON inside a string that is broken or cut off
+        inner = _Parser(text).string(partial=True)
+        if _start(inner) != -1:
+            return loads(inner)[0], False
+
+    start = _start(text)
+    if start == -1:
+        raise TolerantJSONError(f"No JSON object or array in: {text[:200]}")
+    return _Parser(text[start:]).value(), False
@@ -1,62 +1,424 @@
 #https://www.datacamp.com/tutorial/chromadb-tutorial-step-by-step-guide
 
-import chromadb
-from transformers import AutoImageProcessor, AutoModel
-from chromadb.utils.data_loaders import ImageLoader
-from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
-import json
+import os
+import time
+import asyncio
+import model_registry
+from feedback_index import FeedbackIndex
+from relationship_store import RelationshipStore, parse_json_field
+from relationship_stats import RelationshipStats
+from analysis_cache import AnalysisCache, INVALIDATION_NEIGHBOURS
+from ann_index import AnnIndex, ANN_INDEX
+from content_index import get_content_index
+from image_preprocessing import open_prepared_image
+from feedback_relationships import RELATIONSHIP_COLLECTION, RELATIONSHIP_NEIGHBOURS, relationship_documents, key_text, query_filter, rank_feedback
 
 
+# How feedback is matched to the relationships of a scene: "embedding" runs a kNN query
+# over the embedded relationship triples, "index" uses the substring-based inverted index
+# (also used when the embedding query fails)
+FEEDBACK_RETRIEVAL = os.getenv("FEEDBACK_RETRIEVAL", "embedding")
 
-embedding_function = OpenCLIPEmbeddingFunction()
+# Thresholds for the batched image writer used during ingestion
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", "32"))
+INGESTION_BATCH_WAIT = float(os.getenv("INGESTION_BATCH_WAIT", "5"))
 
-data_loader = ImageLoader()
 
-client = chromadb.PersistentClient(path="chroma_data")
 
-collection = client.get_or_create_collection(
-    "visual_concept",
-    embedding_function=embedding_function,
-    data_loader=data_loader
-)
+def load_openclip():
+    from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+    return OpenCLIPEmbeddingFunction()
 
-feedback_collection = client.get_or_create_collection(
-    "feedback"
-)
 
+def lazy_openclip_embedding_function():
+    """Embedding function for the image collection that loads OpenCLIP on first use"""
+    from chromadb import EmbeddingFunction
 
-processor = AutoImageProcessor.from_pretrained("openai/clip-vit-base-patch32")
-model = AutoModel.from_pretrained("openai/clip-vit-base-patch32")
+    class LazyOpenCLIPEmbeddingFunction(EmbeddingFunction):
+        def __call__(self, input):
+            return model_registry.get("openclip")(input)
+
+    return LazyOpenCLIPEmbeddingFunction()
+
+
+def load_text_encoder():
+    # Small CPU sentence encoder (all-MiniLM-L6-v2 on ONNX Runtime) shipped with Chroma
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+    return DefaultEmbeddingFunction()
+
+
+def lazy_text_embedding_function():
+    """Embedding function for the relationship collection that loads the encoder on first use"""
+    from chromadb import EmbeddingFunction
+
+    class LazyTextEmbeddingFunction(EmbeddingFunction):
+        def __call__(self, input):
+            return model_registry.get("text_encoder")(input)
+
+    return LazyTextEmbeddingFunction()
+
+
+def create_client():
+    import chromadb
+    return chromadb.PersistentClient(path="chroma_data")
+
+
+def create_collection():
+    from chromadb.utils.data_loaders import ImageLoader
+    return model_registry.get("chroma_client").get_or_create_collection(
+        "visual_concept",
+        embedding_function=lazy_openclip_embedding_function(),
+        data_loader=ImageLoader()
+    )
+
+
+def create_feedback_collection():
+    return model_registry.get("chroma_client").get_or_create_collection(
+        "feedback"
+    )
+
+
+def create_relationship_collection():
+    """Open the embedded feedback relationships, embedding the existing feedback if the collection is new"""
+    collection = model_registry.get("chroma_client").get_or_create_collection(
+        RELATIONSHIP_COLLECTION,
+        embedding_function=lazy_text_embedding_function(),
+        metadata={"hnsw:space": "cosine"}
+    )
+    if collection.count() == 0:
+        feedback = get_feedback_collection().get(include=['metadatas'])
+        if feedback['ids']:
+            print(f"Embedding relationships of {len(feedback['ids'])} feedback entries", flush=True)
+            for feedback_id, metadata in zip(feedback['ids'], feedback['metadatas']):
+                ids, documents, metadatas = relationship_documents(feedback_id, metadata)
+                if ids:
+                    collection.upsert(ids=ids, documents=documents, metadatas=metadatas)
+    return collection
+
+
+def create_ann_index():
+    """Open the local ANN index, filling it with the collection's embeddings if it is new"""
+    index = AnnIndex(ANN_INDEX)
+    if len(index) == 0:
+        collection = get_collection()
+        total = collection.count()
+        if total:
+            print(f"Building {ANN_INDEX} index for {total} images", flush=True)
+        for offset in range(0, total, 5000):
+            page = collection.get(include=['embeddings'], limit=5000, offset=offset)
+            index.add(page['ids'], page['embeddings'])
+        index.save()
+    return index
+
+
+def create_feedback_index():
+    """Open the feedback inverted index, building it from the feedback collection if it is new"""
+    index = FeedbackIndex()
+    if len(index) == 0:
+        feedback = get_feedback_collection().get(include=['metadatas'])
+        if feedback['ids']:
+            print(f"Building feedback index for {len(feedback['ids'])} entries", flush=True)
+            index.add_many(zip(feedback['ids'], feedback['metadatas']))
+    return index
+
+
+def create_relationship_store():
+    return RelationshipStore(
+        fetch_images=lambda ids: get_collection().get(ids=ids, include=['metadatas'])
+    )
+
+
+def create_relationship_stats():
+    """Open the relationship statistics, counting the existing collection if they are new"""
+    collection = get_collection()
+    stats = RelationshipStats(corpus_size=collection.count())
+    if len(stats) == 0:
+        images = collection.get(include=['metadatas'])
+        if images['ids']:
+            print(f"Building relationship statistics for {len(images['ids'])} images", flush=True)
+            stats.add_images(
+                (image_id, metadata.get("description", ""), parse_json_field(metadata.get("relationships"), []))
+                for image_id, metadata in zip(images['ids'], images['metadatas'])
+            )
+    return stats
+
+
+model_registry.register("openclip", load_openclip)
+model_registry.register("chroma_client", create_client)
+model_registry.register("image_collection", create_collection)
+model_registry.register("feedback_collection", create_feedback_collection)
+model_registry.register("feedback_index", create_feedback_index)
+model_registry.register("text_encoder", load_text_encoder)
+model_registry.register("relationship_collection", create_relationship_collection)
+model_registry.register("relationship_store", create_relationship_store)
+model_registry.register("relationship_stats", create_relationship_stats)
+model_registry.register("analysis_cache", AnalysisCache)
+# Only with ANN_INDEX set, so warm_up doesn't build an index nobody asked for
+if ANN_INDEX:
+    model_registry.register("ann_index", create_ann_index)
+
+
+def get_collection():
+    return model_registry.get("image_collection")
+
+
+def get_feedback_collection():
+    return model_registry.get("feedback_collection")
+
+
+def get_feedback_index():
+    return model_registry.get("feedback_index")
+
+
+def get_relationship_collection():
+    return model_registry.get("relationship_collection")
+
+
+def get_relationship_store():
+    return model_registry.get("relationship_store")
+
+
+def get_relationship_stats():
+    return model_registry.get("relationship_stats")
+
+
+def get_analysis_cache():
+    return model_registry.get("analysis_cache")
+
+
+def get_ann_index():
+    """Local ANN index when ANN_INDEX is set, None when Chroma's own index is used"""
+    return model_registry.get("ann_index") if ANN_INDEX else None
+
+
+def invalidate_analyses_near(query_embeddings):
+    """Invalidate the cached analyses whose neighbour sets the given new embeddings may enter"""
+    index = get_ann_index()
+    if index is not None:
+        ids, distances = index.search(query_embeddings, INVALIDATION_NEIGHBOURS)
+        neighbours = {"ids": ids, "distances": distances}
+    else:
+        neighbours = get_collection().query(
+            query_embeddings=query_embeddings,
+            include=['distances'],
+            n_results=INVALIDATION_NEIGHBOURS
+        )
+    get_analysis_cache().invalidate_near(
+        (image_id, distance)
+        for ids, distances in zip(neighbours['ids'], neighbours['distances'])
+        for image_id, distance in zip(ids, distances)
+    )
 
 def add_image_to_db(image_id, image_path, objects_in_image, description, image_name, relationships):
-    collection.add(
+    metadata = {"objects_in_image": objects_in_image, "description": description, "image_name": image_name, "relationships": relationships }
+    embeddings = embed_images([image_path])
+    get_collection().add(
         ids=[image_id],
         uris=[image_path], 
-        metadatas=[{"objects_in_image": objects_in_image, "description": description, "image_name": image_name, "relationships": relationships }]
+        embeddings=embeddings,
+        metadatas=[metadata]
+    )
+    record = get_relationship_store().add_image(image_id, metadata)
+    get_relationship_stats().add_image(image_id, description, record.relationships)
+    index = get_ann_index()
+    if index is not None:
+        index.add([image_id], embeddings)
+    invalidate_analyses_near(embeddings)
+
+def embed_images(image_paths):
+    """
+    Embed several images with one batched OpenCLIP forward pass.
+
+    Uses the same model, preprocessing and normalization as the collection's
+    embedding function. Images are read through the image preprocessor, so CLIP sees
+    the same downscaled, upright copy as the model and large uploads are decoded once.
+
+    Args:
+        image_paths (list): Paths of the images to embed
+
+    Returns:
+        list: One embedding (list of floats) per image
+    """
+    embedding_function = model_registry.get("openclip")
+    torch = embedding_function._torch
+    model = embedding_function._model
+    preprocess = embedding_function._preprocess
+    device = getattr(embedding_function, "_device", "cpu")
+
+    batch = torch.stack([
+        preprocess(open_prepared_image(path).convert("RGB"))
+        for path in image_paths
+    ]).to(device)
+
+    with torch.no_grad():
+        features = model.encode_image(batch)
+        features /= features.norm(dim=-1, keepdim=True)
+
+    return features.cpu().numpy().tolist()
+
+def add_images_to_db(records):
+    """
+    Embed and write a batch of analyzed images with a single upsert.
+
+    Args:
+        records (list): Dicts with image_id, image_path, objects, scene_description,
+            image_name and relationships (the same fields add_image_to_db takes)
+    """
+    if not records:
+        return
+
+    embeddings = embed_images([r['image_path'] for r in records])
+    metadatas = [
+        {
+            "objects_in_image": r['objects'],
+            "description": r['scene_description'],
+            "image_name": r['image_name'],
+            "relationships": r['relationships']
+        }
+        for r in records
+    ]
+    get_collection().upsert(
+        ids=[r['image_id'] for r in records],
+        uris=[r['image_path'] for r in records],
+        embeddings=embeddings,
+        metadatas=metadatas
     )
 
+    store = get_relationship_store()
+    counted = []
+    for r, metadata in zip(records, metadatas):
+        record = store.add_image(r['image_id'], metadata)
+        counted.append((r['image_id'], record.description, record.relationships))
+    get_relationship_stats().add_images(counted)
+    index = get_ann_index()
+    if index is not None:
+        index.add([r['image_id'] for r in records], embeddings)
+    invalidate_analyses_near(embeddings)
+
+class ImageBatchWriter:
+    """
+    Collects analyzed images and writes them to the collection in batches.
+
+    A batch is flushed when it reaches `batch_size` images or when its oldest image has
+    waited `max_wait` seconds. `on_flush(records)` runs after every successful batch,
+    records of a failed batch are kept in `failed`.
+    """
+
+    def __init__(self, batch_size=INGESTION_BATCH_SIZE, max_wait=INGESTION_BATCH_WAIT, on_flush=None):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.on_flush = on_flush
+        self.failed = []
+        self.written = 0
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    def add(self, record):
+        """Queue a record, flushing in the background once the batch is full"""
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._start_flush)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            start = time.perf_counter()
+            await asyncio.to_thread(add_images_to_db, batch)
+            self.written += len(batch)
+            print(f"Wrote batch of {len(batch)} images in {time.perf_counter() - start:.2f}s", flush=True)
+            if self.on_flush:
+                self.on_flush(batch)
+        except Exception as e:
+            print(f"Error writing batch of {len(batch)} images: {e}", flush=True)
+            self.failed.extend({"item": r['image_name'], "error": str(e)} for r in batch)
+
+    async def close(self):
+        """Flush whatever is left and wait for every batch to be written"""
+        self._start_flush()
+        while self._flushes:
+            await asyncio.gather(*self._flushes)
+
 def get_all_images_from_db():
-    return collection.get(include=['embeddings', 'metadatas'])
+    return get_collection().get(include=['embeddings', 'metadatas'])
 
 
 def get_image_from_db(image_id):
-    return collection.get(ids=[image_id], include=['uris', 'metadatas'])
+    return get_collection().get(ids=[image_id], include=['uris', 'metadatas'])
+
+def get_image_names(image_ids):
+    """
+    Look up the image_name of several images with a single collection.get
+
+    Returns:
+        dict: image_id -> image_name for the ids found in the collection
+    """
+    image_ids = list(dict.fromkeys(i for i in image_ids if i))
+    if not image_ids:
+        return {}
+    images = get_collection().get(ids=image_ids, include=['metadatas'])
+    return {
+        image_id: (metadata or {}).get("image_name", "")
+        for image_id, metadata in zip(images['ids'], images['metadatas'])
+    }
 
 def delete_image_from_db(image_id):
-    collection.delete(ids=[image_id])
+    get_collection().delete(ids=[image_id])
+    get_relationship_store().remove_image(image_id)
+    get_content_index().remove_image(image_id)
+    if get_ann_index() is not None:
+        get_ann_index().remove(image_id)
+    get_analysis_cache().invalidate_all()
 
 def delete_all_images_from_db():
-    collection.delete_all()
+    get_collection().delete_all()
+    get_content_index().clear()
+    if get_ann_index() is not None:
+        get_ann_index().clear()
+    get_analysis_cache().invalidate_all()
 
-def get_n_similar_images(image_id, n):
+def get_n_similar_images(image_id, n, include=['metadatas']):
     """
     Get similar images based on the entity graph
+
+    With ANN_INDEX set, the image's embedding is read from the local index and the
+    neighbours come from it without a round-trip to Chroma; Chroma is only asked for the
+    fields of `include` the index does not have (metadatas, uris...).
     """
-    obj = collection.get(ids=[image_id], include=['embeddings'])
+    index = get_ann_index()
+    if index is not None:
+        found = index.query_by_id(image_id, n)
+        if found is not None:
+            ids, distances = found
+            extra = [field for field in include if field != 'distances']
+            if not extra:
+                return {"ids": [ids], "distances": [distances]}
+
+            fetched = get_collection().get(ids=ids, include=extra)
+            position = {image_id: i for i, image_id in enumerate(fetched['ids'])}
+            kept = [(image_id, distance) for image_id, distance in zip(ids, distances) if image_id in position]
+            similar_images = {"ids": [[i for i, _ in kept]], "distances": [[d for _, d in kept]]}
+            for field in extra:
+                similar_images[field] = [[fetched[field][position[i]] for i, _ in kept]]
+            return similar_images
+
+    obj = get_collection().get(ids=[image_id], include=['embeddings'])
     
-    similar_images = collection.query(
+    similar_images = get_collection().query(
         query_embeddings=obj['embeddings'],
-        include=['metadatas'],
+        include=include,
         n_results=n
     )
     
@@ -73,102 +435,80 @@ def add_feedback_to_db(feedback_id, text, metadata):
         metadata (dict): Metadata including image_id, inference, rating
     '''
     try:
-        feedback_collection.upsert(
+        get_feedback_collection().upsert(
             ids=[feedback_id],
             documents=[text if text else ""],
             metadatas=[metadata]
         )
+        get_feedback_index().add(feedback_id, metadata)
+        get_relationship_store().add_feedback(feedback_id, metadata)
+        if FEEDBACK_RETRIEVAL == "embedding":
+            try:
+                add_feedback_relationships(feedback_id, metadata)
+            except Exception as e:
+                # The entry stays reachable through the index, the fallback of the embedding query
+                print(f"Error embedding feedback relationships: {e}", flush=True)
         return True
     except Exception as e:
         print(f"Error adding feedback to DB: {e}")
         return False
 
+def add_feedback_relationships(feedback_id, metadata):
+    """Embed the relationship triples of a feedback entry into the relationship collection"""
+    collection = get_relationship_collection()
+    # Drop the triples of a previous version of the entry, it may have had more of them
+    collection.delete(where={"feedback_id": feedback_id})
+    ids, documents, metadatas = relationship_documents(feedback_id, metadata)
+    if ids:
+        collection.upsert(ids=ids, documents=documents, metadatas=metadatas)
+
+def query_feedback_relationships(feedback_id, relationship_keys, limit=3):
+    """
+    Feedback ids whose relationships are closest to the keys, with one batched kNN query
+    over all the keys and the similarities aggregated per feedback entry.
+    """
+    collection = get_relationship_collection()
+    count = collection.count()
+    if count == 0 or not relationship_keys:
+        return []
+    results = collection.query(
+        query_texts=[key_text(key) for key in relationship_keys],
+        n_results=min(RELATIONSHIP_NEIGHBOURS, count),
+        where=query_filter(feedback_id),
+        include=['metadatas', 'distances']
+    )
+    return rank_feedback(results, limit)
+
 def get_feedback_by_relationships(feedback_id,relationship_keys, limit=3):
     """
     Find feedback entries that match specific relationship patterns
     
     Args:
+        feedback_id (str): ID of the current feedback, excluded from the results
         relationship_keys (list): List of relationship key strings (e.g., "cup-on-table")
         limit (int): Maximum number of results to return
     """
     try:
-        all_results = []
-        seen_ids = set()
-        seen_image_ids = set()
-        seen_relationships = set()
-        seen_ids.add(feedback_id)
-        
-        # First try the simplest approach - get all feedback with high ratings
-        all_feedback = feedback_collection.get(
-            where={"rating": {"$gte": 0.5}}
-        )
-        
-        if not all_feedback or 'ids' not in all_feedback or not all_feedback['ids']:
-            return {"ids": [[]], "metadatas": [[]]}
-            
-        # Then manually filter for relationship matches
-        for i, metadata in enumerate(all_feedback['metadatas']):
-            feedback_id = all_feedback['ids'][i]
-            image_id = metadata.get("image_id", "")
-            
-            # Skip if we've already seen this ID
-            if feedback_id in seen_ids:
-                continue
-
-            if image_id in seen_image_ids:
-                continue
-                
-            for field in ["atypical_relationships", "typical_relationships"]:
-                field_data = metadata.get(field, "")
-
-                if image_id in seen_image_ids or field_data == "":
-                    break
-                    
-                # Parse the JSON string into a list of dictionaries
-                try:
-                    field_data = json.loads(field_data)
-                except json.JSONDecodeError:
-                    print(f"Error parsing JSON for {field}: {field_data}", flush=True)
-                    continue
-                    
-                for key in relationship_keys:
-                    subject, spatial, state, functional, contextual, obj = key.split("-")
-
-                    if image_id in seen_image_ids:
-                        break
-                    
-                    # If all three components are in the field data, consider it a match
-                    for data in field_data:
-                        
-
-                        if (
-                            (subject in data['subject'] or subject in data['object']) and
-                            (
-                                spatial in data['spatial'] or
-                                state in data['state'] or
-                                functional in data['functional'] or
-                                contextual in data['contextual']
-                            ) and
-                            (obj in data['object'] or obj in data['subject'])
-                        ):
-                            seen_ids.add(feedback_id)
-                            seen_image_ids.add(image_id)
-                            all_results.append((feedback_id, metadata))
-                            break  # Move to next ID after finding a match
-        
+        result_ids = None
+        if FEEDBACK_RETRIEVAL == "embedding":
+            try:
+                result_ids = query_feedback_relationships(feedback_id, relationship_keys, limit)
+            except Exception as e:
+                print(f"Error querying feedback relationships, using the index: {e}", flush=True)
+        if result_ids is None:
+            result_ids = get_feedback_index().query(relationship_keys, exclude_feedback_id=feedback_id, limit=limit)
+
         # Format results to match ChromaDB's return format
-        if not all_results:
+        if not result_ids:
             return {"ids": [[]], "metadatas": [[]]}
-        
-        # Limit results
-        all_results = all_results[:limit]
-        result_ids = [r[0] for r in all_results]
-        
-        result_metadatas = [r[1] for r in all_results]
-        
+
+        feedback = get_feedback_collection().get(ids=result_ids, include=['metadatas'])
+        metadata_by_id = dict(zip(feedback['ids'], feedback['metadatas']))
+        result_ids = [i for i in result_ids if i in metadata_by_id]
+
         return {
             "ids": [result_ids],
-            "metadatas": [result_metadatas]
+            "metadatas": [[metadata_by_id[i] for i in result_ids]]
         }
     except Exception as e:
         print(f"Error in get_feedback_by_relationships: {e}")
@@ -184,7 +524,7 @@ def get_similar_feedback(query_text, limit=3):
         limit (int): Maximum number of results
     '''
     try:
-        results = feedback_collection.query(
+        results = get_feedback_collection().query(
             query_texts=[query_text],
             n_results=limit,
             where={"rating": {"$gte": 0.5}}
@@ -197,4 +537,8 @@ def get_similar_feedback(query_text, limit=3):
         return {"ids": [[]], "metadatas": [[]]}
 
 def delete_feedback_collection():
-    feedback_collection.delete(where={})
\ No newline at end of file
+    get_feedback_collection().delete(where={})
+    get_feedback_index().clear()
+    get_relationship_store().clear_feedback()
+    if FEEDBACK_RETRIEVAL == "embedding":
+        get_relationship_collection().delete(where={})
\ No newline at end of file
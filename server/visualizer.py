@@ -1,10 +1,11 @@
-from sklearn.manifold import TSNE
 from vector_db import get_all_images_from_db
-import plotly.express as px
-import matplotlib.pyplot as plt
-import pandas as pd
 
 def display_image():
+    # Plotting and t-SNE libraries are only needed here, keep them out of module import
+    from sklearn.manifold import TSNE
+    import plotly.express as px
+    import pandas as pd
+
     db_results = get_all_images_from_db()
     
     if not db_results or 'embeddings' not in db_results: